@@ -0,0 +1,655 @@
+import os
+import json
+import time
+import hashlib
+import shutil
+import importlib.metadata
+import numpy as np
+from tqdm import tqdm
+
+import utils
+import data_io
+import profiling
+
+# bumped when the results of an analysis change, so that old cache entries are not used anymore
+CACHE_VERSION = 1
+# default maximum size of the cache in bytes
+DEFAULT_CACHE_SIZE = 2**30
+# name of the file with the hit and miss statistics of a cache folder
+STATS_FILE = 'stats.json'
+# name of the provenance manifest of an output folder
+MANIFEST_FILE = 'manifest.json'
+# suffix of the provenance manifest of an output file that is not in an output folder of its own (see get_file_manifest())
+MANIFEST_SUFFIX = '.manifest.json'
+# minimum time between two saves of a manifest while jobs record their outputs one by one (seconds)
+MANIFEST_SAVE_INTERVAL = 10
+# hash of the source files of the package (see source_hash())
+_source_hash = None
+
+
+class ResultCache:
+    """ Disk cache of result files. Entries are keyed by the hash of the name of the analysis, its parameters, the floating point type of the signals (see utils.get_dtype()), the version and the source files of the package (see source_hash()) and the fingerprints of its input files (size and modification time, or hash of the contents). When the cache is larger than max_size, the least recently used entries are removed
+
+        Parameters
+        ----------
+        cache_dir: str
+            path to cache folder
+        max_size: int
+            maximum size of the cache in bytes
+        hash_contents: bool
+            whether input files are identified by the hash of their contents (slower, but a copied or touched file still hits the cache) instead of their path, size and modification time
+
+        Returns
+        ----------
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_CACHE_SIZE, hash_contents: bool = False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        self._content_hashes = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def fingerprint(self, file_path: str) -> list:
+        """ Identifies an input file
+
+            Parameters
+            ----------
+            file_path: str
+                path to input file
+
+            Returns
+            ----------
+            fingerprint: list
+                hash of the contents, or path, size and modification time of the file
+        """
+        if not self.hash_contents:
+            return file_fingerprint(file_path)
+        stat = os.stat(file_path)
+        # a file is hashed only once per process (e.g. the data.npy of an NPY store, shared by all channels)
+        stat_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        if stat_key not in self._content_hashes:
+            file_hash = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    file_hash.update(block)
+            self._content_hashes[stat_key] = file_hash.hexdigest()
+        return [self._content_hashes[stat_key]]
+
+    def key(self, name: str, input_files: list, params) -> str:
+        """ Calculates the key of a result
+
+            Parameters
+            ----------
+            name: str
+                name of the analysis
+            input_files: list
+                paths to the files the result is calculated from
+            params: any
+                parameters of the analysis (JSON serializable, numpy arrays and numbers are converted)
+
+            Returns
+            ----------
+            key: str
+                hexadecimal SHA-256 hash
+        """
+        # results computed in float32 and float64 (see utils.get_dtype()), or by another version or modified sources of the
+        # package, are different entries
+        description = {'version': CACHE_VERSION, 'package_version': package_version(), 'source': source_hash(), 'name': name,
+                       'dtype': utils.get_dtype().name,
+                       'inputs': [self.fingerprint(input_file) for input_file in input_files],
+                       'params': params}
+        description = json.dumps(description, sort_keys=True, default=_canonical_json)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        """ Gets the path of the entry of a key in the cache folder
+
+            Parameters
+            ----------
+            key: str
+                key of the result
+
+            Returns
+            ----------
+            entry_path: str
+                path to entry file
+        """
+        return os.path.join(self.cache_dir, f'{key}.cache')
+
+    def get(self, key: str, output_file: str) -> bool:
+        """ Copies a cached result file to output_file
+
+            Parameters
+            ----------
+            key: str
+                key of the result
+            output_file: str
+                path to output file
+
+            Returns
+            ----------
+            hit: bool
+                True if the result was in the cache
+        """
+        entry_path = self.entry_path(key)
+        try:
+            shutil.copyfile(entry_path, output_file)
+            # the modification time of the entries is the time of their last use
+            os.utime(entry_path)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return False
+        self._count(hit=True)
+        return True
+
+    def put(self, key: str, result_file: str) -> None:
+        """ Copies a result file to the cache and removes the least recently used entries if the cache is too large
+
+            Parameters
+            ----------
+            key: str
+                key of the result
+            result_file: str
+                path to result file
+
+            Returns
+            ----------
+        """
+        if os.path.getsize(result_file) > self.max_size:
+            return
+        entry_path = self.entry_path(key)
+        tmp_entry_path = f'{entry_path}.{os.getpid()}.tmp'
+        shutil.copyfile(result_file, tmp_entry_path)
+        os.replace(tmp_entry_path, entry_path)
+        self.evict()
+
+    def get_arrays(self, key: str) -> dict:
+        """ Loads cached arrays (see put_arrays())
+
+            Parameters
+            ----------
+            key: str
+                key of the result
+
+            Returns
+            ----------
+            arrays: dict
+                cached arrays, or None if the result is not in the cache
+        """
+        entry_path = self.entry_path(key)
+        try:
+            with profiling.io_time():
+                with np.load(entry_path) as npz_file_contents:
+                    arrays = {name: npz_file_contents[name] for name in npz_file_contents.files}
+            os.utime(entry_path)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return arrays
+
+    def put_arrays(self, key: str, **arrays) -> None:
+        """ Saves arrays in the cache, as an NPZ file
+
+            Parameters
+            ----------
+            key: str
+                key of the result
+            **arrays: numpy.ndarray
+                arrays to be cached
+
+            Returns
+            ----------
+        """
+        entry_path = self.entry_path(key)
+        tmp_entry_path = f'{entry_path}.{os.getpid()}.tmp'
+        with profiling.io_time():
+            with open(tmp_entry_path, 'wb') as f:
+                np.savez(f, **arrays)
+        if os.path.getsize(tmp_entry_path) > self.max_size:
+            os.remove(tmp_entry_path)
+            return
+        os.replace(tmp_entry_path, entry_path)
+        self.evict()
+
+    def evict(self) -> None:
+        """ Removes the least recently used entries until the cache is not larger than max_size
+
+            Parameters
+            ----------
+
+            Returns
+            ----------
+        """
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.cache'):
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+                entries.append((stat.st_mtime_ns, stat.st_size, file_name))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, file_name in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dir, file_name))
+            size -= entry_size
+
+    def stats(self) -> dict:
+        """ Gets the statistics of the cache folder
+
+            Parameters
+            ----------
+
+            Returns
+            ----------
+            stats: dict
+                number of entries, size in bytes, and hits and misses (of this process and of all processes that used the cache folder)
+        """
+        sizes = [os.path.getsize(os.path.join(self.cache_dir, file_name))
+                 for file_name in os.listdir(self.cache_dir) if file_name.endswith('.cache')]
+        total_stats = self._read_stats()
+        return {'entries': len(sizes), 'size': sum(sizes), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses,
+                'total_hits': total_stats['hits'], 'total_misses': total_stats['misses']}
+
+    def clear(self) -> None:
+        """ Removes all entries and statistics
+
+            Parameters
+            ----------
+
+            Returns
+            ----------
+        """
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.cache') or file_name == STATS_FILE:
+                os.remove(os.path.join(self.cache_dir, file_name))
+        self.hits = 0
+        self.misses = 0
+
+    def _read_stats(self) -> dict:
+        try:
+            with open(os.path.join(self.cache_dir, STATS_FILE), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'hits': 0, 'misses': 0}
+
+    def _count(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        total_stats = self._read_stats()
+        total_stats['hits' if hit else 'misses'] += 1
+        stats_file_path = os.path.join(self.cache_dir, STATS_FILE)
+        with open(f'{stats_file_path}.{os.getpid()}.tmp', 'w') as f:
+            json.dump(total_stats, f)
+        os.replace(f'{stats_file_path}.{os.getpid()}.tmp', stats_file_path)
+
+
+class Manifest:
+    """ Provenance manifest of an output folder (manifest.json, which data_io.list_channel_files() skips like all files that are not NPZ files). It records every analysis that wrote outputs to the folder once (its name, parameters, fingerprints (path, size and modification time) of its input files, floating point type of the signals, version of the package and hash of its source files), and for every output file the analysis that wrote it. An output file is up to date if it was not modified since it was recorded and its provenance did not change, so that commands only regenerate stale outputs
+
+        Parameters
+        ----------
+        folder: str
+            path to output folder
+        path: str
+            path to the manifest file. If None, the manifest.json of the output folder
+
+        Returns
+        ----------
+    """
+
+    def __init__(self, folder: str, path: str = None):
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILE) if path is None else path
+        try:
+            with open(self.path, 'r') as f:
+                contents = json.load(f)
+            self.analyses, self.outputs = contents['analyses'], contents['outputs']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            self.analyses, self.outputs = {}, {}
+        self.modified = False
+        self._save_time = time.monotonic()
+
+    def provenance(self, name: str, input_files: list, params) -> dict:
+        """ Describes how output files are calculated
+
+            Parameters
+            ----------
+            name: str
+                name of the analysis
+            input_files: list
+                paths to the files the outputs are calculated from
+            params: any
+                parameters of the analysis (JSON serializable, numpy arrays and numbers are converted)
+
+            Returns
+            ----------
+            provenance: dict
+                name, parameters, input fingerprints, floating point type, package version and hash of the package sources
+        """
+        provenance = {'name': name, 'params': params,
+                      'inputs': [file_fingerprint(input_file) for input_file in input_files],
+                      'dtype': utils.get_dtype().name, 'version': package_version(), 'source': source_hash()}
+        # same representation as after a round trip through the manifest file
+        return json.loads(json.dumps(provenance, sort_keys=True, default=_canonical_json))
+
+    def is_up_to_date(self, output_file: str, provenance: dict) -> bool:
+        """ Checks whether an output file was recorded with the same provenance and not modified since. Always False if the environment variable ELECPHYS_FORCE_RECOMPUTE is 'True'
+
+            Parameters
+            ----------
+            output_file: str
+                path to output file, in the folder of the manifest
+            provenance: dict
+                provenance of the output file (see provenance())
+
+            Returns
+            ----------
+            up_to_date: bool
+                True if the output file does not have to be calculated again
+        """
+        if os.environ.get('ELECPHYS_FORCE_RECOMPUTE') == 'True':
+            return False
+        entry = self.outputs.get(os.path.basename(output_file))
+        if entry is None or not os.path.isfile(output_file):
+            return False
+        return entry['output'] == _output_fingerprint(output_file) and \
+            self.analyses.get(entry['analysis']) == provenance
+
+    def is_folder_up_to_date(self, provenance: dict) -> bool:
+        """ Checks whether all output files of an analysis that writes a whole folder at once (e.g. one file per channel, calculated from all channels) are up to date
+
+            Parameters
+            ----------
+            provenance: dict
+                provenance of the output files (see provenance())
+
+            Returns
+            ----------
+            up_to_date: bool
+                True if outputs were recorded for this analysis and they are all up to date
+        """
+        output_files = [output_file for output_file, entry in self.outputs.items()
+                        if self.analyses.get(entry['analysis'], {}).get('name') == provenance['name']]
+        return len(output_files) > 0 and all(self.is_up_to_date(os.path.join(self.folder, output_file), provenance)
+                                             for output_file in output_files)
+
+    def record(self, output_files: list, provenance: dict, save: bool = True) -> None:
+        """ Records output files that were just written. Their provenance is stored once, however many output files it has
+
+            Parameters
+            ----------
+            output_files: list
+                paths to output files, in the folder of the manifest
+            provenance: dict
+                provenance of the output files (see provenance())
+            save: bool
+                whether to save the manifest now. If False, it is saved by the next call to save()
+
+            Returns
+            ----------
+        """
+        analysis = hashlib.sha256(json.dumps(provenance, sort_keys=True).encode()).hexdigest()[:16]
+        self.analyses[analysis] = provenance
+        for output_file in output_files:
+            self.outputs[os.path.basename(output_file)] = {'output': _output_fingerprint(output_file),
+                                                           'analysis': analysis}
+        self.modified = True
+        if save:
+            self.save()
+
+    def save(self, min_interval: float = 0) -> None:
+        """ Saves the manifest if outputs were recorded since it was last saved
+
+            Parameters
+            ----------
+            min_interval: float
+                the manifest is not saved if it was saved less than min_interval seconds ago, so that jobs recording their outputs one by one only rewrite it from time to time
+
+            Returns
+            ----------
+        """
+        if not self.modified or time.monotonic() - self._save_time < min_interval:
+            return
+        # the analyses of outputs that were overwritten are not needed anymore
+        analyses = {entry['analysis'] for entry in self.outputs.values()}
+        self.analyses = {analysis: provenance for analysis, provenance in self.analyses.items() if analysis in analyses}
+        # written as a whole and renamed, so that an interrupted command does not leave a broken manifest
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': package_version(), 'analyses': self.analyses, 'outputs': self.outputs}, f, indent=1)
+        os.replace(tmp_path, self.path)
+        self.modified = False
+        self._save_time = time.monotonic()
+
+
+def file_fingerprint(file_path: str) -> list:
+    """ Identifies a file by its path, size and modification time
+
+        Parameters
+        ----------
+        file_path: str
+            path to file
+
+        Returns
+        ----------
+        fingerprint: list
+            absolute path, size in bytes and modification time in nanoseconds
+    """
+    stat = os.stat(file_path)
+    return [os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns]
+
+
+def _output_fingerprint(file_path: str) -> list:
+    """ Identifies an output file by its size and modification time (its path is the key of the manifest) """
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def package_version() -> str:
+    """ Gets the version of the installed package, or 'unknown' if it runs from a source tree """
+    try:
+        return importlib.metadata.version('ElecPhys')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def source_hash() -> str:
+    """ Gets the hash of the source files of the package (elecphys/*.py), computed once per process. The package version is not bumped by every change of an analysis (and is 'unknown' in a source tree), so the cache keys and the provenance of the outputs include this hash too """
+    global _source_hash
+    if _source_hash is None:
+        package_folder = os.path.dirname(os.path.realpath(__file__))
+        sha256 = hashlib.sha256()
+        for file_name in sorted(os.listdir(package_folder)):
+            if file_name.endswith('.py'):
+                sha256.update(file_name.encode())
+                with open(os.path.join(package_folder, file_name), 'rb') as f:
+                    sha256.update(f.read())
+        _source_hash = sha256.hexdigest()[:16]
+    return _source_hash
+
+
+def get_manifest(output_folder: str, *input_folders: str) -> Manifest:
+    """ Gets the provenance manifest of an output folder
+
+        Parameters
+        ----------
+        output_folder: str
+            path to output folder
+        *input_folders: str
+            paths to the folders the outputs are calculated from
+
+        Returns
+        ----------
+        manifest: Manifest
+            manifest of the output folder, or None if the output folder or an input folder is in memory (see data_io.is_memory_folder())
+    """
+    if any(data_io.is_memory_folder(folder) for folder in (output_folder,) + input_folders):
+        return None
+    return Manifest(output_folder)
+
+
+def get_file_manifest(output_file: str) -> Manifest:
+    """ Gets the provenance manifest of an output file that is not in an output folder of its own (e.g. a MAT file written to any folder), saved next to it as <output file>.manifest.json
+
+        Parameters
+        ----------
+        output_file: str
+            path to output file
+
+        Returns
+        ----------
+        manifest: Manifest
+            manifest of the output file
+    """
+    return Manifest(os.path.dirname(output_file) or '.', f'{output_file}{MANIFEST_SUFFIX}')
+
+
+def _canonical_json(obj):
+    """ Converts the objects that json cannot serialize (numpy arrays and numbers, tuples in sets...) """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} cannot be part of a cache key')
+
+
+def get_cache() -> ResultCache:
+    """ Gets the result cache configured with the environment variables ELECPHYS_CACHE_DIR (cache folder, the cache is disabled if it is not set or empty), ELECPHYS_CACHE_SIZE (maximum size in bytes) and ELECPHYS_CACHE_HASH_CONTENTS ('True' to identify input files by the hash of their contents)
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        cache: ResultCache
+            result cache, or None if the cache is disabled
+    """
+    cache_dir = os.environ.get('ELECPHYS_CACHE_DIR')
+    if not cache_dir:
+        return None
+    max_size = int(os.environ.get('ELECPHYS_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    hash_contents = os.environ.get('ELECPHYS_CACHE_HASH_CONTENTS') == 'True'
+    cache = _caches.get((cache_dir, max_size, hash_contents))
+    if cache is None:
+        cache = ResultCache(cache_dir, max_size, hash_contents)
+        _caches[(cache_dir, max_size, hash_contents)] = cache
+    return cache
+
+
+_caches = {}
+
+
+def channel_input_files(input_npz_folder: str, npz_file: str) -> list:
+    """ Gets the files a channel is read from
+
+        Parameters
+        ----------
+        input_npz_folder: str
+            path to npz folder or NPY store folder
+        npz_file: str
+            channel file name (see data_io.list_channel_files())
+
+        Returns
+        ----------
+        input_files: list
+            paths to the files
+    """
+    if data_io.is_npy_store(input_npz_folder):
+        return [os.path.join(input_npz_folder, data_io.NPY_STORE_DATA_FILE),
+                os.path.join(input_npz_folder, data_io.NPY_STORE_INFO_FILE)]
+    return [os.path.join(input_npz_folder, npz_file)]
+
+
+def folder_input_files(input_npz_folder: str) -> list:
+    """ Gets the files all channels of a folder are read from
+
+        Parameters
+        ----------
+        input_npz_folder: str
+            path to npz folder or NPY store folder
+
+        Returns
+        ----------
+        input_files: list
+            sorted paths to the files
+    """
+    input_files = [channel_input_files(input_npz_folder, npz_file)
+                   for npz_file in data_io.list_channel_files(input_npz_folder)]
+    return sorted(set(sum(input_files, [])))
+
+
+def run_jobs(func, args_list: list, n_jobs: int, name: str, input_files_list: list, params_list: list,
+             output_files: list) -> list:
+    """ Same as utils.run_jobs() for jobs that save their result in a file, but the jobs whose result file is up to date (see Manifest) are skipped, the result files that are in the cache (see get_cache()) are copied instead of being calculated, and the calculated ones are added to the cache. The outputs are recorded in the manifests of the output folders as the jobs complete, and the manifests are saved from time to time and when all jobs are done (or one fails)
+
+        Parameters
+        ----------
+        func: function
+            module-level (picklable) function taking one argument
+        args_list: list
+            list of arguments to be passed to func, one per job
+        n_jobs: int
+            number of worker processes. If 1, the jobs run in the current process. If None, 0 or negative, all CPU cores are used
+        name: str
+            name of the analysis
+        input_files_list: list
+            paths to the input files of every job
+        params_list: list
+            parameters of every job (everything but the input files that the result depends on)
+        output_files: list
+            path to the result file of every job
+
+        Returns
+        ----------
+        results: list
+            func(args) for every args in args_list, in order, or None for the jobs whose result was up to date or in the cache
+    """
+    results = [None] * len(args_list)
+    manifests = {}
+    provenances = []
+    for input_files, params, output_file in zip(input_files_list, params_list, output_files):
+        output_folder = os.path.dirname(output_file)
+        if output_folder not in manifests:
+            manifests[output_folder] = Manifest(output_folder)
+        provenances.append(manifests[output_folder].provenance(name, input_files, params))
+    stale_jobs = [job_indx for job_indx, output_file in enumerate(output_files)
+                  if not manifests[os.path.dirname(output_file)].is_up_to_date(output_file, provenances[job_indx])]
+    if len(stale_jobs) < len(args_list):
+        print(f'{len(args_list) - len(stale_jobs)} of {len(args_list)} results up to date')
+
+    cache = get_cache()
+    missing_jobs = stale_jobs
+    try:
+        if cache is not None:
+            keys = {job_indx: cache.key(name, input_files_list[job_indx], params_list[job_indx])
+                    for job_indx in stale_jobs}
+            missing_jobs = []
+            for job_indx in stale_jobs:
+                if cache.get(keys[job_indx], output_files[job_indx]):
+                    manifests[os.path.dirname(output_files[job_indx])].record([output_files[job_indx]],
+                                                                              provenances[job_indx], save=False)
+                else:
+                    missing_jobs.append(job_indx)
+            if len(missing_jobs) < len(stale_jobs):
+                print(f'{len(stale_jobs) - len(missing_jobs)} of {len(stale_jobs)} results found in cache {cache.cache_dir}')
+        missing_results = utils.parallel_imap(func, [args_list[job_indx] for job_indx in missing_jobs], n_jobs)
+        for result, job_indx in zip(tqdm(missing_results, total=len(missing_jobs)), missing_jobs):
+            results[job_indx] = result
+            if cache is not None:
+                cache.put(keys[job_indx], output_files[job_indx])
+            manifest = manifests[os.path.dirname(output_files[job_indx])]
+            manifest.record([output_files[job_indx]], provenances[job_indx], save=False)
+            # saved from time to time, so that an interrupted command resumes about where it stopped
+            manifest.save(MANIFEST_SAVE_INTERVAL)
+    finally:
+        for manifest in manifests.values():
+            manifest.save()
+    return results
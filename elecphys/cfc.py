@@ -3,6 +3,16 @@ import numpy as np
 from scipy import signal
 from tqdm import tqdm
 from scipy.fft import fft
+import utils
+
+# maximum number of elements of the (lags x time bins) blocks built by rid_rihaczek4()
+_MAX_BLOCK_ELEMENTS = 2**22
+# maximum number of samples of the blocks of windows processed at once by sliding_comodulogram()
+_MAX_BLOCK_SAMPLES = 2**20
+# default number of surrogates evaluated by each job of surrogate_comodulogram() (the seeds depend on it)
+_SURROGATES_PER_JOB = 10
+# up to this number of frequency rows, rid_rihaczek4() computes them with a DFT matrix instead of a full FFT
+_MAX_DFT_ROWS = 32
 
 
 def calc_tf_mvl(x, fs: int, freqs_phase: list, freqs_amp: list) -> np.ndarray:
@@ -25,15 +35,67 @@ def calc_tf_mvl(x, fs: int, freqs_phase: list, freqs_amp: list) -> np.ndarray:
                 2D tf_MVL matrix (phase x amplitude)
     """
 
-    MI_mat = np.zeros((len(freqs_phase), len(freqs_amp)))
-    for phase_counter, freq_phase in enumerate(freqs_phase):
-        for amp_counter, freq_amp in enumerate(freqs_amp):
-            mvl = band_tfMVL(x, [freq_amp - 1, freq_amp + 1],
-                             [freq_phase - 1, freq_phase + 1], fs)
-            MI_mat[phase_counter, amp_counter] = mvl
+    Phase, Amp = tf_phase_amp(x, fs, freqs_phase, freqs_amp)
+    MI_mat = mvl_from_phase_amp(Phase, Amp)
     return MI_mat
 
 
+def tf_phase_amp(x, fs: int, freqs_phase: list, freqs_amp: list) -> [np.ndarray, np.ndarray]:
+    """ Function that Calculates the phases and amplitudes used by calc_tf_mvl(). The distribution is calculated once, for the rows used by any (phase, amplitude) pair
+
+        Parameters
+        ----------
+            x: np.array
+                signal in time domain
+            fs: float
+                sampling frequency (Hz)
+            freqs_phase: list
+                phase frequencies (Hz)
+            freqs_amp: list
+                amplitude frequencies (Hz)
+
+        Returns
+        ----------
+            Phase: np.ndarray
+                unit phasors of the rows around every phase frequency. Shape: (len(freqs_phase), 2, num_time_bins)
+            Amp: np.ndarray
+                amplitudes of the rows around every amplitude frequency. Shape: (len(freqs_amp), 2, num_time_bins)
+    """
+
+    # same rows as band_tfMVL() for every (phase, amplitude) pair
+    fs = int(fs)
+    num_rows = len(x) if len(x) - 1 == fs else fs
+    rows = np.arange(num_rows)[1:]
+    high_rows = rows[[[freq_amp - 1, freq_amp + 1] for freq_amp in freqs_amp]]
+    low_rows = rows[[[freq_phase - 1, freq_phase + 1] for freq_phase in freqs_phase]]
+    tfd_rows, tfd_indexes = np.unique(np.concatenate((high_rows.ravel(), low_rows.ravel())), return_inverse=True)
+    W = rid_rihaczek4(x, fs, freq_rows=tfd_rows)
+    Amp = np.abs(W[tfd_indexes[:high_rows.size].reshape(high_rows.shape), :])
+    Phase = np.exp(1j * np.angle(W[tfd_indexes[high_rows.size:].reshape(low_rows.shape), :]))
+    return Phase, Amp
+
+
+def mvl_from_phase_amp(Phase: np.ndarray, Amp: np.ndarray) -> np.ndarray:
+    """ Function that Calculates the tf_MVL matrix from the phases and amplitudes of tf_phase_amp(). All pairs are reduced at once
+
+        Parameters
+        ----------
+            Phase: np.ndarray
+                unit phasors. Shape: (num_freqs_phase, 2, num_time_bins)
+            Amp: np.ndarray
+                amplitudes. Shape: (num_freqs_amp, 2, num_time_bins), or (num_freqs_amp, 2, num_surrogates, num_time_bins) for a batch of surrogates
+
+        Returns
+        ----------
+            MI_mat: np.ndarray
+                2D tf_MVL matrix (phase x amplitude), or 3D (surrogate x phase x amplitude) for a batch of surrogates
+    """
+
+    if Amp.ndim == 4:
+        return np.abs(np.einsum('pkt,akst->spa', Phase, Amp)) / (Amp.shape[1] * Amp.shape[3])
+    return np.abs(np.einsum('pkt,akt->pa', Phase, Amp)) / (Amp.shape[1] * Amp.shape[2])
+
+
 def band_tfMVL(x, high_freq, low_freq, fs: int) -> float:
     """ Function that Calculates the tf_MVL for a given signal x
 
@@ -55,11 +117,13 @@ def band_tfMVL(x, high_freq, low_freq, fs: int) -> float:
     """
 
     fs = int(fs)
-    tfd = rid_rihaczek4(x, fs)
-    W = tfd
-    W2 = W[1:, :]
-    Amp = np.abs(W2[high_freq, :])
-    tfd_low = W2[low_freq, :]
+    # only the rows of the distribution that are used are calculated (W2 = W[1:, :])
+    num_rows = len(x) if len(x) - 1 == fs else fs
+    high_rows = np.arange(num_rows)[1:][high_freq]
+    low_rows = np.arange(num_rows)[1:][low_freq]
+    W = rid_rihaczek4(x, fs, freq_rows=np.concatenate((high_rows, low_rows)))
+    Amp = np.abs(W[:len(high_rows), :])
+    tfd_low = W[len(high_rows):, :]
     angle_low = np.angle(tfd_low)
     Phase = angle_low
     tf_canolty = calc_MVL(Phase, Amp)
@@ -88,7 +152,7 @@ def calc_MVL(phase, amp) -> np.ndarray:
     return MVL
 
 
-def rid_rihaczek4(x, fbins) -> np.ndarray:
+def rid_rihaczek4(x, fbins, freq_rows: list = None) -> np.ndarray:
     """ Function that Calculates the rid_rihaczek4 for a given signal x
 
         Parameters
@@ -97,49 +161,50 @@ def rid_rihaczek4(x, fbins) -> np.ndarray:
                 signal in time domain
             fbins: int
                 number of frequency bins
+            freq_rows: list
+                frequency bins (rows of the distribution) to be calculated. If None, all rows are calculated
 
         Returns
         ----------
             tfd: np.ndarray
-                2D rid_rihaczek4 matrix
+                2D rid_rihaczek4 matrix. Shape: (fbins, len(x)), or (len(freq_rows), len(x)) if freq_rows is given
     """
 
+    x = np.real(np.asarray(x)).astype(float)
     tbins = len(x)
-    amb = np.zeros((tbins, tbins))
-
-    for tau in range(tbins):
-        indexes = np.arange(tau, tbins, 1)
-        indexes = np.append(indexes, np.arange(0, tau, 1))
-        amb[tau, :] = np.multiply(np.conj(x), x[indexes])
-
-    indexes = np.arange(int(tbins / 2), tbins)
-    indexes = np.append(indexes, np.arange(0, int(tbins / 2)))
-
-    ambTemp = amb[:, indexes]
-
-    indexes = np.arange(0, int(tbins / 2))
-    indexes = np.append(np.arange(int(tbins / 2), tbins), indexes)
-    amb1 = ambTemp[indexes, :]
-
-    D_mult = np.linspace(-1, 1, tbins)
-    D_mult = np.reshape(D_mult, (-1, len(D_mult)))
-    D = np.matmul(np.transpose(D_mult), D_mult)
-    L = D
-
-    K = chwi_krn(D, L, 0.01)
-    df = K
-    ambf = np.multiply(amb1, df)
-    A = np.zeros((fbins, tbins))
-    tbins = tbins - 1
-    if tbins != fbins:
-        for tt in range(tbins):
-            A[:, tt] = data_wrapper(ambf[:, tt], fbins)
+    fbins = int(fbins)
+    if tbins - 1 == fbins:
+        nfft = tbins
+        num_columns = tbins
     else:
-        A = ambf
-
-    tfd = np.zeros(A.shape, dtype='complex_')
-    for col in range(A.shape[1]):
-        tfd[:, col] = fft(A[:, col])
+        nfft = fbins
+        # the last time bin is left empty, as in the original implementation
+        num_columns = tbins - 1
+    if freq_rows is None:
+        freq_rows = np.arange(nfft)
+    freq_rows = np.asarray(freq_rows, dtype=int)
+    use_fft = len(freq_rows) > _MAX_DFT_ROWS
+    if not use_fft:
+        dft_matrix = np.exp(-2j * np.pi * (np.outer(freq_rows, np.arange(nfft)) % nfft) / nfft)
+
+    # the ambiguity function, its kernel and the distribution are built a block of time bins at a time,
+    # so that memory scales with tbins * (block size + number of frequency rows)
+    half = int(tbins / 2)
+    lags = (np.arange(tbins) + half) % tbins
+    D_mult = np.linspace(-1, 1, tbins)
+    block_size = max(1, _MAX_BLOCK_ELEMENTS // max(tbins, nfft))
+    tfd = np.zeros((len(freq_rows), tbins), dtype=complex)
+    for block_start in range(0, num_columns, block_size):
+        columns = np.arange(block_start, min(block_start + block_size, num_columns))
+        times = (columns + half) % tbins
+        amb1 = np.multiply(x[times][np.newaxis, :], x[(times[np.newaxis, :] + lags[:, np.newaxis]) % tbins])
+        D = np.multiply(D_mult[:, np.newaxis], D_mult[np.newaxis, columns])
+        ambf = np.multiply(amb1, chwi_krn(D, D, 0.01))
+        A = data_wrapper(ambf, nfft)
+        if use_fft:
+            tfd[:, columns] = fft(A, axis=0)[freq_rows, :]
+        else:
+            tfd[:, columns] = np.matmul(dft_matrix, A)
 
     return tfd
 
@@ -167,25 +232,27 @@ def chwi_krn(D, L, A) -> np.ndarray:
 
 
 def data_wrapper(x, sec_dim) -> np.ndarray:
-    """ Function that Wraps the data for a given signal x
+    """ Function that Wraps the data for a given signal x (along its first axis) to sec_dim samples. Longer signals are folded (samples sec_dim apart are summed) and shorter signals are extended periodically
 
         Parameters
         ----------
             x: np.array
-                signal in time domain
+                signal in time domain. Shape: (num_samples,) or (num_samples, num_columns)
             sec_dim: int
                 second dimension
 
         Returns
         ----------
             wrapped_x: np.ndarray
-                wrapped signal
+                wrapped signal. Shape: (sec_dim,) or (sec_dim, num_columns)
     """
 
-    wrapped_x = np.zeros((sec_dim, 1))
-    wrapped_x[0:len(x), 0] = x
-    wrapped_x[len(x):sec_dim, 0] = x[0:sec_dim - len(x)]
-    wrapped_x = np.squeeze(wrapped_x)
+    x = np.asarray(x)
+    if len(x) <= sec_dim:
+        return x[np.arange(sec_dim) % len(x)]
+    num_folds = -(-len(x) // sec_dim)
+    padding = [(0, num_folds * sec_dim - len(x))] + [(0, 0)] * (x.ndim - 1)
+    wrapped_x = np.pad(x, padding).reshape((num_folds, sec_dim) + x.shape[1:]).sum(axis=0)
     return wrapped_x
 
 
@@ -212,29 +279,324 @@ def cfc_mi(sig, freqs_phase: list, freqs_amp: list,
                 2D MI matrix (phase x amplitude)
     """
 
+    inst_phase, inst_amp = phase_amp_filter_bank(sig, freqs_phase, freqs_amp, fs)
+    MI_mat = mi_from_phase_amp(inst_phase, inst_amp, nbins)
+    return MI_mat
+
+
+def phase_amp_filter_bank(sig, freqs_phase: list, freqs_amp: list, fs: int) -> [np.ndarray, np.ndarray]:
+    """ Function that Filters a signal at every phase and amplitude frequency (each frequency is filtered once) and extracts the instantaneous phases and amplitudes
+
+        Parameters
+        ----------
+            sig: np.array
+                signal in time domain
+            freqs_phase: list
+                phase frequencies (Hz)
+            freqs_amp: list
+                amplitude frequencies (Hz)
+            fs: int
+                sampling frequency (Hz)
+
+        Returns
+        ----------
+            inst_phase: np.ndarray
+                instantaneous phase (degrees, between 0 and 360) at every phase frequency. Shape: (len(freqs_phase), len(sig))
+            inst_amp: np.ndarray
+                instantaneous amplitude at every amplitude frequency. Shape: (len(freqs_amp), len(sig))
+    """
+
+    freqs, freqs_indexes = np.unique(np.concatenate((np.asarray(freqs_phase, dtype=float),
+                                                     np.asarray(freqs_amp, dtype=float))), return_inverse=True)
+    sig_filt = np.zeros((len(freqs), len(sig)))
+    for freq_counter, freq in enumerate(freqs):
+        sig_filt[freq_counter, :], _, _ = butterworth_filter(sig, freq, fs)
+    inst_phase = extract_inst_phase(sig_filt[freqs_indexes[:len(freqs_phase)], :])
+    inst_amp = extract_inst_amp(sig_filt[freqs_indexes[len(freqs_phase):], :])
+    return inst_phase, inst_amp
+
+
+def mi_from_phase_amp(inst_phase: np.ndarray, inst_amp: np.ndarray, nbins: int = 20) -> np.ndarray:
+    """ Function that Calculates the MI matrix from instantaneous phases and amplitudes (see phase_amp_filter_bank()). The mean amplitude in every phase bin is calculated for all amplitude frequencies at once
+
+        Parameters
+        ----------
+            inst_phase: np.ndarray
+                instantaneous phase (degrees) at every phase frequency. Shape: (num_freqs_phase, num_samples)
+            inst_amp: np.ndarray
+                instantaneous amplitude at every amplitude frequency. Shape: (num_freqs_amp, num_samples)
+            nbins: int
+                number of bins
+
+        Returns
+        ----------
+            MI_mat: np.ndarray
+                2D MI matrix (phase x amplitude). NaN if a phase bin is empty
+    """
+
     uniform_dist = np.ones((nbins - 1,))
     uniform_dist = uniform_dist / np.sum(uniform_dist)
     bins = np.linspace(0, 360, nbins)
+    num_bins = len(bins) - 1
+    num_freqs_amp = inst_amp.shape[0]
+
+    MI_mat = np.zeros((inst_phase.shape[0], num_freqs_amp))
+    for phase_counter in range(inst_phase.shape[0]):
+        # phases outside [0, 360) go to an extra bin, which is then dropped
+        phase_bins = np.digitize(inst_phase[phase_counter, :], bins) - 1
+        phase_bins[(phase_bins < 0) | (phase_bins >= num_bins)] = num_bins
+        counts = np.bincount(phase_bins, minlength=num_bins + 1)[:num_bins]
+        sums = np.bincount((np.arange(num_freqs_amp)[:, np.newaxis] * (num_bins + 1) + phase_bins).ravel(),
+                           weights=inst_amp.ravel(), minlength=num_freqs_amp * (num_bins + 1))
+        sums = sums.reshape((num_freqs_amp, num_bins + 1))[:, :num_bins]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means_amps_in_bin = sums / counts
+            means_amps_in_bin = means_amps_in_bin / np.sum(means_amps_in_bin, axis=1, keepdims=True)
+        MI = np.sum(rel_entr(means_amps_in_bin, uniform_dist), axis=1)
+        MI_mat[phase_counter, :] = MI / nbins
+    return MI_mat
+
+
+def surrogate_comodulogram(x, fs: int, freqs_phase: list, freqs_amp: list, method: str = 'tf_mvl',
+                           num_surrogates: int = 200, surrogate_type: str = 'circular_shift', nbins: int = 20,
+                           num_blocks: int = 10, seed: int = None, n_jobs: int = 1) -> [np.ndarray, np.ndarray, np.ndarray]:
+    """ Function that Tests the significance of a comodulogram against surrogates, in which the amplitudes are shifted in time relative to the phases
+
+        The phases and amplitudes are extracted once (see phase_amp_filter_bank() and tf_phase_amp()) and only the amplitude series are shifted, so no surrogate is filtered or transformed again. Surrogates are evaluated in batches, in parallel. Each batch has its own seed (spawned from seed with numpy.random.SeedSequence), so the results do not depend on n_jobs
+
+        Parameters
+        ----------
+            x: np.array
+                signal in time domain
+            fs: int
+                sampling frequency (Hz)
+            freqs_phase: list
+                phase frequencies (Hz)
+            freqs_amp: list
+                amplitude frequencies (Hz)
+            method: str
+                'tf_mvl' (see calc_tf_mvl()) or 'mi' (see cfc_mi()). Default is 'tf_mvl'
+            num_surrogates: int
+                number of surrogates
+            surrogate_type: str
+                'circular_shift' (amplitudes shifted circularly by a random lag of at least one second, or one tenth of the signal if it is shorter than 10 seconds) or 'block_swap' (amplitudes cut in num_blocks blocks that are randomly permuted)
+            nbins: int
+                number of bins of the 'mi' method
+            num_blocks: int
+                number of blocks of the 'block_swap' surrogates
+            seed: int
+                seed of the random generator. If None, fresh entropy is used
+            n_jobs: int
+                number of batches of surrogates evaluated in parallel. If None, 0 or negative, all CPU cores are used
+
+        Returns
+        ----------
+            MI_mat: np.ndarray
+                2D comodulogram (phase x amplitude)
+            z_mat: np.ndarray
+                z-score of MI_mat relative to the surrogates
+            p_mat: np.ndarray
+                p-value of MI_mat, i.e. (1 + number of surrogates >= MI_mat) / (1 + num_surrogates)
+    """
+
+    if method not in ['tf_mvl', 'mi']:
+        raise ValueError(f'Invalid method: {method}. Must be "tf_mvl" or "mi"')
+    if surrogate_type not in ['circular_shift', 'block_swap']:
+        raise ValueError(f'Invalid surrogate type: {surrogate_type}. Must be "circular_shift" or "block_swap"')
+    if num_surrogates <= 0:
+        raise ValueError('num_surrogates must be positive')
+
+    if method == 'mi':
+        phase, amp = phase_amp_filter_bank(x, freqs_phase, freqs_amp, fs)
+        MI_mat = mi_from_phase_amp(phase, amp, nbins)
+    else:
+        phase, amp = tf_phase_amp(x, fs, freqs_phase, freqs_amp)
+        MI_mat = mvl_from_phase_amp(phase, amp)
+    num_samples = amp.shape[-1]
+    if surrogate_type == 'block_swap' and not 2 <= num_blocks <= num_samples:
+        raise ValueError(f'num_blocks must be between 2 and the number of samples ({num_samples})')
+    min_shift = min(int(fs), num_samples // 10)
+
+    batch_sizes = [min(_SURROGATES_PER_JOB, num_surrogates - i) for i in range(0, num_surrogates, _SURROGATES_PER_JOB)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    args_list = [(phase, amp, method, nbins, surrogate_type, min_shift, num_blocks, batch_size, batch_seed)
+                 for batch_size, batch_seed in zip(batch_sizes, seeds)]
+    surrogates_MI_mat = np.concatenate(utils.run_jobs(_surrogates_batch, args_list, n_jobs), axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z_mat = (MI_mat - np.mean(surrogates_MI_mat, axis=0)) / np.std(surrogates_MI_mat, axis=0)
+    p_mat = (1 + np.sum(surrogates_MI_mat >= MI_mat, axis=0)) / (1 + num_surrogates)
+    return MI_mat, z_mat, p_mat
+
+
+def surrogate_indexes(num_samples: int, num_surrogates: int, surrogate_type: str, rng: np.random.Generator,
+                      min_shift: int = 1, num_blocks: int = 10) -> np.ndarray:
+    """ Function that Draws the time indexes of surrogate series (see surrogate_comodulogram())
+
+        Parameters
+        ----------
+            num_samples: int
+                number of samples of the series
+            num_surrogates: int
+                number of surrogates
+            surrogate_type: str
+                'circular_shift' or 'block_swap'
+            rng: np.random.Generator
+                random generator
+            min_shift: int
+                minimum lag of the 'circular_shift' surrogates (samples)
+            num_blocks: int
+                number of blocks of the 'block_swap' surrogates
+
+        Returns
+        ----------
+            indexes: np.ndarray
+                series[..., indexes[i]] is the i-th surrogate. Shape: (num_surrogates, num_samples)
+    """
+
+    if surrogate_type == 'circular_shift':
+        min_shift = max(1, min(min_shift, num_samples // 2))
+        shifts = rng.integers(min_shift, num_samples - min_shift, size=num_surrogates, endpoint=True)
+        return (np.arange(num_samples) + shifts[:, np.newaxis]) % num_samples
+    boundaries = np.linspace(0, num_samples, num_blocks + 1).astype(int)
+    blocks = [np.arange(boundaries[i], boundaries[i + 1]) for i in range(num_blocks)]
+    return np.array([np.concatenate([blocks[i] for i in rng.permutation(num_blocks)])
+                     for _ in range(num_surrogates)])
+
+
+def _surrogates_batch(args: tuple) -> np.ndarray:
+    """ Function that Calculates the comodulograms of a batch of surrogates. Worker of surrogate_comodulogram()
+
+        Parameters
+        ----------
+            args: tuple
+                (phase, amp, method, nbins, surrogate_type, min_shift, num_blocks, num_surrogates, seed)
+
+        Returns
+        ----------
+            MI_mat: np.ndarray
+                comodulograms of the surrogates. Shape: (num_surrogates, num_freqs_phase, num_freqs_amp)
+    """
+
+    phase, amp, method, nbins, surrogate_type, min_shift, num_blocks, num_surrogates, seed = args
+    indexes = surrogate_indexes(amp.shape[-1], num_surrogates, surrogate_type,
+                                np.random.default_rng(seed), min_shift, num_blocks)
+    # surrogates are evaluated in chunks of at most _MAX_BLOCK_ELEMENTS shifted amplitude samples
+    chunk_size = max(1, _MAX_BLOCK_ELEMENTS // amp.size)
+    MI_mat = np.zeros((num_surrogates, phase.shape[0], amp.shape[0]))
+    for i in range(0, num_surrogates, chunk_size):
+        chunk_amp = amp[..., indexes[i:i + chunk_size]]
+        if method == 'mi':
+            # (num_freqs_amp, chunk, num_samples) -> one amplitude row per (surrogate, frequency)
+            chunk_amp = chunk_amp.transpose(1, 0, 2).reshape(-1, amp.shape[-1])
+            chunk_MI_mat = mi_from_phase_amp(phase, chunk_amp, nbins)
+            MI_mat[i:i + chunk_size] = chunk_MI_mat.reshape(phase.shape[0], -1, amp.shape[0]).transpose(1, 0, 2)
+        else:
+            MI_mat[i:i + chunk_size] = mvl_from_phase_amp(phase, chunk_amp)
+    return MI_mat
+
+
+def sliding_comodulogram(x, fs: int, freqs_phase: list, freqs_amp: list, window_size: float, step: float,
+                         method: str = 'tf_mvl', nbins: int = 20, output_npy_file: str = None,
+                         n_jobs: int = 1) -> [np.ndarray, np.ndarray]:
+    """ Function that Calculates a comodulogram in sliding windows, to follow how the coupling changes over time
+
+        The windows are processed in blocks of consecutive windows, in parallel. With the 'mi' method, the filter bank (see phase_amp_filter_bank()) is applied once to each block (with one window of margin on both sides), and the overlapping windows of the block share its phases and amplitudes. With the 'tf_mvl' method, the distribution depends on the window, so calc_tf_mvl() is called for each window. Results are written block by block, so that long recordings can be processed in bounded memory
+
+        Parameters
+        ----------
+            x: np.array
+                signal in time domain (can be a memory-mapped array, only the samples of the blocks being processed are read)
+            fs: int
+                sampling frequency (Hz)
+            freqs_phase: list
+                phase frequencies (Hz)
+            freqs_amp: list
+                amplitude frequencies (Hz)
+            window_size: float
+                window size in seconds
+            step: float
+                step between the starts of consecutive windows in seconds
+            method: str
+                'tf_mvl' (see calc_tf_mvl()) or 'mi' (see cfc_mi()). Default is 'tf_mvl'
+            nbins: int
+                number of bins of the 'mi' method
+            output_npy_file: str
+                path to a .npy file in which the comodulograms are written as they are calculated. If None, they are kept in memory
+            n_jobs: int
+                number of blocks of windows processed in parallel. If None, 0 or negative, all CPU cores are used
+
+        Returns
+        ----------
+            MI_mat: np.ndarray
+                comodulograms of all windows (memory-mapped array if output_npy_file is given). Shape: (num_windows, len(freqs_phase), len(freqs_amp))
+            t: np.ndarray
+                center time of every window in seconds
+    """
+
+    if method not in ['tf_mvl', 'mi']:
+        raise ValueError(f'Invalid method: {method}. Must be "tf_mvl" or "mi"')
+    window_length = int(window_size * fs)
+    step_length = int(step * fs)
+    if window_length <= 0 or step_length <= 0:
+        raise ValueError('window_size and step must be at least one sample long')
+    if len(x) < window_length:
+        raise ValueError(f'Signal ({len(x)} samples) is shorter than the window ({window_length} samples)')
+    num_windows = (len(x) - window_length) // step_length + 1
+    window_starts = np.arange(num_windows) * step_length
+    t = (window_starts + window_length / 2) / fs
+
+    shape = (num_windows, len(freqs_phase), len(freqs_amp))
+    if output_npy_file is None:
+        MI_mat = np.zeros(shape)
+    else:
+        MI_mat = np.lib.format.open_memmap(output_npy_file, mode='w+', dtype=np.float64, shape=shape)
+
+    # blocks of about _MAX_BLOCK_SAMPLES samples
+    windows_per_block = max(1, (_MAX_BLOCK_SAMPLES - window_length) // step_length + 1)
+    margin = window_length if method == 'mi' else 0
+    blocks = [window_starts[i:i + windows_per_block] for i in range(0, num_windows, windows_per_block)]
+
+    def block_args():
+        for block_starts in blocks:
+            segment_start = max(block_starts[0] - margin, 0)
+            segment_stop = min(block_starts[-1] + window_length + margin, len(x))
+            yield (np.asarray(x[segment_start:segment_stop], dtype=float), fs, freqs_phase, freqs_amp, method,
+                   nbins, block_starts - segment_start, window_length)
+
+    window_counter = 0
+    for block_MI_mat in tqdm(utils.parallel_imap(_comodulogram_block, block_args(), n_jobs), total=len(blocks)):
+        MI_mat[window_counter:window_counter + len(block_MI_mat)] = block_MI_mat
+        window_counter += len(block_MI_mat)
+    if output_npy_file is not None:
+        MI_mat.flush()
+    return MI_mat, t
+
+
+def _comodulogram_block(args: tuple) -> np.ndarray:
+    """ Function that Calculates the comodulograms of a block of windows. Worker of sliding_comodulogram()
+
+        Parameters
+        ----------
+            args: tuple
+                (segment, fs, freqs_phase, freqs_amp, method, nbins, window_starts, window_length), where window_starts are relative to the segment
+
+        Returns
+        ----------
+            MI_mat: np.ndarray
+                comodulograms of the windows. Shape: (len(window_starts), len(freqs_phase), len(freqs_amp))
+    """
 
-    MI_mat = np.zeros((len(freqs_phase), len(freqs_amp)))
-    for phase_counter, freq_phase in enumerate(tqdm(freqs_phase)):
-        for amp_counter, freq_amp in enumerate(freqs_amp):
-            phase_sig_filt, _, _ = butterworth_filter(sig, freq_phase, fs)
-            amp_sig_filt, _, _ = butterworth_filter(sig, freq_amp, fs)
-            inst_phase = extract_inst_phase(phase_sig_filt)
-            inst_amp = extract_inst_amp(amp_sig_filt)
-
-            means_amps_in_bin = []
-            for bin_counter in range(len(bins) - 1):
-                itemindex = np.where((inst_phase >= bins[bin_counter]) & (
-                    inst_phase < bins[bin_counter + 1]))
-                amps_in_bin = inst_amp[itemindex[0]]
-                mean_amps_in_bin = np.mean(amps_in_bin)
-                means_amps_in_bin.append(mean_amps_in_bin)
-            means_amps_in_bin = np.array(means_amps_in_bin)
-            means_amps_in_bin = means_amps_in_bin / np.sum(means_amps_in_bin)
-            MI = np.sum(rel_entr(means_amps_in_bin, uniform_dist))
-            MI_mat[phase_counter, amp_counter] = MI / nbins
+    segment, fs, freqs_phase, freqs_amp, method, nbins, window_starts, window_length = args
+    MI_mat = np.zeros((len(window_starts), len(freqs_phase), len(freqs_amp)))
+    if method == 'mi':
+        inst_phase, inst_amp = phase_amp_filter_bank(segment, freqs_phase, freqs_amp, fs)
+    for window_counter, window_start in enumerate(window_starts):
+        window = slice(window_start, window_start + window_length)
+        if method == 'mi':
+            MI_mat[window_counter] = mi_from_phase_amp(inst_phase[:, window], inst_amp[:, window], nbins)
+        else:
+            MI_mat[window_counter] = calc_tf_mvl(segment[window], fs, freqs_phase, freqs_amp)
     return MI_mat
 
 
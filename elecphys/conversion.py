@@ -1,15 +1,23 @@
 import os
 import numpy as np
-import mat73
 import preprocessing
+import data_io
+import cache
+import rhd
 import utils
+import profiling
 import shutil
+import tempfile
 from tqdm import tqdm
+mat73 = utils.lazy_import('mat73')
 
+# maximum number of samples per channel decoded at once when streaming RHD files
+DEFAULT_CHUNK_SIZE = 2**17
 
-def convert_rhd_to_mat(
-        folder_path: str, output_mat_file: str, ds_factor: int) -> None:
-    """ Function that Converts RHD files to mat files using RHD to MAT converter written in MATLAB
+
+def convert_rhd_to_mat(folder_path: str, output_mat_file: str, ds_factor: int, use_matlab: bool = False,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE, n_jobs: int = 1) -> None:
+    """ Function that Converts RHD files to mat files
 
         Parameters
         ----------
@@ -19,25 +27,351 @@ def convert_rhd_to_mat(
             path to output mat file
         ds_factor: int
             downsample factor
+        use_matlab: bool
+            if True, the RHD to MAT converter written in MATLAB is used (needs MATLAB installed). Otherwise, RHD files are decoded with the native Python reader. Default is False
+        chunk_size: int
+            maximum number of samples per channel that are decoded and kept in memory at once by the native Python reader
+        n_jobs: int
+            number of RHD files decoded in parallel by the native Python reader (one file per worker process). If None, 0 or negative, all CPU cores are used
 
         Returns
         ----------
     """
     output_mat_file_folder = os.path.dirname(output_mat_file)
-    if not os.path.exists(output_mat_file_folder):
+    if output_mat_file_folder != '' and not os.path.exists(output_mat_file_folder):
         os.makedirs(output_mat_file_folder)
     elif os.path.exists(output_mat_file):
         Warning(f'{output_mat_file} already exists. File will be overwritten.')
-    # if os is unix, check if MATLAB is installed
-    Warning('This functionality needs MATLAB to be installed on your computer. If you do not have MATLAB installed, please install it first.')
-    eng = utils.get_matlab_engine()
-    eng.addpath(os.path.join(os.path.dirname(__file__), 'matlab_scripts'))
-    eng.convertRHD2Mat(folder_path, output_mat_file, ds_factor, nargout=0)
-    eng.quit()
+
+    if use_matlab:
+        # if os is unix, check if MATLAB is installed
+        Warning('This functionality needs MATLAB to be installed on your computer. If you do not have MATLAB installed, please install it first.')
+        eng = utils.get_matlab_engine()
+        eng.addpath(os.path.join(os.path.dirname(__file__), 'matlab_scripts'))
+        eng.convertRHD2Mat(folder_path, output_mat_file, ds_factor, nargout=0)
+        eng.quit()
+        return
+
+    if not output_mat_file.endswith('.mat'):
+        output_mat_file = f'{output_mat_file}.mat'
+    rhd_files, num_channels, num_samples, fs = rhd_folder_info(folder_path, ds_factor)
+    manifest = cache.get_file_manifest(output_mat_file)
+    provenance = manifest.provenance('convert_rhd_to_mat', rhd_files, [ds_factor])
+    if manifest.is_up_to_date(output_mat_file, provenance):
+        print(f'{output_mat_file} is up to date.')
+        return
+    with data_io.MatStreamWriter(output_mat_file, num_channels, num_samples, fs) as writer:
+        # MAT files are always saved in float64
+        for chunk in iter_rhd_folder_chunks(rhd_files, ds_factor, chunk_size=chunk_size, n_jobs=n_jobs,
+                                            temp_folder=output_mat_file_folder or None, dtype=np.float64):
+            writer.write(chunk)
+    manifest.record([output_mat_file], provenance)
+
+
+def convert_rhd_to_npz(folder_path: str, output_npz_folder: str, ds_factor: int = 1, notch_filter_freq: int = 0,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE, n_jobs: int = 1, output_format: str = 'npz') -> None:
+    """ Function that Converts RHD files to NPZ files (one file per amplifier channel). The recording is decoded, downsampled, notch filtered and written chunk by chunk, so memory usage does not grow with the recording length
+
+        Parameters
+        ----------
+        folder_path: str
+            path to folder containing RHD files
+        output_npz_folder: str
+            path to output npz folder
+        ds_factor: int
+            downsample factor
+        notch_filter_freq: int
+            notch filter frequency in Hz. It should be 0 (no filtering), 50 (Hz), or 60 (Hz). The notch filter is applied causally (single pass) so that it can run chunk by chunk
+        chunk_size: int
+            maximum number of samples per channel that are decoded and kept in memory at once
+        n_jobs: int
+            number of RHD files decoded in parallel (one file per worker process). If None, 0 or negative, all CPU cores are used
+        output_format: str
+            'npz' (default) to write one NPZ file per channel, or 'npy' to write a single memory-mappable NPY store (see data_io.create_npy_store())
+
+        Returns
+        ----------
+    """
+    if notch_filter_freq != 0 and notch_filter_freq != 50 and notch_filter_freq != 60:
+        raise ValueError(
+            'Notch filter frequency must be 0 (no filtering), 50 (Hz), or 60 (Hz)')
+    check_output_format(output_format)
+
+    rhd_files, num_channels, num_samples, fs = rhd_folder_info(folder_path, ds_factor)
+    if not os.path.exists(output_npz_folder):
+        os.makedirs(output_npz_folder)
+    manifest = cache.get_manifest(output_npz_folder)
+    provenance = manifest.provenance('convert_rhd_to_npz', rhd_files, [ds_factor, notch_filter_freq, output_format])
+    if manifest.is_folder_up_to_date(provenance):
+        print(f'NPZ files in {output_npz_folder} are up to date.')
+        return
+    if output_format == 'npy':
+        writer_class = data_io.NpyStoreStreamWriter
+    else:
+        writer_class = data_io.NpzStreamWriter
+    with writer_class(output_npz_folder, num_channels, num_samples, fs, utils.get_dtype()) as writer:
+        for chunk in iter_rhd_folder_chunks(rhd_files, ds_factor, notch_filter_freq, chunk_size, n_jobs,
+                                            temp_folder=output_npz_folder):
+            writer.write(chunk)
+    manifest.record(output_files(output_npz_folder, num_channels, output_format), provenance)
+
+
+def rhd_folder_info(folder_path: str, ds_factor: int = 1) -> [list, int, int, float]:
+    """ Function that Reads the headers of all RHD files in a folder and computes the size of the converted recording
+
+        Parameters
+        ----------
+        folder_path: str
+            path to folder containing RHD files
+        ds_factor: int
+            downsample factor
+
+        Returns
+        ----------
+        rhd_files: list
+            list of paths to RHD files, in timestamp order
+        num_channels: int
+            number of amplifier channels
+        num_samples: int
+            number of samples per channel after downsampling and concatenating all files
+        fs: float
+            sampling frequency after downsampling (Hz)
+    """
+    ds_factor = int(ds_factor)
+    if ds_factor < 1:
+        raise ValueError(f'Downsample factor must be a positive integer, but it is {ds_factor}')
+    rhd_files, headers = rhd.read_rhd_folder_info(folder_path)
+    rhd.check_timestamps_continuity(rhd_files, headers)
+    sample_rate = headers[0]['sample_rate']
+    if sample_rate % ds_factor != 0:
+        raise ValueError('sample_rate/ds_factor must be an integer')
+    num_channels = len(headers[0]['amplifier_channels'])
+    # each file is downsampled separately, keeping its first sample
+    num_samples = sum(-(-header['num_data_blocks'] * header['num_samples_per_data_block'] // ds_factor)
+                      for header in headers)
+    return rhd_files, num_channels, num_samples, sample_rate / ds_factor
+
+
+def iter_rhd_folder_chunks(rhd_files: list, ds_factor: int = 1, notch_filter_freq: int = 0,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE, n_jobs: int = 1, temp_folder: str = None,
+                           dtype: np.dtype = None) -> np.ndarray:
+    """ Function that Decodes RHD files chunk by chunk, downsampling each file the same way convertRHD2Mat.m does and optionally notch filtering the result with a filter state carried over between chunks
+
+        Parameters
+        ----------
+        rhd_files: list
+            list of paths to RHD files, in the order they should be concatenated
+        ds_factor: int
+            downsample factor. Each file is downsampled separately by keeping every ds_factor-th sample
+        notch_filter_freq: int
+            notch filter frequency in Hz. If 0, no notch filter is applied
+        chunk_size: int
+            maximum number of samples per channel (before downsampling) in each chunk
+        n_jobs: int
+            number of files decoded in parallel, one file per worker process. If larger than 1, every file is decoded into a temporary NPY file, which is read back in order as soon as it is ready and then removed. If None, 0 or negative, all CPU cores are used
+        temp_folder: str
+            folder of the temporary files used when n_jobs is larger than 1. If None, the system temporary folder is used
+        dtype: np.dtype
+            floating point type of the temporary files, i.e. the type the chunks are saved in. If None, utils.get_dtype() is used
+
+        Returns
+        ----------
+        generator of chunk: np.ndarray
+            amplifier data in microvolts. Shape: (num_channels, num_chunk_samples)
+    """
+    ds_factor = int(ds_factor)
+    notch_filter = None
+    if notch_filter_freq != 0:
+        header, _ = rhd.open_rhd_file(rhd_files[0])
+        notch_filter = preprocessing.StreamingNotchFilter(header['sample_rate'] / ds_factor, notch_filter_freq, Q=60)
+
+    if utils.get_n_jobs(n_jobs) == 1 or len(rhd_files) == 1:
+        chunks = _iter_rhd_files_serial(rhd_files, ds_factor, chunk_size)
+    else:
+        chunks = _iter_rhd_files_parallel(rhd_files, ds_factor, chunk_size, n_jobs, temp_folder,
+                                          utils.get_dtype() if dtype is None else dtype)
+    for chunk in chunks:
+        if notch_filter is not None:
+            chunk = notch_filter.filter(chunk)
+        yield chunk
+
+
+def _iter_downsampled_rhd_file(rhd_file: str, ds_factor: int, chunk_size: int) -> [np.ndarray, np.ndarray]:
+    """ Function that Decodes one RHD file chunk by chunk and downsamples it, keeping its first sample
+
+        Parameters
+        ----------
+        rhd_file: str
+            path to RHD file
+        ds_factor: int
+            downsample factor
+        chunk_size: int
+            maximum number of samples per channel (before downsampling) in each chunk
+
+        Returns
+        ----------
+        generator of (chunk, timestamps):
+            chunk: np.ndarray
+                downsampled amplifier data in microvolts. Shape: (num_channels, num_chunk_samples)
+            timestamps: np.ndarray
+                amplifier timestamps of the chunk before downsampling (samples)
+    """
+    file_position = 0
+    for amplifier_data, timestamps in rhd.iter_rhd_chunks(rhd_file, chunk_size):
+        chunk = amplifier_data[:, (-file_position) % ds_factor::ds_factor]
+        file_position += amplifier_data.shape[1]
+        yield chunk, timestamps
+
+
+def _warn_timestamp_gaps(rhd_file: str, num_gaps: int) -> None:
+    """ Function that Prints a warning if gaps were found in the timestamps of an RHD file
+
+        Parameters
+        ----------
+        rhd_file: str
+            path to RHD file
+        num_gaps: int
+            number of gaps found in the amplifier timestamps of the file
+
+        Returns
+        ----------
+    """
+    if num_gaps > 0:
+        print(f'Warning: {num_gaps} gaps in timestamp data found in {os.path.basename(rhd_file)}. Time scale will not be uniform!')
+
+
+def _iter_rhd_files_serial(rhd_files: list, ds_factor: int, chunk_size: int) -> np.ndarray:
+    """ Function that Decodes RHD files one after another, chunk by chunk
+
+        Parameters
+        ----------
+        rhd_files: list
+            list of paths to RHD files, in the order they should be concatenated
+        ds_factor: int
+            downsample factor
+        chunk_size: int
+            maximum number of samples per channel (before downsampling) in each chunk
+
+        Returns
+        ----------
+        generator of chunk: np.ndarray
+            downsampled amplifier data in microvolts. Shape: (num_channels, num_chunk_samples)
+    """
+    for rhd_file in tqdm(rhd_files):
+        num_gaps = 0
+        previous_timestamp = None
+        for chunk, timestamps in _iter_downsampled_rhd_file(rhd_file, ds_factor, chunk_size):
+            num_gaps += rhd.count_timestamp_gaps(timestamps, previous_timestamp)
+            previous_timestamp = timestamps[-1]
+            yield chunk
+        _warn_timestamp_gaps(rhd_file, num_gaps)
+
+
+def _decode_rhd_file_to_npy(args: tuple) -> int:
+    """ Function that Decodes and downsamples one RHD file into its own temporary NPY file. It runs in a worker process
+
+        Parameters
+        ----------
+        args: tuple
+            (rhd_file, npy_file, shape, ds_factor, chunk_size, dtype), where npy_file is the path of the .npy file to create, of shape (num_channels, num_samples) and type dtype
+
+        Returns
+        ----------
+        num_gaps: int
+            number of gaps found in the amplifier timestamps of the file
+    """
+    rhd_file, npy_file, shape, ds_factor, chunk_size, dtype = args
+    data = np.lib.format.open_memmap(npy_file, mode='w+', dtype=dtype, shape=shape)
+    num_gaps = 0
+    previous_timestamp = None
+    sample_indx = 0
+    for chunk, timestamps in _iter_downsampled_rhd_file(rhd_file, ds_factor, chunk_size):
+        num_gaps += rhd.count_timestamp_gaps(timestamps, previous_timestamp)
+        previous_timestamp = timestamps[-1]
+        data[:, sample_indx:sample_indx + chunk.shape[1]] = chunk
+        sample_indx += chunk.shape[1]
+    data.flush()
+    del data
+    return num_gaps
+
+
+def _iter_rhd_files_parallel(rhd_files: list, ds_factor: int, chunk_size: int,
+                             n_jobs: int, temp_folder: str = None, dtype: np.dtype = np.float64) -> np.ndarray:
+    """ Function that Decodes RHD files in a process pool, each file into its own temporary NPY file, and reads every file back chunk by chunk as soon as it is decoded, in file order. A temporary file is removed once it is read, so at most about 2 * n_jobs decoded files are on disk at once
+
+        Parameters
+        ----------
+        rhd_files: list
+            list of paths to RHD files, in the order they should be concatenated
+        ds_factor: int
+            downsample factor
+        chunk_size: int
+            maximum number of samples per channel in each chunk
+        n_jobs: int
+            number of worker processes
+        temp_folder: str
+            folder of the temporary files. If None, the system temporary folder is used
+        dtype: np.dtype
+            floating point type of the temporary files
+
+        Returns
+        ----------
+        generator of chunk: np.ndarray
+            downsampled amplifier data in microvolts. Shape: (num_channels, num_chunk_samples)
+    """
+    headers = [rhd.open_rhd_file(rhd_file)[0] for rhd_file in rhd_files]
+    num_samples_files = [-(-header['num_data_blocks'] * header['num_samples_per_data_block'] // ds_factor)
+                         for header in headers]
+    num_channels = len(headers[0]['amplifier_channels'])
+    temp_dir = tempfile.mkdtemp(dir=temp_folder)
+    npy_files = [os.path.join(temp_dir, f'{file_indx}.npy') for file_indx in range(len(rhd_files))]
+    args_list = [(rhd_file, npy_file, (num_channels, num_samples), ds_factor, chunk_size, np.dtype(dtype).name)
+                 for rhd_file, npy_file, num_samples in zip(rhd_files, npy_files, num_samples_files)]
+    results = utils.parallel_imap(_decode_rhd_file_to_npy, args_list, n_jobs)
+    try:
+        for rhd_file, npy_file, num_gaps in zip(rhd_files, npy_files, tqdm(results, total=len(args_list))):
+            _warn_timestamp_gaps(rhd_file, num_gaps)
+            data = np.load(npy_file, mmap_mode='r')
+            for sample_indx in range(0, data.shape[1], chunk_size):
+                yield np.array(data[:, sample_indx:sample_indx + chunk_size])
+            # the memory map must be released before the file can be removed on Windows
+            data = None
+            os.remove(npy_file)
+    finally:
+        # waits for the files being decoded before removing them
+        results.close()
+        data = None
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def load_rhd_folder(folder_path: str, ds_factor: int = 1) -> [np.ndarray, float]:
+    """ Function that Loads and downsamples the amplifier data of all RHD files in a folder, the same way convertRHD2Mat.m does
+
+        Parameters
+        ----------
+        folder_path: str
+            path to folder containing RHD files
+        ds_factor: int
+            downsample factor. Each file is downsampled separately by keeping every ds_factor-th sample
+
+        Returns
+        ----------
+        data: np.ndarray
+            amplifier data of all files concatenated in time, in microvolts. Shape: (num_channels, num_samples)
+        fs: float
+            sampling frequency after downsampling (Hz)
+    """
+    rhd_files, num_channels, num_samples, fs = rhd_folder_info(folder_path, ds_factor)
+    data = np.zeros((num_channels, num_samples))
+    sample_indx = 0
+    for chunk in iter_rhd_folder_chunks(rhd_files, ds_factor):
+        data[:, sample_indx:sample_indx + chunk.shape[1]] = chunk
+        sample_indx += chunk.shape[1]
+    return data, fs
 
 
 def convert_mat_to_npz(mat_file: str, output_npz_folder: str,
-                       notch_filter_freq: int) -> None:
+                       notch_filter_freq: int, output_format: str = 'npz') -> None:
     """ Function that  Converts MAT files to NPZ files
 
         Parameters
@@ -46,35 +380,85 @@ def convert_mat_to_npz(mat_file: str, output_npz_folder: str,
             path to mat file
         output_npz_folder: str
             path to output npz folder
+        notch_filter_freq: int
+            notch filter frequency in Hz. It should be 0 (no filtering), 50 (Hz), or 60 (Hz)
+        output_format: str
+            'npz' (default) to write one NPZ file per channel, or 'npy' to write a single memory-mappable NPY store (see data_io.create_npy_store())
 
         Returns
         ----------
     """
+    check_output_format(output_format)
 
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
+    data_io.make_output_folder(output_npz_folder, allow_memory=output_format == 'npz')
 
     if notch_filter_freq != 0 and notch_filter_freq != 50 and notch_filter_freq != 60:
         raise ValueError(
             'Notch filter frequency must be 0 (no filtering), 50 (Hz), or 60 (Hz)')
 
-    mat_file_contents = mat73.loadmat(mat_file)
-    data = mat_file_contents['data']
-    fs = mat_file_contents['fs']
-
-    for ch_num in tqdm(range(data.shape[0])):
-        ch_name = f'Ch{ch_num+1}'
-        if notch_filter_freq == 0:
-            data_filtered = data[ch_num, :]
-        else:
-            data_filtered = preprocessing.apply_notch(
-                data[ch_num, :], {'Q': 60, 'fs': fs, 'f0': notch_filter_freq})
-
-        np.savez(
-            os.path.join(
-                output_npz_folder,
-                f'{ch_name}.npz'),
-            data=data_filtered,
-            fs=fs)
+    manifest = cache.get_manifest(output_npz_folder)
+    if manifest is not None:
+        provenance = manifest.provenance('convert_mat_to_npz', [mat_file], [notch_filter_freq, output_format])
+        if manifest.is_folder_up_to_date(provenance):
+            print(f'NPZ files in {output_npz_folder} are up to date.')
+            return
+
+    with profiling.io_time():
+        mat_file_contents = mat73.loadmat(mat_file)
+        data = mat_file_contents['data']
+        fs = mat_file_contents['fs']
+        profiling.count_read(data)
+
+    if notch_filter_freq != 0:
+        # all channels are filtered at once
+        data = preprocessing.apply_notch(
+            data, {'Q': 60, 'fs': fs, 'f0': notch_filter_freq})
+
+    data = data_io.as_signal_dtype(data)
+    if output_format == 'npy':
+        data_io.write_npy_store(data, fs, output_npz_folder)
+    else:
+        for ch_num in tqdm(range(data.shape[0])):
+            ch_name = f'Ch{ch_num+1}'
+            data_io.save_channel(output_npz_folder, f'{ch_name}.npz', data[ch_num, :], fs)
+    if manifest is not None:
+        manifest.record(output_files(output_npz_folder, data.shape[0], output_format), provenance)
+
+
+def output_files(output_npz_folder: str, num_channels: int, output_format: str) -> list:
+    """ Function that Lists the files written by the conversion functions
+
+        Parameters
+        ----------
+        output_npz_folder: str
+            path to output npz folder
+        num_channels: int
+            number of channels
+        output_format: str
+            'npz' (one NPZ file per channel) or 'npy' (single NPY store)
+
+        Returns
+        ----------
+        output_files: list
+            paths to the output files
+    """
+    if output_format == 'npy':
+        return [os.path.join(output_npz_folder, data_io.NPY_STORE_DATA_FILE),
+                os.path.join(output_npz_folder, data_io.NPY_STORE_INFO_FILE)]
+    return [os.path.join(output_npz_folder, f'Ch{ch_indx+1}.npz') for ch_indx in range(num_channels)]
+
+
+def check_output_format(output_format: str) -> None:
+    """ Function that Checks the output format of the conversion functions
+
+        Parameters
+        ----------
+        output_format: str
+            'npz' (one NPZ file per channel) or 'npy' (single NPY store)
+
+        Returns
+        ----------
+    """
+    if output_format not in ['npz', 'npy']:
+        raise ValueError(
+            'Output format must be either "npz" (one NPZ file per channel) or "npy" (single NPY store)')
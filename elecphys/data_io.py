@@ -1,7 +1,14 @@
-import mat73
+import json
 import numpy as np
 import os
+import struct
+import time
+import zipfile
 import utils
+import profiling
+# only needed to read and write MAT files
+mat73 = utils.lazy_import('mat73')
+h5py = utils.lazy_import('h5py')
 
 
 def load_mat(mat_file) -> [np.ndarray, int]:
@@ -19,12 +26,58 @@ def load_mat(mat_file) -> [np.ndarray, int]:
         fs: int
             sampling frequency (Hz)
     """
-    with mat73.loadmat(mat_file) as mat_file_contents:
-        data = mat_file_contents['data']
-        fs = mat_file_contents['fs']
+    with profiling.io_time():
+        with mat73.loadmat(mat_file) as mat_file_contents:
+            data = mat_file_contents['data']
+            fs = mat_file_contents['fs']
+        profiling.count_read(data)
     return data, fs
 
 
+def write_mat(mat_file: str, data: np.ndarray, fs: float) -> None:
+    """ Function that Writes data to a MATLAB v7.3 MAT file, with the same layout as the one saved by convertRHD2Mat.m
+
+        Parameters
+        ----------
+        mat_file: str
+            path to output mat file
+        data: numpy.ndarray
+            data to be written to MAT file. Shape: (num_channels, num_samples)
+        fs: float
+            sampling frequency (Hz)
+
+        Returns
+        ----------
+    """
+    with profiling.io_time():
+        with h5py.File(mat_file, 'w', userblock_size=512) as mat_file_contents:
+            # MATLAB stores arrays in column-major order, so they are saved transposed
+            dataset = mat_file_contents.create_dataset('data', data=np.asarray(data, dtype=np.float64).T)
+            dataset.attrs['MATLAB_class'] = np.bytes_('double')
+            dataset = mat_file_contents.create_dataset('fs', data=np.array([[fs]], dtype=np.float64))
+            dataset.attrs['MATLAB_class'] = np.bytes_('double')
+        _write_mat_userblock(mat_file)
+        profiling.count_written(data)
+
+
+def _write_mat_userblock(mat_file: str) -> None:
+    """ Function that Writes the MATLAB v7.3 header into the HDF5 user block of a MAT file
+
+        Parameters
+        ----------
+        mat_file: str
+            path to mat file created with a 512 bytes user block
+
+        Returns
+        ----------
+    """
+    created_on = time.strftime('%a %b %d %H:%M:%S %Y')
+    text = f'MATLAB 7.3 MAT-file, Platform: PYTHON, Created on: {created_on} HDF5 schema 1.00 .'
+    mat_header = text.encode('ascii').ljust(116, b' ') + b'\x00' * 8 + b'\x00\x02' + b'IM'
+    with open(mat_file, 'r+b') as f:
+        f.write(mat_header)
+
+
 def load_npz(npz_file) -> [np.ndarray, int]:
     """ Function that Loads NPZ file
 
@@ -37,39 +90,147 @@ def load_npz(npz_file) -> [np.ndarray, int]:
         data: data from NPZ file - type: numpy.ndarray
         fs: sampling frequency - type: float
     """
-    with np.load(npz_file) as npz_file_contents:
-        data = npz_file_contents['data']
-        fs = npz_file_contents['fs']
+    with profiling.io_time():
+        with np.load(npz_file) as npz_file_contents:
+            data = npz_file_contents['data']
+            fs = npz_file_contents['fs']
+        profiling.count_read(data)
     return data, fs
 
 
+def open_npz_data(npz_file) -> [np.ndarray, int]:
+    """ Function that Opens the data of an NPZ file without reading it. If the NPZ file is not compressed (np.savez, NpzStreamWriter), the data is memory-mapped, so that slicing it only reads the requested samples from disk. Otherwise the data is loaded
+
+        Parameters
+        ----------
+        npz_file: str
+            path to npz file
+
+        Returns
+        ----------
+        data: numpy.ndarray
+            data from NPZ file (read-only memory-mapped array if possible). The NPZ file must not be overwritten while the data is in use
+        fs: int
+            sampling frequency (Hz)
+    """
+    with zipfile.ZipFile(npz_file) as zip_file:
+        with zip_file.open('fs.npy') as fs_file:
+            fs = np.lib.format.read_array(fs_file)
+        data_info = zip_file.getinfo('data.npy')
+    if data_info.compress_type != zipfile.ZIP_STORED:
+        data, _ = load_npz(npz_file)
+        return data, fs
+    with open(npz_file, 'rb') as f:
+        f.seek(data_info.header_offset)
+        local_header = f.read(30)
+        if local_header[:4] != b'PK\x03\x04':
+            raise ValueError(f'{npz_file} is not a valid NPZ file')
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        f.seek(data_info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if fortran_order or dtype.hasobject or np.prod(shape) == 0:
+        data, _ = load_npz(npz_file)
+        return data, fs
+    data = np.memmap(npz_file, dtype=dtype, mode='r', shape=shape, offset=offset)
+    return data, fs
+
+
+def time_to_sample_range(fs: float, num_samples: int, t_min: float = None, t_max: float = None) -> [int, int]:
+    """ Function that Converts a time interval to a range of samples. Sample i is at time i / fs, and the samples in [t_min, t_max] are selected
+
+        Parameters
+        ----------
+        fs: float
+            sampling frequency (Hz)
+        num_samples: int
+            number of samples of the signal
+        t_min: float
+            start of the time interval in seconds. If None, the interval starts at the beginning of the signal
+        t_max: float
+            end of the time interval in seconds (included). If None, the interval ends at the end of the signal
+
+        Returns
+        ----------
+        start_sample: int
+            index of the first sample
+        stop_sample: int
+            index after the last sample
+    """
+    start_sample = 0 if t_min is None else int(np.ceil(t_min * fs))
+    stop_sample = num_samples if t_max is None else int(np.floor(t_max * fs)) + 1
+    start_sample = min(max(start_sample, 0), num_samples)
+    stop_sample = min(max(stop_sample, start_sample), num_samples)
+    return start_sample, stop_sample
+
+
+def get_npz_folder_info(npz_folder: str) -> [int, int, int]:
+    """ Function that Gets the number of channels, the number of samples and the sampling frequency of a folder of NPZ files or of an NPY store, without reading the data
+
+        Parameters
+        ----------
+        npz_folder: str
+            path to npz folder or NPY store folder
+
+        Returns
+        ----------
+        num_channels: int
+            number of channels
+        num_samples: int
+            number of samples per channel
+        fs: int
+            sampling frequency (Hz)
+    """
+    npz_files = list_channel_files(npz_folder)
+    if len(npz_files) == 0:
+        raise ValueError(f'No NPZ files found in {npz_folder}')
+    data, fs = open_channel(npz_folder, npz_files[0])
+    return len(npz_files), len(data), fs
+
+
 def load_all_npz_files(npz_folder: str, ignore_channels: [
-                       list, str] = None, channels_list: [list, str] = None) -> [np.ndarray, int, list]:
-    """ Function that Loads all NPZ files in a folder
+                       list, str] = None, channels_list: [list, str] = None, t_min: float = None, t_max: float = None,
+                       start_sample: int = None, stop_sample: int = None) -> [np.ndarray, int, list]:
+    """ Function that Loads all NPZ files in a folder, or the channels of an NPY store (see create_npy_store())
 
         Parameters
         ----------
         npz_folder: str
-            path to npz folder containing NPZ files
+            path to npz folder containing NPZ files, or to an NPY store folder
         ignore_channels: list, str
             list of channels to be ignored and not loaded. If None, all channels will be loaded. Either a list of channel names or a string of channel names separated by commas.
         channels_list: list, str
             list of channels to be loaded. If None, all channels will be loaded. Either a list of channel names or a string of channel names separated by commas.
+        t_min: float
+            start of the time interval to be loaded in seconds. If None, the data is loaded from the beginning. Ignored if start_sample is given
+        t_max: float
+            end of the time interval to be loaded in seconds. If None, the data is loaded until the end. Ignored if stop_sample is given
+        start_sample: int
+            index of the first sample to be loaded. If None, it is computed from t_min
+        stop_sample: int
+            index after the last sample to be loaded. If None, it is computed from t_max
 
         Returns
         --------
         data_all: np.ndarray
-            data from all NPZ files. Shape: (num_channels, num_samples)
+            data from all NPZ files, in the floating point type of utils.get_dtype(). Shape: (num_channels, num_samples). For an NPY store of that type and a contiguous range of channels, this is a copy-on-write memory-mapped view of the store
         fs: int
             sampling frequency (Hz)
         channels_map: list
             list of channel indices corresponding to the order of channels in data_all
     """
-    files_list = os.listdir(npz_folder)
-    for file_name in files_list:
-        if not file_name.endswith('.npz'):
-            files_list.remove(file_name)
-    files_list = utils.sort_file_names(files_list)
+    data_store = None
+    if is_memory_folder(npz_folder):
+        files_list = list_channel_files(npz_folder)
+    elif is_npy_store(npz_folder):
+        data_store, fs, channel_names = open_npy_store(npz_folder, mode='c')
+        files_list = [f'{channel_name}.npz' for channel_name in channel_names]
+    else:
+        files_list = utils.sort_file_names(os.listdir(npz_folder))
     all_channels_in_folder = list(range(0, len(files_list)))
     channels_list = utils.convert_string_to_list(channels_list)
     if channels_list is None:
@@ -91,6 +252,13 @@ def load_all_npz_files(npz_folder: str, ignore_channels: [
             channels_map_new.append(channel)
     channels_map = channels_map_new
 
+    if data_store is not None:
+        start_sample, stop_sample = _sample_range(fs, data_store.shape[1], t_min, t_max, start_sample, stop_sample)
+        with profiling.io_time():
+            data_all = as_signal_dtype(_select_store_channels(data_store, channels_map)[:, start_sample:stop_sample])
+            profiling.count_read(data_all)
+        return data_all, fs, channels_map
+
     files_list_new = []
     for indx, file_name in enumerate(files_list):
         if indx not in ignore_channels:
@@ -99,18 +267,76 @@ def load_all_npz_files(npz_folder: str, ignore_channels: [
 
     num_channels = len(files_list)
     ch_indx = 0
-    for npz_file in files_list:
-        npz_file_path = os.path.join(npz_folder, npz_file)
-        if ch_indx == 0:
-            data, fs = load_npz(npz_file_path)
-            data_all = np.zeros((num_channels, len(data)))
-        else:
-            data, _ = load_npz(npz_file_path)
-        data_all[ch_indx, :] = data
-        ch_indx += 1
+    with profiling.io_time():
+        for npz_file in files_list:
+            # only the selected samples are read from disk
+            data, fs = open_channel(npz_folder, npz_file)
+            if ch_indx == 0:
+                start_sample, stop_sample = _sample_range(fs, len(data), t_min, t_max, start_sample, stop_sample)
+                data_all = np.zeros((num_channels, stop_sample - start_sample), dtype=utils.get_dtype())
+            data_all[ch_indx, :] = data[start_sample:stop_sample]
+            del data
+            ch_indx += 1
+        profiling.count_read(data_all)
     return data_all, fs, channels_map
 
 
+def _sample_range(fs: float, num_samples: int, t_min: float, t_max: float,
+                  start_sample: int, stop_sample: int) -> [int, int]:
+    """ Function that Gets the range of samples to be loaded by load_all_npz_files(), from either a time interval or sample indices
+
+        Parameters
+        ----------
+        fs: float
+            sampling frequency (Hz)
+        num_samples: int
+            number of samples per channel
+        t_min: float
+            start of the time interval in seconds, used if start_sample is None
+        t_max: float
+            end of the time interval in seconds, used if stop_sample is None
+        start_sample: int
+            index of the first sample
+        stop_sample: int
+            index after the last sample
+
+        Returns
+        ----------
+        start_sample: int
+            index of the first sample
+        stop_sample: int
+            index after the last sample
+    """
+    start_from_time, stop_from_time = time_to_sample_range(fs, num_samples, t_min, t_max)
+    if start_sample is None:
+        start_sample = start_from_time
+    if stop_sample is None:
+        stop_sample = stop_from_time
+    if not 0 <= start_sample <= stop_sample <= num_samples:
+        raise ValueError(f'Invalid sample range [{start_sample}, {stop_sample}) for {num_samples} samples')
+    return int(start_sample), int(stop_sample)
+
+
+def _select_store_channels(data_store: np.memmap, channels_map: list) -> np.ndarray:
+    """ Function that Selects channels of a memory-mapped NPY store. A contiguous range of channels is returned as a memory-mapped view (nothing is read until it is used), other selections only read the selected channels
+
+        Parameters
+        ----------
+        data_store: np.memmap
+            memory-mapped data. Shape: (num_channels, num_samples)
+        channels_map: list
+            list of channel indices to select
+
+        Returns
+        ----------
+        data: np.ndarray
+            selected channels. Shape: (len(channels_map), num_samples)
+    """
+    if len(channels_map) > 0 and list(channels_map) == list(range(channels_map[0], channels_map[-1] + 1)):
+        return data_store[channels_map[0]:channels_map[-1] + 1]
+    return np.asarray(data_store[channels_map])
+
+
 def load_npz_stft(npz_file) -> [np.ndarray, np.ndarray, np.ndarray]:
     """ Function that Loads NPZ file
 
@@ -124,10 +350,12 @@ def load_npz_stft(npz_file) -> [np.ndarray, np.ndarray, np.ndarray]:
         t: time array - type: numpy.ndarray
         Zxx: STFT array - type: numpy.ndarray
     """
-    with np.load(npz_file) as npz_file_contents:
-        f = npz_file_contents['f']
-        t = npz_file_contents['t']
-        Zxx = npz_file_contents['Zxx']
+    with profiling.io_time():
+        with np.load(npz_file) as npz_file_contents:
+            f = npz_file_contents['f']
+            t = npz_file_contents['t']
+            Zxx = npz_file_contents['Zxx']
+        profiling.count_read(Zxx)
     return f, t, Zxx
 
 
@@ -144,9 +372,11 @@ def load_npz_dft(npz_file) -> [np.ndarray, np.ndarray]:
         Zxx: DFT array - type: numpy.ndarray
     """
 
-    with np.load(npz_file) as npz_file_contents:
-        f = npz_file_contents['f']
-        Zxx = npz_file_contents['Zxx']
+    with profiling.io_time():
+        with np.load(npz_file) as npz_file_contents:
+            f = npz_file_contents['f']
+            Zxx = npz_file_contents['Zxx']
+        profiling.count_read(Zxx)
     return f, Zxx
 
 
@@ -164,14 +394,39 @@ def load_npz_mvl(npz_file) -> [np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         freqs_phase: phase frequencies - type: numpy.ndarray
         time_interval: time interval - type: numpy.ndarray
     """
-    with np.load(npz_file) as npz_file_contents:
-        MI_mat = npz_file_contents['MI_mat']
-        freqs_amp = npz_file_contents['freqs_amp']
-        freqs_phase = npz_file_contents['freqs_phase']
-        time_interval = npz_file_contents['time_interval']
+    with profiling.io_time():
+        with np.load(npz_file) as npz_file_contents:
+            MI_mat = npz_file_contents['MI_mat']
+            freqs_amp = npz_file_contents['freqs_amp']
+            freqs_phase = npz_file_contents['freqs_phase']
+            time_interval = npz_file_contents['time_interval']
+        profiling.count_read(MI_mat)
     return MI_mat, freqs_amp, freqs_phase, time_interval
 
 
+def write_npz_from_npy_files(npz_file: str, npy_files: dict, **arrays) -> None:
+    """ Function that Writes an uncompressed NPZ file (same layout as np.savez()) in which some arrays are copied from .npy files chunk by chunk, without loading them in memory
+
+        Parameters
+        ----------
+        npz_file: str
+            path to output npz file
+        npy_files: dict
+            names of the arrays in the NPZ file and paths to the .npy files containing them
+        **arrays: numpy.ndarray
+            other arrays to be saved in the NPZ file
+
+        Returns
+        ----------
+    """
+    with zipfile.ZipFile(npz_file, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+        for name, array in arrays.items():
+            with zip_file.open(f'{name}.npy', 'w', force_zip64=True) as array_file:
+                np.lib.format.write_array(array_file, np.asanyarray(array), allow_pickle=True)
+        for name, npy_file in npy_files.items():
+            zip_file.write(npy_file, f'{name}.npy')
+
+
 def write_separate_npz_files(
         data: np.ndarray, fs: int, output_npz_folder: str) -> None:
     """ Function that Writes data to NPZ file as separate files for each channel
@@ -188,10 +443,652 @@ def write_separate_npz_files(
         Returns
         ----------
     """
-    if not os.path.exists(output_npz_folder):
+    make_output_folder(output_npz_folder)
+    for ch_indx in range(data.shape[0]):
+        save_channel(output_npz_folder, f'Ch{ch_indx+1}.npz', data[ch_indx, :], fs)
+
+
+class NpzStreamWriter:
+    """ Writes a multichannel recording chunk by chunk as separate NPZ files for each channel (Ch1.npz, Ch2.npz, ...), without keeping the whole recording in memory. The files can be loaded with load_npz()
+
+        Parameters
+        ----------
+        output_npz_folder: str
+            path to output npz folder
+        num_channels: int
+            number of channels
+        num_samples: int
+            total number of samples per channel that will be written
+        fs: float
+            sampling frequency (Hz)
+        dtype: np.dtype
+            data type of the saved samples. Default is float64
+        file_names: list
+            NPZ file names of the channels. If None, Ch1.npz, Ch2.npz, ...
+
+        Returns
+        ----------
+    """
+
+    def __init__(self, output_npz_folder: str, num_channels: int, num_samples: int,
+                 fs: float, dtype: np.dtype = np.float64, file_names: list = None):
+        if not os.path.exists(output_npz_folder):
+            os.makedirs(output_npz_folder)
+        else:
+            Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
+        self.num_samples = int(num_samples)
+        self.dtype = np.dtype(dtype)
+        self.samples_written = 0
+        self._zip_files = []
+        self._data_files = []
+        if file_names is None:
+            file_names = [f'Ch{ch_indx+1}.npz' for ch_indx in range(num_channels)]
+        for file_name in file_names:
+            zip_file = zipfile.ZipFile(os.path.join(output_npz_folder, file_name),
+                                       mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+            with zip_file.open('fs.npy', 'w') as fs_file:
+                np.lib.format.write_array(fs_file, np.asarray(fs))
+            data_file = zip_file.open('data.npy', 'w', force_zip64=True)
+            np.lib.format.write_array_header_1_0(
+                data_file, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                            'fortran_order': False, 'shape': (self.num_samples,)})
+            self._zip_files.append(zip_file)
+            self._data_files.append(data_file)
+
+    def write(self, chunk: np.ndarray) -> None:
+        """ Appends a chunk of samples to all channels
+
+        Parameters
+            ----------
+            chunk: np.ndarray
+                chunk of samples. Shape: (num_channels, num_chunk_samples)
+
+        Returns
+            ----------
+        """
+        if chunk.shape[0] != len(self._data_files):
+            raise ValueError(f'Chunk has {chunk.shape[0]} channels but {len(self._data_files)} channels are being written')
+        if self.samples_written + chunk.shape[1] > self.num_samples:
+            raise ValueError(f'Cannot write more than {self.num_samples} samples per channel')
+        chunk = np.ascontiguousarray(chunk, dtype=self.dtype)
+        with profiling.io_time():
+            for ch_indx, data_file in enumerate(self._data_files):
+                data_file.write(chunk[ch_indx, :].tobytes())
+            profiling.count_written(chunk)
+        self.samples_written += chunk.shape[1]
+
+    def close(self) -> None:
+        """ Closes all NPZ files
+
+        Parameters
+            ----------
+
+        Returns
+            ----------
+        """
+        with profiling.io_time():
+            for data_file, zip_file in zip(self._data_files, self._zip_files):
+                data_file.close()
+                zip_file.close()
+        self._data_files = []
+        self._zip_files = []
+        if self.samples_written != self.num_samples:
+            raise ValueError(f'Only {self.samples_written} of {self.num_samples} samples per channel were written')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for data_file, zip_file in zip(self._data_files, self._zip_files):
+                data_file.close()
+                zip_file.close()
+
+
+class MatStreamWriter:
+    """ Writes a multichannel recording chunk by chunk to a MATLAB v7.3 MAT file (same layout as write_mat()), without keeping the whole recording in memory
+
+        Parameters
+        ----------
+        mat_file: str
+            path to output mat file
+        num_channels: int
+            number of channels
+        num_samples: int
+            total number of samples per channel that will be written
+        fs: float
+            sampling frequency (Hz)
+
+        Returns
+        ----------
+    """
+
+    def __init__(self, mat_file: str, num_channels: int, num_samples: int, fs: float):
+        self.mat_file = mat_file
+        self.num_samples = int(num_samples)
+        self.samples_written = 0
+        self._mat_file_contents = h5py.File(mat_file, 'w', userblock_size=512)
+        # MATLAB stores arrays in column-major order, so they are saved transposed
+        self._dataset = self._mat_file_contents.create_dataset(
+            'data', shape=(self.num_samples, num_channels), dtype=np.float64)
+        self._dataset.attrs['MATLAB_class'] = np.bytes_('double')
+        dataset = self._mat_file_contents.create_dataset('fs', data=np.array([[fs]], dtype=np.float64))
+        dataset.attrs['MATLAB_class'] = np.bytes_('double')
+
+    def write(self, chunk: np.ndarray) -> None:
+        """ Appends a chunk of samples to all channels
+
+        Parameters
+            ----------
+            chunk: np.ndarray
+                chunk of samples. Shape: (num_channels, num_chunk_samples)
+
+        Returns
+            ----------
+        """
+        if self.samples_written + chunk.shape[1] > self.num_samples:
+            raise ValueError(f'Cannot write more than {self.num_samples} samples per channel')
+        with profiling.io_time():
+            self._dataset[self.samples_written:self.samples_written + chunk.shape[1], :] = chunk.T
+            profiling.count_written(chunk)
+        self.samples_written += chunk.shape[1]
+
+    def close(self) -> None:
+        """ Closes the MAT file and writes its MATLAB header
+
+        Parameters
+            ----------
+
+        Returns
+            ----------
+        """
+        if self._mat_file_contents is None:
+            return
+        self._mat_file_contents.close()
+        self._mat_file_contents = None
+        _write_mat_userblock(self.mat_file)
+        if self.samples_written != self.num_samples:
+            raise ValueError(f'Only {self.samples_written} of {self.num_samples} samples per channel were written')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._mat_file_contents is not None:
+            self._mat_file_contents.close()
+            self._mat_file_contents = None
+
+
+NPY_STORE_DATA_FILE = 'data.npy'
+NPY_STORE_INFO_FILE = 'info.json'
+# folders whose path starts with this prefix are kept in memory instead of being written to disk (see make_output_folder())
+MEMORY_FOLDER_PREFIX = 'mem://'
+# in-memory folders: {'fs': sampling frequency, 'channels': {channel file name: data}}, shared by the elecphys.data_io and
+# data_io module objects
+_memory_folders = utils.shared_state('data_io', '_memory_folders', {})
+
+
+def is_npy_store(folder: str) -> bool:
+    """ Function that Checks whether a folder is an NPY store (data.npy + info.json) instead of a folder of separate NPZ files
+
+        Parameters
+        ----------
+        folder: str
+            path to folder
+
+        Returns
+        ----------
+        is_store: bool
+            True if the folder contains an NPY store
+    """
+    return os.path.isfile(os.path.join(folder, NPY_STORE_DATA_FILE)) and \
+        os.path.isfile(os.path.join(folder, NPY_STORE_INFO_FILE))
+
+
+def create_npy_store(output_folder: str, num_channels: int, num_samples: int, fs: float,
+                     dtype: np.dtype = np.float64, channel_names: list = None) -> np.memmap:
+    """ Function that Creates an empty NPY store: a single contiguous (num_channels, num_samples) .npy file that can be memory-mapped, and a JSON sidecar with the sampling frequency and the channel names
+
+        Parameters
+        ----------
+        output_folder: str
+            path to output folder
+        num_channels: int
+            number of channels
+        num_samples: int
+            number of samples per channel
+        fs: float
+            sampling frequency (Hz)
+        dtype: np.dtype
+            data type of the samples. Default is float64
+        channel_names: list
+            list of channel names. If None, channels are named Ch1, Ch2, ...
+
+        Returns
+        ----------
+        data: np.memmap
+            writable memory-mapped array. Shape: (num_channels, num_samples)
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    else:
+        Warning(f'{output_folder} already exists. Files will be overwritten.')
+    if channel_names is None:
+        channel_names = [f'Ch{ch_indx+1}' for ch_indx in range(num_channels)]
+    if len(channel_names) != num_channels:
+        raise ValueError(f'{len(channel_names)} channel names given for {num_channels} channels')
+    info = {'fs': float(fs), 'channel_names': list(channel_names),
+            'num_channels': int(num_channels), 'num_samples': int(num_samples),
+            'dtype': np.dtype(dtype).str}
+    with open(os.path.join(output_folder, NPY_STORE_INFO_FILE), 'w') as fp:
+        json.dump(info, fp, indent=4)
+    return np.lib.format.open_memmap(os.path.join(output_folder, NPY_STORE_DATA_FILE), mode='w+',
+                                     dtype=dtype, shape=(int(num_channels), int(num_samples)))
+
+
+def write_npy_store(data: np.ndarray, fs: float, output_folder: str, channel_names: list = None) -> None:
+    """ Function that Writes data to an NPY store (see create_npy_store())
+
+        Parameters
+        ----------
+        data: numpy.ndarray
+            data to be written. Shape: (num_channels, num_samples)
+        fs: float
+            sampling frequency (Hz)
+        output_folder: str
+            path to output folder
+        channel_names: list
+            list of channel names. If None, channels are named Ch1, Ch2, ...
+
+        Returns
+        ----------
+    """
+    data_store = create_npy_store(output_folder, data.shape[0], data.shape[1], fs, data.dtype, channel_names)
+    with profiling.io_time():
+        data_store[:] = data
+        data_store.flush()
+        profiling.count_written(data)
+    del data_store
+
+
+def open_npy_store(folder: str, mode: str = 'r') -> [np.memmap, float, list]:
+    """ Function that Opens an NPY store without reading it. Slicing the returned array only reads the requested channels and samples from disk
+
+        Parameters
+        ----------
+        folder: str
+            path to NPY store folder
+        mode: str
+            memory-map mode: 'r' (read-only), 'r+' (read and write) or 'c' (copy-on-write). Default is 'r'
+
+        Returns
+        ----------
+        data: np.memmap
+            memory-mapped data. Shape: (num_channels, num_samples)
+        fs: float
+            sampling frequency (Hz)
+        channel_names: list
+            list of channel names
+    """
+    if not is_npy_store(folder):
+        raise ValueError(f'{folder} is not an NPY store')
+    with open(os.path.join(folder, NPY_STORE_INFO_FILE), 'r') as fp:
+        info = json.load(fp)
+    data = np.load(os.path.join(folder, NPY_STORE_DATA_FILE), mmap_mode=mode)
+    if data.ndim != 2 or data.shape[0] != len(info['channel_names']):
+        raise ValueError(f'{folder} data shape {data.shape} does not match its {NPY_STORE_INFO_FILE}')
+    return data, info['fs'], info['channel_names']
+
+
+def convert_npz_folder_to_npy_store(input_npz_folder: str, output_folder: str) -> None:
+    """ Function that Converts a folder of separate NPZ files (Ch1.npz, Ch2.npz, ...) to an NPY store, one channel at a time
+
+        Parameters
+        ----------
+        input_npz_folder: str
+            path to input npz folder
+        output_folder: str
+            path to output NPY store folder
+
+        Returns
+        ----------
+    """
+    npz_files = utils.sort_file_names(os.listdir(input_npz_folder))
+    if len(npz_files) == 0:
+        raise ValueError(f'No NPZ files found in {input_npz_folder}')
+    data, fs = load_npz(os.path.join(input_npz_folder, npz_files[0]))
+    channel_names = [os.path.splitext(npz_file)[0] for npz_file in npz_files]
+    data_store = create_npy_store(output_folder, len(npz_files), len(data), fs, utils.get_dtype(), channel_names)
+    for ch_indx, npz_file in enumerate(npz_files):
+        data, _ = load_npz(os.path.join(input_npz_folder, npz_file))
+        if len(data) != data_store.shape[1]:
+            raise ValueError(f'{npz_file} has {len(data)} samples but {npz_files[0]} has {data_store.shape[1]} samples')
+        data_store[ch_indx, :] = data
+    data_store.flush()
+    del data_store
+
+
+def list_channel_files(npz_folder: str) -> list:
+    """ Function that Lists the channel files of a folder of separate NPZ files or of an NPY store. For an NPY store, the names are the ones the channels would have as separate NPZ files (e.g. Ch1.npz), so that outputs are named the same way for both formats
+
+        Parameters
+        ----------
+        npz_folder: str
+            path to npz folder or NPY store folder
+
+        Returns
+        ----------
+        npz_files: list
+            sorted list of channel file names, to be passed to load_channel()
+    """
+    if is_memory_folder(npz_folder):
+        return utils.sort_file_names(list(_get_memory_folder(npz_folder)['channels']))
+    if is_npy_store(npz_folder):
+        with open(os.path.join(npz_folder, NPY_STORE_INFO_FILE), 'r') as fp:
+            channel_names = json.load(fp)['channel_names']
+        return [f'{channel_name}.npz' for channel_name in channel_names]
+    return utils.sort_file_names(os.listdir(npz_folder))
+
+
+def load_channel(npz_folder: str, npz_file: str) -> [np.ndarray, float]:
+    """ Function that Loads one channel of a folder of separate NPZ files or of an NPY store
+
+        Parameters
+        ----------
+        npz_folder: str
+            path to npz folder or NPY store folder
+        npz_file: str
+            channel file name, as returned by list_channel_files()
+
+        Returns
+        ----------
+        data: numpy.ndarray
+            channel data, in the floating point type of utils.get_dtype(). For an NPY store of that type, this is a read-only memory-mapped view
+        fs: float
+            sampling frequency (Hz)
+    """
+    with profiling.io_time():
+        if is_memory_folder(npz_folder):
+            memory_folder = _get_memory_folder(npz_folder)
+            data, fs = memory_folder['channels'][npz_file], memory_folder['fs']
+        elif is_npy_store(npz_folder):
+            data_store, fs, channel_names = open_npy_store(npz_folder)
+            data = data_store[channel_names.index(os.path.splitext(npz_file)[0])]
+        else:
+            data, fs = load_npz(os.path.join(npz_folder, npz_file))
+        data = as_signal_dtype(data)
+        profiling.count_read(data)
+    return data, fs
+
+
+def as_signal_dtype(data: np.ndarray) -> np.ndarray:
+    """ Function that Converts a signal to the floating point type of utils.get_dtype(), without copying it if it already has that type
+
+        Parameters
+        ----------
+        data: numpy.ndarray
+            signal
+
+        Returns
+        ----------
+        data: numpy.ndarray
+            signal in the floating point type of utils.get_dtype()
+    """
+    dtype = utils.get_dtype()
+    if isinstance(data, np.ndarray) and data.dtype == dtype:
+        # memory-mapped arrays stay memory-mapped
+        return data
+    return np.asarray(data, dtype=dtype)
+
+
+def open_channel(npz_folder: str, npz_file: str) -> [np.ndarray, float]:
+    """ Function that Opens one channel of a folder of separate NPZ files or of an NPY store without reading it (see open_npz_data()). Slicing the returned array only reads the requested samples from disk
+
+        Parameters
+        ----------
+        npz_folder: str
+            path to npz folder or NPY store folder
+        npz_file: str
+            channel file name, as returned by list_channel_files()
+
+        Returns
+        ----------
+        data: numpy.ndarray
+            channel data (read-only memory-mapped array if possible)
+        fs: float
+            sampling frequency (Hz)
+    """
+    if is_memory_folder(npz_folder) or is_npy_store(npz_folder):
+        return load_channel(npz_folder, npz_file)
+    return open_npz_data(os.path.join(npz_folder, npz_file))
+
+
+def iter_channel_chunks(npz_folder: str, chunk_size: int, npz_files: list = None):
+    """ Function that Reads channels of a folder chunk by chunk, all channels at once. Only the samples of the current chunk are read from disk (see open_channel())
+
+        Parameters
+        ----------
+        npz_folder: str
+            path to npz folder or NPY store folder
+        chunk_size: int
+            maximum number of samples per channel in a chunk
+        npz_files: list
+            channel file names (see list_channel_files()). If None, all channels are read
+
+        Returns
+        ----------
+        generator of chunks: np.ndarray
+            chunks in the floating point type of utils.get_dtype(). Shape: (num_channels, num_chunk_samples)
+    """
+    if npz_files is None:
+        npz_files = list_channel_files(npz_folder)
+    with profiling.io_time():
+        channels = [open_channel(npz_folder, npz_file)[0] for npz_file in npz_files]
+    num_samples = len(channels[0])
+    for start_sample in range(0, num_samples, chunk_size):
+        stop_sample = min(start_sample + chunk_size, num_samples)
+        with profiling.io_time():
+            chunk = np.empty((len(channels), stop_sample - start_sample), dtype=utils.get_dtype())
+            for ch_indx, data in enumerate(channels):
+                chunk[ch_indx, :] = data[start_sample:stop_sample]
+            profiling.count_read(chunk)
+        yield chunk
+
+
+def is_memory_folder(folder: str) -> bool:
+    """ Function that Checks whether a folder is kept in memory (its path starts with MEMORY_FOLDER_PREFIX, e.g. mem://filtered). In-memory folders are shared by all the functions called in the same process, e.g. by the commands of a CLI chain, so that intermediate results are not written to disk and read again
+
+        Parameters
+        ----------
+        folder: str
+            path to folder
+
+        Returns
+        ----------
+        is_memory: bool
+            True if the folder is kept in memory
+    """
+    return isinstance(folder, str) and folder.startswith(MEMORY_FOLDER_PREFIX)
+
+
+def _get_memory_folder(folder: str) -> dict:
+    """ Function that Gets an in-memory folder
+
+        Parameters
+        ----------
+        folder: str
+            path to in-memory folder
+
+        Returns
+        ----------
+        memory_folder: dict
+            {'fs': sampling frequency, 'channels': {channel file name: data}}
+    """
+    if folder not in _memory_folders:
+        raise ValueError(
+            f'{folder} is not in memory. In-memory folders must be written by a previous command of the same chain')
+    return _memory_folders[folder]
+
+
+def release_memory_folder(folder: str) -> None:
+    """ Function that Frees the memory of an in-memory folder
+
+        Parameters
+        ----------
+        folder: str
+            path to in-memory folder
+
+        Returns
+        ----------
+    """
+    _memory_folders.pop(folder, None)
+
+
+def make_output_folder(output_npz_folder: str, allow_memory: bool = True) -> None:
+    """ Function that Creates an output folder, on disk or in memory (see is_memory_folder())
+
+        Parameters
+        ----------
+        output_npz_folder: str
+            path to output folder
+        allow_memory: bool
+            whether the output can be kept in memory. Only folders of signals (one file per channel, written with save_channel()) can
+
+        Returns
+        ----------
+    """
+    if is_memory_folder(output_npz_folder):
+        if not allow_memory:
+            raise ValueError(
+                f'{output_npz_folder} cannot be kept in memory. Only folders of signals (one file per channel) can')
+        if output_npz_folder in _memory_folders:
+            Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
+        _memory_folders[output_npz_folder] = {'fs': None, 'channels': {}}
+    elif not os.path.exists(output_npz_folder):
         os.makedirs(output_npz_folder)
     else:
         Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
-    for ch_indx in range(data.shape[0]):
-        np.savez(os.path.join(output_npz_folder,
-                 f'Ch{ch_indx+1}.npz'), data=data[ch_indx, :], fs=fs)
+
+
+def save_channel(output_npz_folder: str, npz_file: str, data: np.ndarray, fs: float) -> None:
+    """ Function that Saves one channel as an NPZ file (same as np.savez(data=data, fs=fs)), or keeps it in memory if the folder is in memory (see make_output_folder())
+
+        Parameters
+        ----------
+        output_npz_folder: str
+            path to output folder
+        npz_file: str
+            channel file name
+        data: numpy.ndarray
+            channel data, saved in the floating point type of utils.get_dtype()
+        fs: float
+            sampling frequency (Hz)
+
+        Returns
+        ----------
+    """
+    data = as_signal_dtype(data)
+    if is_memory_folder(output_npz_folder):
+        memory_folder = _get_memory_folder(output_npz_folder)
+        memory_folder['fs'] = fs
+        memory_folder['channels'][npz_file] = data
+        return
+    save_npz(os.path.join(output_npz_folder, npz_file), data=data, fs=fs)
+
+
+def save_npz(npz_file: str, **arrays) -> None:
+    """ Function that Saves arrays as an NPZ file (same as np.savez()), counted as I/O when commands are profiled (see profiling.profile_command())
+
+        Parameters
+        ----------
+        npz_file: str
+            path to output npz file
+        **arrays: numpy.ndarray
+            arrays to be saved
+
+        Returns
+        ----------
+    """
+    with profiling.io_time():
+        np.savez(npz_file, **arrays)
+        profiling.count_written(*arrays.values())
+
+
+class NpyStoreStreamWriter:
+    """ Writes a multichannel recording chunk by chunk to an NPY store (see create_npy_store()). Same interface as NpzStreamWriter
+
+        Parameters
+        ----------
+        output_folder: str
+            path to output NPY store folder
+        num_channels: int
+            number of channels
+        num_samples: int
+            total number of samples per channel that will be written
+        fs: float
+            sampling frequency (Hz)
+        dtype: np.dtype
+            data type of the saved samples. Default is float64
+        file_names: list
+            NPZ file names of the channels (see list_channel_files()). If None, Ch1.npz, Ch2.npz, ...
+
+        Returns
+        ----------
+    """
+
+    def __init__(self, output_folder: str, num_channels: int, num_samples: int,
+                 fs: float, dtype: np.dtype = np.float64, file_names: list = None):
+        self.num_samples = int(num_samples)
+        self.samples_written = 0
+        channel_names = None if file_names is None else [os.path.splitext(file_name)[0] for file_name in file_names]
+        self._data_store = create_npy_store(output_folder, num_channels, num_samples, fs, dtype, channel_names)
+
+    def write(self, chunk: np.ndarray) -> None:
+        """ Appends a chunk of samples to all channels
+
+        Parameters
+            ----------
+            chunk: np.ndarray
+                chunk of samples. Shape: (num_channels, num_chunk_samples)
+
+        Returns
+            ----------
+        """
+        if chunk.shape[0] != self._data_store.shape[0]:
+            raise ValueError(f'Chunk has {chunk.shape[0]} channels but {self._data_store.shape[0]} channels are being written')
+        if self.samples_written + chunk.shape[1] > self.num_samples:
+            raise ValueError(f'Cannot write more than {self.num_samples} samples per channel')
+        with profiling.io_time():
+            self._data_store[:, self.samples_written:self.samples_written + chunk.shape[1]] = chunk
+            profiling.count_written(chunk)
+        self.samples_written += chunk.shape[1]
+
+    def close(self) -> None:
+        """ Flushes and closes the NPY store
+
+        Parameters
+            ----------
+
+        Returns
+            ----------
+        """
+        if self._data_store is None:
+            return
+        with profiling.io_time():
+            self._data_store.flush()
+        self._data_store = None
+        if self.samples_written != self.num_samples:
+            raise ValueError(f'Only {self.samples_written} of {self.num_samples} samples per channel were written')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._data_store = None
@@ -1,10 +1,21 @@
-import utils
 import os
+import json
+import numpy as np
+from tqdm import tqdm
+import utils
+import data_io
+import cache
+
+# default number of samples per channel read at once
+DEFAULT_CHUNK_SIZE = 2**15
+# name of the file with the principal axes and explained variances, written next to the components
+PCA_MODEL_FILE = 'pca.json'
 
 
 def pca_from_npz(input_npz_folder, output_npz_folder,
-                 n_components, matrix_whitenning, channels_list) -> None:
-    """ Performs PCA on NPZ files
+                 n_components, matrix_whitenning, channels_list, solver: str = 'full', output_format: str = 'npz',
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, seed: int = None) -> None:
+    """ Performs PCA on NPZ files. The covariance matrix of the channels is accumulated chunk by chunk, and the components are then projected and written chunk by chunk, so the recording never has to be in memory at once. The components are saved as PC1.npz, PC2.npz, ... (or an NPY store), and the principal axes and explained variances in pca.json
 
         Parameters
         ----------
@@ -13,26 +24,189 @@ def pca_from_npz(input_npz_folder, output_npz_folder,
         output_npz_folder: str
             path to output npz folder
         n_components: int
-            number of components to keep
+            number of components to keep. If None, all components are kept
         matrix_whitenning: bool
-            whether to whiten the matrix
+            whether to whiten the components (scaled to unit variance)
         channels_list: list
-            list of channels to plot
+            list of channels (1-based) to apply PCA to. If None, all channels are used
+        solver: str
+            'full' (default) for the eigendecomposition of the covariance matrix, or 'randomized' for a randomized subspace iteration, faster for high channel counts and few components
+        output_format: str
+            'npz' (default) to write one NPZ file per component, or 'npy' to write a single memory-mappable NPY store (see data_io.create_npy_store())
+        chunk_size: int
+            maximum number of samples per channel read at once
+        seed: int
+            seed of the random generator of the randomized solver
 
         Returns
         ----------
     """
-    npz_files = os.listdir(input_npz_folder)
-    npz_files = utils.sort_file_names(npz_files)
+    npz_files = data_io.list_channel_files(input_npz_folder)
+    channels_list = utils.convert_string_to_list(channels_list)
 
     if channels_list is None:
         channels_list = tuple(range(1, len(npz_files) + 1))
     else:
         channels_list = sorted(channels_list)
+    npz_files = [npz_files[channel - 1] for channel in channels_list]
+    if n_components is None:
+        n_components = len(npz_files)
+    if n_components < 1 or n_components > len(npz_files):
+        raise ValueError(f'Number of components must be between 1 and the number of channels ({len(npz_files)})')
+    if solver not in ['full', 'randomized']:
+        raise ValueError('Solver must be either "full" or "randomized"')
+    if output_format not in ['npz', 'npy']:
+        raise ValueError(
+            'Output format must be either "npz" (one NPZ file per component) or "npy" (single NPY store)')
 
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
+    data_io.make_output_folder(output_npz_folder, allow_memory=False)
+
+    # every component depends on all channels
+    manifest = cache.get_manifest(output_npz_folder, input_npz_folder)
+    if manifest is not None:
+        provenance = manifest.provenance(
+            'pca', cache.folder_input_files(input_npz_folder),
+            [list(channels_list), n_components, matrix_whitenning, solver, output_format, seed])
+        if manifest.is_folder_up_to_date(provenance):
+            print(f'PCA results in {output_npz_folder} are up to date.')
+            return
 
     print(f'--- Performing PCA on NPZ files...')
+    mean, covariance, num_samples = channel_covariance(input_npz_folder, npz_files, chunk_size)
+    if solver == 'full':
+        explained_variance, components = pca_from_covariance(covariance, n_components)
+    else:
+        explained_variance, components = randomized_pca_from_covariance(covariance, n_components, seed=seed)
+    projection = components
+    if matrix_whitenning:
+        projection = components / np.sqrt(explained_variance)[:, np.newaxis]
+
+    _, _, fs = data_io.get_npz_folder_info(input_npz_folder)
+    file_names = [f'PC{component_indx+1}.npz' for component_indx in range(n_components)]
+    if output_format == 'npy':
+        writer_class = data_io.NpyStoreStreamWriter
+    else:
+        writer_class = data_io.NpzStreamWriter
+    with writer_class(output_npz_folder, n_components, num_samples, fs, utils.get_dtype(), file_names) as writer:
+        for chunk in data_io.iter_channel_chunks(input_npz_folder, chunk_size, npz_files):
+            writer.write(projection @ (chunk - mean[:, np.newaxis]))
+
+    pca_model = {'channels': list(channels_list),
+                 'components': components.tolist(),
+                 'mean': mean.tolist(),
+                 'explained_variance': explained_variance.tolist(),
+                 'explained_variance_ratio': (explained_variance / np.trace(covariance)).tolist(),
+                 'whiten': bool(matrix_whitenning),
+                 'solver': solver}
+    with open(os.path.join(output_npz_folder, PCA_MODEL_FILE), 'w') as fp:
+        json.dump(pca_model, fp)
+    if manifest is not None:
+        if output_format == 'npy':
+            output_files = [data_io.NPY_STORE_DATA_FILE, data_io.NPY_STORE_INFO_FILE]
+        else:
+            output_files = file_names
+        manifest.record([os.path.join(output_npz_folder, file_name) for file_name in output_files + [PCA_MODEL_FILE]],
+                        provenance)
+
+
+def channel_covariance(npz_folder: str, npz_files: list = None,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> [np.ndarray, np.ndarray, int]:
+    """ Computes the mean and covariance matrix of channels in one pass over the recording, chunk by chunk. The centered scatter matrix of every chunk is one matrix product, and the chunks are merged with the pairwise update of Chan et al., which stays accurate for signals with large offsets
+
+        Parameters
+        ----------
+        npz_folder: str
+            path to npz folder or NPY store folder
+        npz_files: list
+            channel file names (see data_io.list_channel_files()). If None, all channels are used
+        chunk_size: int
+            maximum number of samples per channel read at once
+
+        Returns
+        ----------
+        mean: np.ndarray
+            mean of every channel. Shape: (num_channels,)
+        covariance: np.ndarray
+            covariance matrix (same as np.cov()). Shape: (num_channels, num_channels)
+        num_samples: int
+            number of samples per channel
+    """
+    _, total_samples, _ = data_io.get_npz_folder_info(npz_folder)
+    mean = None
+    num_samples = 0
+    for chunk in tqdm(data_io.iter_channel_chunks(npz_folder, chunk_size, npz_files),
+                      total=-(-total_samples // chunk_size)):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if mean is None:
+            mean = np.zeros(chunk.shape[0])
+            scatter = np.zeros((chunk.shape[0], chunk.shape[0]))
+        chunk_mean = np.mean(chunk, axis=1)
+        chunk -= chunk_mean[:, np.newaxis]
+        total_samples = num_samples + chunk.shape[1]
+        delta = chunk_mean - mean
+        scatter += chunk @ chunk.T + np.outer(delta, delta) * (num_samples * chunk.shape[1] / total_samples)
+        mean += delta * (chunk.shape[1] / total_samples)
+        num_samples = total_samples
+    return mean, scatter / (num_samples - 1), num_samples
+
+
+def pca_from_covariance(covariance: np.ndarray, n_components: int) -> [np.ndarray, np.ndarray]:
+    """ Computes the principal axes of a covariance matrix with its eigendecomposition
+
+        Parameters
+        ----------
+        covariance: np.ndarray
+            covariance matrix. Shape: (num_channels, num_channels)
+        n_components: int
+            number of components to keep
+
+        Returns
+        ----------
+        explained_variance: np.ndarray
+            variance of every component, in decreasing order. Shape: (n_components,)
+        components: np.ndarray
+            principal axes. Shape: (n_components, num_channels)
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    return eigenvalues[order], _flip_signs(eigenvectors[:, order].T)
+
+
+def randomized_pca_from_covariance(covariance: np.ndarray, n_components: int, n_oversamples: int = 10,
+                                   n_iter: int = 4, seed: int = None) -> [np.ndarray, np.ndarray]:
+    """ Computes the leading principal axes of a covariance matrix with a randomized subspace iteration (Halko et al.), which only needs matrix products with n_components + n_oversamples vectors instead of a full eigendecomposition
+
+        Parameters
+        ----------
+        covariance: np.ndarray
+            covariance matrix. Shape: (num_channels, num_channels)
+        n_components: int
+            number of components to keep
+        n_oversamples: int
+            number of extra random vectors, which improve the accuracy. Default is 10
+        n_iter: int
+            number of power iterations. Default is 4
+        seed: int
+            seed of the random generator
+
+        Returns
+        ----------
+        explained_variance: np.ndarray
+            variance of every component, in decreasing order. Shape: (n_components,)
+        components: np.ndarray
+            principal axes. Shape: (n_components, num_channels)
+    """
+    rng = np.random.default_rng(seed)
+    num_vectors = min(n_components + n_oversamples, covariance.shape[0])
+    subspace, _ = np.linalg.qr(rng.standard_normal((covariance.shape[0], num_vectors)))
+    for _ in range(n_iter):
+        subspace, _ = np.linalg.qr(covariance @ subspace)
+    eigenvalues, eigenvectors = np.linalg.eigh(subspace.T @ covariance @ subspace)
+    order = np.argsort(eigenvalues)[::-1][:n_components]
+    return eigenvalues[order], _flip_signs((subspace @ eigenvectors[:, order]).T)
+
+
+def _flip_signs(components: np.ndarray) -> np.ndarray:
+    """ Makes the largest loading of every component positive, so that the solvers give the same signs """
+    signs = np.sign(components[np.arange(components.shape[0]), np.argmax(np.abs(components), axis=1)])
+    return components * signs[:, np.newaxis]
@@ -1,19 +1,25 @@
 import os
 import numpy as np
 from scipy import signal
-from tqdm import tqdm
+from scipy import fft
+from scipy import stats
 import json
 import csv
 
 import utils
-import cfc
+import cache
 import data_io
-import visualization
+# only needed by the CFC and plotting functions
+cfc = utils.lazy_import('cfc')
+visualization = utils.lazy_import('visualization')
+
+# maximum number of elements of the (channels x windows x samples) blocks of windows built by freq_bands_power_from_array()
+_MAX_BLOCK_ELEMENTS = 2**24
 
 
 def stft_numeric_output_from_npz(input_npz_folder: str, output_npz_folder: str,
-                                 window_size: float, overlap: float, window_type: str = 'hann') -> None:
-    """ Computes STFT and saves results as NPZ files
+                                 window_size: float, overlap: float, window_type: str = 'hann', n_jobs: int = 1) -> None:
+    """ Computes STFT and saves results as NPZ files, in the floating point type of utils.get_dtype() (complex64 for float32, which halves the size of the output files)
 
         Parameters
         ----------
@@ -27,33 +33,48 @@ def stft_numeric_output_from_npz(input_npz_folder: str, output_npz_folder: str,
             overlap in seconds
         window_type: str
             window type. Default is 'hann', but can be any window type supported by scipy.signal.get_window()
+        n_jobs: int
+            number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
 
         Returns
         ----------
     """
 
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
+    data_io.make_output_folder(output_npz_folder, allow_memory=False)
     print(
         f'Computing STFT with window size {window_size} seconds, overlap {overlap} seconds, and window type {window_type}...')
-    for npz_file in tqdm(os.listdir(input_npz_folder)):
-        if npz_file.endswith('.npz'):
-            npz_file_path = os.path.join(input_npz_folder, npz_file)
-            npz_file_contents = np.load(npz_file_path)
-            data = npz_file_contents['data']
-            fs = npz_file_contents['fs']
-            f, t, Zxx = stft_from_array(
-                data, fs, window_size, overlap, window_type)
-            stft_npz_file_path = os.path.join(
-                output_npz_folder, f'STFT_{npz_file}')
-            np.savez(stft_npz_file_path, f=f, t=t, Zxx=Zxx)
+    args_list = [(input_npz_folder, npz_file, output_npz_folder, window_size, overlap, window_type)
+                 for npz_file in data_io.list_channel_files(input_npz_folder)]
+    _run_cached_channel_jobs(_stft_npz_file, args_list, n_jobs, 'STFT')
+
+
+def _stft_npz_file(args: tuple) -> str:
+    """ Computes STFT of one channel and saves it as STFT_<channel file name>. Worker of stft_numeric_output_from_npz()
+
+        Parameters
+        ----------
+        args: tuple
+            (input_npz_folder, npz_file, output_npz_folder, window_size, overlap, window_type)
+
+        Returns
+        ----------
+        stft_npz_file_path: str
+            path to the saved NPZ file
+    """
+    input_npz_folder, npz_file, output_npz_folder, window_size, overlap, window_type = args
+    data, fs = data_io.load_channel(input_npz_folder, npz_file)
+    f, t, Zxx = stft_from_array(
+        data, fs, window_size, overlap, window_type)
+    stft_npz_file_path = os.path.join(
+        output_npz_folder, f'STFT_{npz_file}')
+    data_io.save_npz(stft_npz_file_path, f=f, t=t, Zxx=Zxx)
+    return stft_npz_file_path
 
 
 def dft_numeric_output_from_npz(
-        input_npz_folder: str, output_npz_folder: str, nfft: int = None) -> None:
-    """ Computes DFT and saves results as NPZ files
+        input_npz_folder: str, output_npz_folder: str, nfft: int = None, n_jobs: int = 1, one_sided: bool = False,
+        output_type: str = 'complex', f_min: float = None, f_max: float = None) -> None:
+    """ Computes DFT and saves results as NPZ files, in the floating point type of utils.get_dtype() (complex64, or float32 for magnitude and power, for float32, which halves the size of the output files)
 
         Parameters
         ----------
@@ -61,31 +82,216 @@ def dft_numeric_output_from_npz(
             path to input npz folder
         output_npz_folder: str
             path to output npz folder to save DFT results
+        nfft: int
+            number of FFT points. Default is the number of samples
+        n_jobs: int
+            number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
+        one_sided: bool
+            whether only the non-negative frequencies are computed and saved (the signal is real, so the negative ones are redundant), which halves the size of the output files. Default is False
+        output_type: str
+            'complex' (DFT), 'magnitude' (absolute value of the DFT) or 'power' (squared absolute value of the DFT). Default is 'complex'
+        f_min: float
+            minimum frequency to save in Hz. Default is None which means the lowest frequency
+        f_max: float
+            maximum frequency to save in Hz. Default is None which means the highest frequency
 
         Returns
         ----------
     """
 
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
+    data_io.make_output_folder(output_npz_folder, allow_memory=False)
+    check_spectrum_output_type(output_type)
     print(f'Computing DFT...')
-    for npz_file in tqdm(os.listdir(input_npz_folder)):
-        if npz_file.endswith('.npz'):
-            npz_file_path = os.path.join(input_npz_folder, npz_file)
-            npz_file_contents = np.load(npz_file_path)
-            data = npz_file_contents['data']
-            fs = npz_file_contents['fs']
-            f, Zxx = dft_from_array(data, fs)
-            dft_npz_file_path = os.path.join(
-                output_npz_folder, f'DFT_{npz_file}')
-            np.savez(dft_npz_file_path, f=f, Zxx=Zxx)
+    args_list = [(input_npz_folder, npz_file, output_npz_folder, nfft, one_sided, output_type, f_min, f_max)
+                 for npz_file in data_io.list_channel_files(input_npz_folder)]
+    _run_cached_channel_jobs(_dft_npz_file, args_list, n_jobs, 'DFT')
+
+
+def _dft_npz_file(args: tuple) -> str:
+    """ Computes DFT of one channel and saves it as DFT_<channel file name>. Worker of dft_numeric_output_from_npz()
+
+        Parameters
+        ----------
+        args: tuple
+            (input_npz_folder, npz_file, output_npz_folder, nfft, one_sided, output_type, f_min, f_max)
+
+        Returns
+        ----------
+        dft_npz_file_path: str
+            path to the saved NPZ file
+    """
+    input_npz_folder, npz_file, output_npz_folder, nfft, one_sided, output_type, f_min, f_max = args
+    data, fs = data_io.load_channel(input_npz_folder, npz_file)
+    f, Zxx = dft_from_array(data, fs, nfft, one_sided)
+    f, Zxx = select_spectrum(f, Zxx, f_min, f_max, output_type)
+    dft_npz_file_path = os.path.join(
+        output_npz_folder, f'DFT_{npz_file}')
+    data_io.save_npz(dft_npz_file_path, f=f, Zxx=Zxx, output_type=output_type)
+    return dft_npz_file_path
+
+
+def welch_psd_from_npz(input_npz_folder: str, output_npz_folder: str, window_size: float, overlap: float,
+                       window_type: str = 'hann', confidence: float = 0.95, n_jobs: int = 1) -> None:
+    """ Computes Welch PSD (see welch_psd_from_array()) and saves results as NPZ files, with the keys of dft_numeric_output_from_npz() (so they can be plotted with visualization.plot_dft_from_npz()) and the confidence bounds (Zxx_low, Zxx_high)
+
+        Parameters
+        ----------
+        input_npz_folder: str
+            path to input npz folder
+        output_npz_folder: str
+            path to output npz folder to save PSD results
+        window_size: float
+            window size in seconds
+        overlap: float:
+            overlap in seconds
+        window_type: str
+            window type. Default is 'hann', but can be any window type supported by scipy.signal.get_window()
+        confidence: float
+            confidence level of the bounds. Default is 0.95
+        n_jobs: int
+            number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
+
+        Returns
+        ----------
+    """
+
+    data_io.make_output_folder(output_npz_folder, allow_memory=False)
+    print(
+        f'Computing Welch PSD with window size {window_size} seconds, overlap {overlap} seconds, and window type {window_type}...')
+    args_list = [(input_npz_folder, npz_file, output_npz_folder, window_size, overlap, window_type, confidence)
+                 for npz_file in data_io.list_channel_files(input_npz_folder)]
+    _run_cached_channel_jobs(_welch_psd_npz_file, args_list, n_jobs, 'PSD')
+
+
+def _welch_psd_npz_file(args: tuple) -> str:
+    """ Computes Welch PSD of one channel and saves it as PSD_<channel file name>. Worker of welch_psd_from_npz()
+
+        Parameters
+        ----------
+        args: tuple
+            (input_npz_folder, npz_file, output_npz_folder, window_size, overlap, window_type, confidence)
+
+        Returns
+        ----------
+        psd_npz_file_path: str
+            path to the saved NPZ file
+    """
+    input_npz_folder, npz_file, output_npz_folder, window_size, overlap, window_type, confidence = args
+    # the channel is read window block by window block
+    data, fs = data_io.open_channel(input_npz_folder, npz_file)
+    f, psd, psd_low, psd_high = welch_psd_from_array(data, fs, window_size, overlap, window_type,
+                                                      confidence=confidence)
+    psd_npz_file_path = os.path.join(
+        output_npz_folder, f'PSD_{npz_file}')
+    data_io.save_npz(psd_npz_file_path, f=f, Zxx=psd, Zxx_low=psd_low, Zxx_high=psd_high, output_type='psd')
+    return psd_npz_file_path
+
+
+def welch_psd_from_array(signal_array, fs: int, window_size: float, overlap: float, window_type: str = 'hann',
+                         nfft: int = None, confidence: float = 0.95) -> [np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Computes the power spectral density of a 1D array with Welch's method (same as scipy.signal.welch() with its default detrending and scaling). The periodograms are accumulated block of windows by block of windows, so memory does not depend on the length of the signal
+
+        Parameters
+        ----------
+            signal_array: np.ndarray
+                signal array in time domain (can be a memory-mapped array, only the samples of the block being processed are read)
+            fs: int
+                sampling frequency (Hz)
+            window_size: float
+                window size in seconds
+            overlap: float
+                windows overlap in seconds
+            window_type: str
+                window type. Default is 'hann', but can be any window type supported by scipy.signal.get_window()
+            nfft: int
+                number of FFT points. Default is the number of samples of a window
+            confidence: float
+                confidence level of the bounds. Default is 0.95
+
+        Returns
+        ----------
+            f: np.ndarray
+                frequency vector
+            psd: np.ndarray
+                power spectral density (V**2/Hz)
+            psd_low: np.ndarray
+                lower confidence bound of psd (chi-squared with 2 degrees of freedom per window, which is optimistic for overlapping windows)
+            psd_high: np.ndarray
+                upper confidence bound of psd
+    """
+    if np.ndim(signal_array) == 2:
+        signal_array = np.squeeze(signal_array)
+        Warning('Signal array is 2D but only one channel. Using first channel.')
+    if np.ndim(signal_array) != 1:
+        raise ValueError(
+            f'Signal array must be 1D array but has {np.ndim(signal_array)} dimensions')
+    window_length = int(window_size * fs)
+    step_length = window_length - int(overlap * fs)
+    if nfft is None:
+        nfft = window_length
+    if window_length <= 0 or step_length <= 0:
+        raise ValueError('window_size must be at least one sample long and larger than overlap')
+    if len(signal_array) < window_length:
+        raise ValueError(
+            f'Signal ({len(signal_array)} samples) is shorter than the window ({window_length} samples)')
+    if 'kaiser' in window_type:
+        window = signal.windows.kaiser(window_length, float(window_type.split(' ')[1]))
+    else:
+        window = signal.get_window(window_type, window_length)
+
+    num_windows = (len(signal_array) - window_length) // step_length + 1
+    windows_per_block = max(1, _MAX_BLOCK_ELEMENTS // nfft)
+    psd = np.zeros(nfft // 2 + 1)
+    for w0 in range(0, num_windows, windows_per_block):
+        w1 = min(w0 + windows_per_block, num_windows)
+        block = np.asarray(signal_array[w0 * step_length:(w1 - 1) * step_length + window_length], dtype=float)
+        frames = np.lib.stride_tricks.sliding_window_view(block, window_length)[::step_length]
+        frames = frames - np.mean(frames, axis=1, keepdims=True)
+        Zxx = fft.rfft(frames * window, nfft, axis=1)
+        psd += np.sum(Zxx.real**2 + Zxx.imag**2, axis=0)
+    psd /= num_windows * fs * np.sum(window**2)
+    # one-sided: the power of the negative frequencies is added to the positive ones
+    psd[1:nfft - nfft // 2] *= 2
+    f = np.fft.rfftfreq(nfft, 1 / fs)
+
+    dof = 2 * num_windows
+    psd_low = psd * dof / stats.chi2.ppf((1 + confidence) / 2, dof)
+    psd_high = psd * dof / stats.chi2.ppf((1 - confidence) / 2, dof)
+    return f, psd, psd_low, psd_high
+
+
+def _run_cached_channel_jobs(func, args_list: list, n_jobs: int, output_prefix: str) -> list:
+    """ Runs jobs that process one channel and save it as <output_prefix>_<channel file name>, skipping the channels whose output is up to date and with the result cache (see cache.run_jobs())
+
+        Parameters
+        ----------
+        func: function
+            worker function
+        args_list: list
+            list of arguments to be passed to func, one per channel: (input_npz_folder, npz_file, output_npz_folder, parameters...)
+        n_jobs: int
+            number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
+        output_prefix: str
+            prefix of the output file names, also used as name of the analysis in the cache
+
+        Returns
+        ----------
+        results: list
+            func(args) for every args in args_list, or None for the channels whose result was up to date or in the cache
+    """
+    if any(data_io.is_memory_folder(args[0]) or data_io.is_memory_folder(args[2]) for args in args_list):
+        # in-memory folders are not shared with worker processes and cannot be cached or fingerprinted
+        return utils.run_jobs(func, args_list, 1)
+    return cache.run_jobs(func, args_list, n_jobs, output_prefix,
+                          [cache.channel_input_files(args[0], args[1]) for args in args_list],
+                          [[args[1]] + list(args[3:]) for args in args_list],
+                          [os.path.join(args[2], f'{output_prefix}_{args[1]}') for args in args_list])
 
 
 def stft_from_array(signal_array, fs: int, window_size: float, overlap: float,
-                    window_type: str = 'hann', nfft: int = None) -> [np.ndarray, np.ndarray, np.ndarray]:
-    """ Computes STFT from 1D array
+                    window_type: str = 'hann', nfft: int = None, boundary: str = 'zeros',
+                    padded: bool = True) -> [np.ndarray, np.ndarray, np.ndarray]:
+    """ Computes STFT from 1D array, in the floating point type of utils.get_dtype() (Zxx is complex64 for float32)
 
         Parameters
         ----------
@@ -101,6 +307,10 @@ def stft_from_array(signal_array, fs: int, window_size: float, overlap: float,
                 window type. Default is 'hann', but can be any window type supported by scipy.signal.get_window()
             nfft: int
                 number of FFT points
+            boundary: str
+                extension of the signal at both ends, passed to scipy.signal.stft(). Default is 'zeros'. If None, the first window starts at the first sample
+            padded: bool
+                whether the signal is zero-padded at the end to fit an integer number of windows, passed to scipy.signal.stft(). Default is True
 
         Returns
         ----------
@@ -124,6 +334,8 @@ def stft_from_array(signal_array, fs: int, window_size: float, overlap: float,
     if 'kaiser' in window_type:
         window_type = signal.windows.kaiser(
             window_length, float(window_type.split(' ')[1]))
+    # scipy.signal.stft() keeps single precision inputs in single precision
+    signal_array = np.asarray(signal_array, dtype=utils.get_dtype())
     [f,
      t,
      Zxx] = signal.stft(signal_array,
@@ -131,13 +343,58 @@ def stft_from_array(signal_array, fs: int, window_size: float, overlap: float,
                         window=window_type,
                         nperseg=window_length,
                         noverlap=overlap_length,
-                        nfft=nfft)
+                        nfft=nfft,
+                        boundary=boundary,
+                        padded=padded)
     return f, t, Zxx
 
 
-def dft_from_array(signal_array, fs: int,
-                   nfft: int = None) -> [np.ndarray, np.ndarray]:
-    """ Computes DFT from 1D array
+def stft_window_sample_range(num_samples: int, fs: int, window_size: float, overlap: float,
+                             t_min: float, t_max: float) -> [np.ndarray, int, int]:
+    """ Finds the samples needed to compute the STFT windows of stft_from_array() centered in [t_min, t_max], so that a time interval of a long signal can be analyzed without reading the whole signal
+
+        Parameters
+        ----------
+            num_samples: int
+                number of samples of the whole signal
+            fs: int
+                sampling frequency (Hz)
+            window_size: float
+                window size in seconds
+            overlap: float
+                windows overlap in seconds
+            t_min: float
+                start of time interval in seconds
+            t_max: float
+                end of time interval in seconds
+
+        Returns
+        ----------
+            t: np.ndarray
+                time vector of the windows centered in [t_min, t_max], same as the one of stft_from_array() for the whole signal
+            start_sample: int
+                index of the first sample of the first window. Negative if the first window starts before the signal
+            stop_sample: int
+                index after the last sample of the last window. Larger than num_samples if the last window ends after the signal
+    """
+    window_length = int(window_size * fs)
+    step_length = window_length - int(overlap * fs)
+    # same windows as scipy.signal.stft(boundary='zeros', padded=True)
+    extended_length = num_samples + 2 * (window_length // 2)
+    extended_length += (-(extended_length - window_length) % step_length) % window_length
+    t = np.arange(window_length / 2, extended_length - window_length / 2 + 1, step_length) / float(fs)
+    t -= (window_length / 2) / fs
+    windows = np.where((t >= t_min) & (t <= t_max))[0]
+    if len(windows) == 0:
+        raise ValueError(
+            f'Invalid time interval: [{t_min}, {t_max}]. No STFT window is centered in this interval.')
+    start_sample = windows[0] * step_length - window_length // 2
+    stop_sample = windows[-1] * step_length - window_length // 2 + window_length
+    return t[windows[0]:windows[-1] + 1], int(start_sample), int(stop_sample)
+
+
+def dft_from_array(signal_array, fs: int, nfft: int = None, one_sided: bool = False) -> [np.ndarray, np.ndarray]:
+    """ Computes DFT from 1D array, in the floating point type of utils.get_dtype() (Zxx is complex64 for float32)
 
         Parameters
         ----------
@@ -147,6 +404,8 @@ def dft_from_array(signal_array, fs: int,
                 sampling frequency (Hz)
             nfft: int
                 number of FFT points
+            one_sided: bool
+                whether only the non-negative frequencies are computed, with a real FFT (nfft // 2 + 1 points). Default is False
 
         Returns
         ----------
@@ -163,11 +422,72 @@ def dft_from_array(signal_array, fs: int,
             f'Signal array must be 1D array but has {np.ndim(signal_array)} dimensions')
     if nfft is None:
         nfft = len(signal_array)
-    f = np.linspace(0, fs, nfft)
-    Zxx = np.fft.fft(signal_array, nfft)
+    # scipy.fft keeps single precision inputs in single precision
+    signal_array = np.asarray(signal_array, dtype=utils.get_dtype())
+    if one_sided:
+        f = np.fft.rfftfreq(nfft, 1 / fs)
+        Zxx = fft.rfft(signal_array, nfft)
+    else:
+        f = np.arange(nfft) * (fs / nfft)
+        Zxx = fft.fft(signal_array, nfft)
+    return f, Zxx
+
+
+def select_spectrum(f: np.ndarray, Zxx: np.ndarray, f_min: float = None, f_max: float = None,
+                    output_type: str = 'complex') -> [np.ndarray, np.ndarray]:
+    """ Keeps the frequencies of a spectrum in [f_min, f_max] and converts it to the output type
+
+        Parameters
+        ----------
+            f: np.ndarray
+                frequency vector
+            Zxx: np.ndarray
+                spectrum (complex), with frequencies along the first axis
+            f_min: float
+                minimum frequency to keep in Hz. Default is None which means the lowest frequency
+            f_max: float
+                maximum frequency to keep in Hz. Default is None which means the highest frequency
+            output_type: str
+                'complex', 'magnitude' or 'power'. Default is 'complex'
+
+        Returns
+        ----------
+            f: np.ndarray
+                frequency vector in [f_min, f_max]
+            Zxx: np.ndarray
+                spectrum in [f_min, f_max] (complex, or real with the precision of Zxx for magnitude and power)
+    """
+    check_spectrum_output_type(output_type)
+    f_min = -np.inf if f_min is None else f_min
+    f_max = np.inf if f_max is None else f_max
+    if f_max < f_min:
+        raise ValueError(f'Invalid frequency range: [{f_min}, {f_max}]. f_max must be larger than f_min.')
+    rows = np.where((f >= f_min) & (f <= f_max))[0]
+    rows = slice(rows[0], rows[-1] + 1) if len(rows) else slice(0, 0)
+    f = f[rows]
+    Zxx = Zxx[rows]
+    if output_type == 'magnitude':
+        Zxx = np.abs(Zxx)
+    elif output_type == 'power':
+        Zxx = Zxx.real**2 + Zxx.imag**2
     return f, Zxx
 
 
+def check_spectrum_output_type(output_type: str) -> None:
+    """ Checks the output type of select_spectrum()
+
+        Parameters
+        ----------
+            output_type: str
+                'complex', 'magnitude' or 'power'
+
+        Returns
+        ----------
+    """
+    if output_type not in ['complex', 'magnitude', 'power']:
+        raise ValueError(f'Invalid output type: {output_type}. Must be "complex", "magnitude" or "power"')
+
+
 def butterworth_filtering_from_array(
         signal_array, fs: int, _args: dict) -> np.ndarray:
     """ Filters signal array
@@ -216,7 +536,7 @@ def butterworth_filtering_from_array(
 
 
 def butterworth_filtering_from_npz(
-        input_npz_folder: str, output_npz_folder: str, _args: dict) -> None:
+        input_npz_folder: str, output_npz_folder: str, _args: dict, n_jobs: int = 1) -> None:
     """ Filters signal array
 
         Parameters
@@ -227,28 +547,26 @@ def butterworth_filtering_from_npz(
                 path to output npz folder to save filtered results
             _args: dict
                 dictionary containing filter parameters
+            n_jobs: int
+                number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
 
         Returns
         ----------
     """
 
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
-
-    for npz_file in tqdm(os.listdir(input_npz_folder)):
-        if npz_file.endswith('.npz'):
-            npz_file_path = os.path.join(input_npz_folder, npz_file)
-            npz_file_contents = np.load(npz_file_path)
-            data = npz_file_contents['data']
-            fs = npz_file_contents['fs']
-            data = butterworth_filtering_from_array(data, fs, _args)
-            filtered_npz_file_path = os.path.join(
-                output_npz_folder, f'Filtered_{npz_file}')
-            np.savez(filtered_npz_file_path, data=data, fs=fs)
+    data_io.make_output_folder(output_npz_folder)
+
+    if _args['filter_type'] == 'BPF':
+        # same conversion as in butterworth_filtering_from_array(), which runs in the worker processes
+        _args['freq_cutoff'] = [int(i) for i in utils.convert_string_to_list(_args['freq_cutoff'])]
+    args_list = [(input_npz_folder, npz_file, output_npz_folder, _args)
+                 for npz_file in data_io.list_channel_files(input_npz_folder)]
+    _run_cached_channel_jobs(_butterworth_filtering_npz_file, args_list, n_jobs, 'Filtered')
+    _, _, fs = data_io.get_npz_folder_info(input_npz_folder)
 
     _args['fs'] = int(fs)
+    if data_io.is_memory_folder(output_npz_folder):
+        return
     filter_freq_response_json_file_path = os.path.join(
         output_npz_folder, f'filter_freq_response.json')
 
@@ -256,6 +574,26 @@ def butterworth_filtering_from_npz(
         json.dump(_args, fp)
 
 
+def _butterworth_filtering_npz_file(args: tuple) -> float:
+    """ Filters one channel and saves it as Filtered_<channel file name>. Worker of butterworth_filtering_from_npz()
+
+        Parameters
+        ----------
+        args: tuple
+            (input_npz_folder, npz_file, output_npz_folder, _args)
+
+        Returns
+        ----------
+        fs: float
+            sampling frequency (Hz) of the channel
+    """
+    input_npz_folder, npz_file, output_npz_folder, _args = args
+    data, fs = data_io.load_channel(input_npz_folder, npz_file)
+    data = butterworth_filtering_from_array(data, fs, dict(_args))
+    data_io.save_channel(output_npz_folder, f'Filtered_{npz_file}', data, fs)
+    return fs
+
+
 def calc_freq_response(
         _args: dict) -> [np.ndarray, np.ndarray, np.ndarray, dict]:
     """ Calculates filter frequency response
@@ -333,14 +671,14 @@ def calc_cfc_from_array(signal_array, fs: int, freqs_amp: list,
 
     if time_interval is None:
         time_interval = [0, len(signal_array) / fs]
-    signal_array = signal_array[int(
-        time_interval[0] * fs):int(time_interval[1] * fs)]
+    signal_array = np.asarray(signal_array[int(
+        time_interval[0] * fs):int(time_interval[1] * fs)])
     MI_mat = cfc.calc_tf_mvl(signal_array, fs, freqs_phase, freqs_amp)
     return MI_mat
 
 
 def calc_cfc_from_npz(input_npz_folder: str, output_npz_folder: str,
-                      freqs_amp: list, freqs_phase: list, time_interval: list = None) -> None:
+                      freqs_amp: list, freqs_phase: list, time_interval: list = None, n_jobs: int = 1) -> None:
     """ Calculates CFC matrix
 
         Parameters
@@ -355,32 +693,235 @@ def calc_cfc_from_npz(input_npz_folder: str, output_npz_folder: str,
                 phase frequencies (Hz)
             time_interval: list
                 time interval to calculate CFC over in seconds
+            n_jobs: int
+                number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
 
         Returns
         ----------
     """
 
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
-
-    for npz_file in tqdm(os.listdir(input_npz_folder)):
-        if npz_file.endswith('.npz'):
-            npz_file_path = os.path.join(input_npz_folder, npz_file)
-            npz_file_contents = np.load(npz_file_path)
-            data = npz_file_contents['data']
-            fs = npz_file_contents['fs']
-            MI_mat = calc_cfc_from_array(
-                data, fs, freqs_amp, freqs_phase, time_interval)
-            cfc_npz_file_path = os.path.join(
-                output_npz_folder, f'CFC_{npz_file}')
-            np.savez(
+    data_io.make_output_folder(output_npz_folder, allow_memory=False)
+
+    args_list = [(input_npz_folder, npz_file, output_npz_folder, freqs_amp, freqs_phase, time_interval)
+                 for npz_file in data_io.list_channel_files(input_npz_folder)]
+    _run_cached_channel_jobs(_cfc_npz_file, args_list, n_jobs, 'CFC')
+
+
+def _cfc_npz_file(args: tuple) -> str:
+    """ Calculates CFC matrix of one channel and saves it as CFC_<channel file name>. Worker of calc_cfc_from_npz()
+
+        Parameters
+        ----------
+            args: tuple
+                (input_npz_folder, npz_file, output_npz_folder, freqs_amp, freqs_phase, time_interval)
+
+        Returns
+        ----------
+            cfc_npz_file_path: str
+                path to the saved NPZ file
+    """
+    input_npz_folder, npz_file, output_npz_folder, freqs_amp, freqs_phase, time_interval = args
+    # only the samples in time_interval are read
+    data, fs = data_io.open_channel(input_npz_folder, npz_file)
+    MI_mat = calc_cfc_from_array(
+        data, fs, freqs_amp, freqs_phase, time_interval)
+    cfc_npz_file_path = os.path.join(
+        output_npz_folder, f'CFC_{npz_file}')
+    data_io.save_npz(
+        cfc_npz_file_path,
+        MI_mat=MI_mat,
+        freqs_amp=freqs_amp,
+        freqs_phase=freqs_phase,
+        time_interval=time_interval)
+    return cfc_npz_file_path
+
+
+def calc_cfc_sliding_from_array(signal_array, fs: int, freqs_amp: list, freqs_phase: list, window_size: float,
+                                step: float, time_interval: list = None, method: str = 'tf_mvl',
+                                output_npy_file: str = None, n_jobs: int = 1) -> [np.ndarray, np.ndarray]:
+    """ Calculates CFC matrices in sliding windows (see cfc.sliding_comodulogram())
+
+        Parameters
+        ----------
+            signal_array: np.ndarray
+                1D array of signal (can be a memory-mapped array)
+            fs: int
+                sampling frequency (Hz)
+            freqs_amp: list
+                amplitude frequencies (Hz)
+            freqs_phase: list
+                phase frequencies (Hz)
+            window_size: float
+                window size in seconds
+            step: float
+                step between the starts of consecutive windows in seconds
+            time_interval: list
+                time interval to calculate CFC over in seconds. If None, the whole signal is used
+            method: str
+                'tf_mvl' (default, same as calc_cfc_from_array()) or 'mi' (modulation index)
+            output_npy_file: str
+                path to a .npy file in which the CFC matrices are written as they are calculated. If None, they are kept in memory
+            n_jobs: int
+                number of blocks of windows processed in parallel. If None, 0 or negative, all CPU cores are used
+
+        Returns
+        ----------
+            MI_mat: np.ndarray
+                CFC matrices of all windows. Shape: (num_windows, len(freqs_phase), len(freqs_amp))
+            t: np.ndarray
+                center time of every window in seconds
+    """
+    if np.ndim(signal_array) == 2:
+        signal_array = np.squeeze(signal_array)
+        Warning('Signal array is 2D but only one channel. Using first channel.')
+    if np.ndim(signal_array) != 1:
+        raise ValueError(
+            f'Signal array must be 1D array but has {np.ndim(signal_array)} dimensions')
+
+    if time_interval is None:
+        time_interval = [0, len(signal_array) / fs]
+    start_sample = int(time_interval[0] * fs)
+    signal_array = signal_array[start_sample:int(time_interval[1] * fs)]
+    MI_mat, t = cfc.sliding_comodulogram(signal_array, fs, freqs_phase, freqs_amp, window_size, step,
+                                         method=method, output_npy_file=output_npy_file, n_jobs=n_jobs)
+    return MI_mat, t + start_sample / fs
+
+
+def calc_cfc_sliding_from_npz(input_npz_folder: str, output_npz_folder: str, freqs_amp: list, freqs_phase: list,
+                              window_size: float, step: float, time_interval: list = None,
+                              method: str = 'tf_mvl', n_jobs: int = 1) -> None:
+    """ Calculates CFC matrices in sliding windows and saves them as NPZ files (CFC_sliding_<channel file name>), with the keys of calc_cfc_from_npz() and the center time of every window (t)
+
+        Parameters
+        ----------
+            input_npz_folder: str
+                path to input npz folder
+            output_npz_folder: str
+                path to output npz folder to save CFC results
+            freqs_amp: list
+                amplitude frequencies (Hz)
+            freqs_phase: list
+                phase frequencies (Hz)
+            window_size: float
+                window size in seconds
+            step: float
+                step between the starts of consecutive windows in seconds
+            time_interval: list
+                time interval to calculate CFC over in seconds. If None, the whole signal is used
+            method: str
+                'tf_mvl' (default, same as calc_cfc_from_npz()) or 'mi' (modulation index)
+            n_jobs: int
+                number of blocks of windows processed in parallel. If None, 0 or negative, all CPU cores are used
+
+        Returns
+        ----------
+    """
+
+    data_io.make_output_folder(output_npz_folder, allow_memory=False)
+
+    manifest = cache.get_manifest(output_npz_folder, input_npz_folder)
+    result_cache = None if manifest is None else cache.get_cache()
+    try:
+        for npz_file in data_io.list_channel_files(input_npz_folder):
+            cfc_npz_file_path = os.path.join(output_npz_folder, f'CFC_sliding_{npz_file}')
+            if manifest is not None:
+                input_files = cache.channel_input_files(input_npz_folder, npz_file)
+                params = [npz_file, freqs_amp, freqs_phase, window_size, step, time_interval, method]
+                provenance = manifest.provenance('CFC_sliding', input_files, params)
+                if manifest.is_up_to_date(cfc_npz_file_path, provenance):
+                    print(f'Sliding window CFC of {npz_file} is up to date')
+                    continue
+            if result_cache is not None:
+                key = result_cache.key('CFC_sliding', input_files, params)
+                if result_cache.get(key, cfc_npz_file_path):
+                    print(f'Sliding window CFC of {npz_file} found in cache {result_cache.cache_dir}')
+                    manifest.record([cfc_npz_file_path], provenance, save=False)
+                    continue
+            print(f'Computing sliding window CFC of {npz_file}...')
+            # the signal is read and the results are written block by block
+            data, fs = data_io.open_channel(input_npz_folder, npz_file)
+            npy_file_path = os.path.join(output_npz_folder, f'CFC_sliding_{os.path.splitext(npz_file)[0]}.npy')
+            MI_mat, t = calc_cfc_sliding_from_array(data, fs, freqs_amp, freqs_phase, window_size, step,
+                                                    time_interval, method, npy_file_path, n_jobs)
+            del MI_mat, data
+            data_io.write_npz_from_npy_files(
                 cfc_npz_file_path,
-                MI_mat=MI_mat,
+                {'MI_mat': npy_file_path},
                 freqs_amp=freqs_amp,
                 freqs_phase=freqs_phase,
-                time_interval=time_interval)
+                time_interval=[t[0] - window_size / 2, t[-1] + window_size / 2],
+                t=t)
+            os.remove(npy_file_path)
+            if result_cache is not None:
+                result_cache.put(key, cfc_npz_file_path)
+            if manifest is not None:
+                manifest.record([cfc_npz_file_path], provenance, save=False)
+                manifest.save(cache.MANIFEST_SAVE_INTERVAL)
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+
+def freq_bands_power_from_array(signal_array, fs: int, window_size: float, overlap: float, freq_bands: list,
+                                window_type: str = 'hann') -> np.ndarray:
+    """ Computes the power of frequency bands in the windows of stft_from_array(boundary=None, padded=False), for all channels and bands at once
+
+        Parameters
+        ----------
+            signal_array: np.ndarray
+                signal array in time domain. Shape: (channels, samples)
+            fs: int
+                sampling frequency (Hz)
+            window_size: float
+                window size in seconds
+            overlap: float
+                windows overlap in seconds
+            freq_bands: list
+                list of frequency bands, each one a list of the lower and upper frequency bounds of the band (Hz)
+            window_type: str
+                window type. Default is 'hann', but can be any window type supported by scipy.signal.get_window()
+
+        Returns
+        ----------
+            power_bands: np.ndarray
+                sum of the squared STFT magnitudes over the frequencies of each band. Shape: (bands, channels, windows)
+    """
+    signal_array = np.atleast_2d(signal_array)
+    window_length = int(window_size * fs)
+    step_length = window_length - int(overlap * fs)
+    nfft = 2 * window_length
+    if signal_array.shape[1] < window_length:
+        raise ValueError(
+            f'Signal ({signal_array.shape[1]} samples) is shorter than the window ({window_length} samples)')
+    # same window and scaling as scipy.signal.stft()
+    if 'kaiser' in window_type:
+        window = signal.windows.kaiser(window_length, float(window_type.split(' ')[1]))
+    else:
+        window = signal.get_window(window_type, window_length)
+    window = window / np.sum(window)
+    f = np.fft.rfftfreq(nfft, 1 / fs)
+
+    # only the frequency rows from the lowest to the highest band bound are kept
+    band_rows = [np.where((f >= freq_band[0]) & (f <= freq_band[1]))[0] for freq_band in freq_bands]
+    for freq_band, rows in zip(freq_bands, band_rows):
+        if len(rows) == 0:
+            raise ValueError(
+                f'Frequency band {freq_band} contains no frequency of the STFT (frequency resolution {fs / nfft} Hz)')
+    used_rows = np.concatenate(band_rows)
+    first_row = used_rows.min()
+    last_row = used_rows.max() + 1
+    bands_mask = np.zeros((last_row - first_row, len(freq_bands)))
+    for band_indx, rows in enumerate(band_rows):
+        bands_mask[rows - first_row, band_indx] = 1
+
+    frames = np.lib.stride_tricks.sliding_window_view(signal_array, window_length, axis=1)[:, ::step_length, :]
+    power_bands = np.zeros((len(freq_bands), signal_array.shape[0], frames.shape[1]))
+    windows_per_block = max(1, _MAX_BLOCK_ELEMENTS // (nfft * signal_array.shape[0]))
+    for w0 in range(0, frames.shape[1], windows_per_block):
+        Zxx = np.fft.rfft(frames[:, w0:w0 + windows_per_block, :] * window, n=nfft, axis=-1)[..., first_row:last_row]
+        power = Zxx.real**2 + Zxx.imag**2
+        power_bands[:, :, w0:w0 + windows_per_block] = np.moveaxis(power @ bands_mask, -1, 0)
+    return power_bands
 
 
 def freq_bands_power_over_time(
@@ -430,7 +971,7 @@ def freq_bands_power_over_time(
     channels_list = utils.convert_string_to_list(channels_list)
     ignore_channels = utils.convert_string_to_list(ignore_channels)
 
-    data_all, fs, channels_map = data_io.load_all_npz_files(input_npz_folder, ignore_channels, channels_list)
+    _, num_samples, fs = data_io.get_npz_folder_info(input_npz_folder)
     # if freq_bands only has one list, we should make sure it is a list of lists
     if len(freq_bands) == 2 and isinstance(freq_bands[0], int) and isinstance(freq_bands[1], int):
         freq_bands = [freq_bands]
@@ -440,29 +981,34 @@ def freq_bands_power_over_time(
     if t_min is None:
         t_min = 0
     if t_max is None:
-        t_max = data_all.shape[1] / fs
+        t_max = num_samples / fs
 
     if t_max <= t_min:
         raise ValueError(
             f'Invalid time interval: [{t_min}, {t_max}]. t_max must be larger than t_min.')
 
-    for freq_band in freq_bands:
-        for ch_indx in range(data_all.shape[0]):
-            data = data_all[ch_indx, :]
-            f, t, Zxx = stft_from_array(data, fs, window_size, overlap)
-            Zxx = np.abs(Zxx)
-            if ch_indx == 0:
-                spectrum_all = np.zeros((data_all.shape[0], len(t), len(f)))
-            spectrum_all[ch_indx, :, :] = Zxx.T
-
-        t0 = np.where(t >= t_min)[0][0]
-        t1 = np.where(t <= t_max)[0][-1]
-        t = t[t0:t1 + 1]
-        f0 = np.where(f >= freq_band[0])[0][0]
-        f1 = np.where(f <= freq_band[1])[0][-1]
-        spectrum_all = spectrum_all[:, :, f0:f1 + 1]
-        spectrum_all = spectrum_all[:, t0:t1 + 1, :]
-        power_all = np.sum(spectrum_all**2, axis=2)
+    # only the samples of the STFT windows centered in [t_min, t_max] are read
+    t, start_sample, stop_sample = stft_window_sample_range(num_samples, fs, window_size, overlap, t_min, t_max)
+    result_cache = None if data_io.is_memory_folder(input_npz_folder) else cache.get_cache()
+    cached_arrays = None
+    if result_cache is not None:
+        key = result_cache.key('freq_bands_power', cache.folder_input_files(input_npz_folder),
+                               [freq_bands, channels_list, ignore_channels, window_size, overlap, t_min, t_max])
+        cached_arrays = result_cache.get_arrays(key)
+    if cached_arrays is not None:
+        power_bands = cached_arrays['power_bands']
+        channels_map = list(cached_arrays['channels_map'])
+    else:
+        data_all, fs, channels_map = data_io.load_all_npz_files(
+            input_npz_folder, ignore_channels, channels_list,
+            start_sample=max(start_sample, 0), stop_sample=min(stop_sample, num_samples))
+        data_all = np.pad(data_all, ((0, 0), (max(-start_sample, 0), max(stop_sample - num_samples, 0))))
+
+        # the STFT of every channel is computed once for all bands
+        power_bands = freq_bands_power_from_array(data_all, fs, window_size, overlap, freq_bands)
+        if result_cache is not None:
+            result_cache.put_arrays(key, power_bands=power_bands, channels_map=channels_map)
+    for freq_band, power_all in zip(freq_bands, power_bands):
         avg_power = np.mean(power_all, axis=0)
         avg_power = 10 * np.log10(avg_power)
         power_all = 10 * np.log10(power_all)
@@ -473,7 +1019,7 @@ def freq_bands_power_over_time(
             with open(f'{output_csv_file}_{freq_band[0]}_{freq_band[1]}.csv', 'w', newline='') as csvfile:
                 csvwriter = csv.writer(csvfile)
                 csvwriter.writerow(['Channel', 'Time', 'Power'])
-                for ch_indx in range(data_all.shape[0]):
+                for ch_indx in range(power_all.shape[0]):
                     for t_indx in range(len(t)):
                         csvwriter.writerow([channels_map[ch_indx] + 1, t[t_indx], power_all[ch_indx, t_indx]])
                 for t_indx in range(len(t)):
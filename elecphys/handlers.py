@@ -1,5 +1,6 @@
 from functools import wraps
 import os
+import profiling
 
 
 class ErrorHandler:
@@ -31,7 +32,7 @@ class ErrorHandler:
         return None
 
     def error_handler(self, func):
-        """ Error handler decorator
+        """ Error handler decorator. If profiling is enabled (see profiling.is_enabled()), the function is also profiled
 
         Parameters
             ----------
@@ -45,11 +46,18 @@ class ErrorHandler:
         """
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if os.environ.get('ELECPHYS_DEBUG') == 'True':
-                return func(*args, **kwargs)
-            else:
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    return self.error(e)
+            if profiling.is_enabled():
+                with profiling.profile_command(func.__name__):
+                    return self._call(func, *args, **kwargs)
+            return self._call(func, *args, **kwargs)
         return wrapper
+
+    def _call(self, func, *args, **kwargs):
+        """ Calls a function, and prints its error instead of raising it unless debug mode is on """
+        if os.environ.get('ELECPHYS_DEBUG') == 'True':
+            return func(*args, **kwargs)
+        else:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                return self.error(e)
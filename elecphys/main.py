@@ -2,12 +2,18 @@ import click
 import sys
 import os
 
-import conversion
-import preprocessing
-import fourier_analysis
-import visualization
-import dimensionality_reduction
+import cache
+import profiling
+import utils
 from handlers import ErrorHandler
+# the modules of the commands, and the libraries they need (e.g. matplotlib, scipy and h5py), are only loaded
+# when a command uses them, so that --help and light commands start quickly
+conversion = utils.lazy_import('conversion')
+data_io = utils.lazy_import('data_io')
+preprocessing = utils.lazy_import('preprocessing')
+fourier_analysis = utils.lazy_import('fourier_analysis')
+visualization = utils.lazy_import('visualization')
+dimensionality_reduction = utils.lazy_import('dimensionality_reduction')
 error_handler = ErrorHandler().error_handler
 
 
@@ -16,8 +22,31 @@ error_handler = ErrorHandler().error_handler
               type=bool, default=False, show_default=True, is_flag=True)
 @click.option('--debug', '-d', help='Debug mode', required=False,
               type=bool, default=False, show_default=True, is_flag=True)
+@click.option('--cache_dir', '-cd', help='Cache STFT, DFT, PSD, filter, CFC and power over time results in this folder (the cache is disabled if it is not set)',
+              required=False, type=str, default=None, show_default=True)
+@click.option('--cache_size', '-csz', help='Maximum size of the cache in MB (least recently used results are removed)',
+              required=False, type=int, default=cache.DEFAULT_CACHE_SIZE // 2**20, show_default=True)
+@click.option('--cache_hash_contents', '-chc', help='Identify input files by the hash of their contents instead of their path, size and modification time',
+              required=False, type=bool, default=False, show_default=True, is_flag=True)
+@click.option('--no_cache', '-nc', help='Do not use the cache, even if the environment variable ELECPHYS_CACHE_DIR is set', required=False,
+              type=bool, default=False, show_default=True, is_flag=True)
+@click.option('--dtype', '-dt', help='Floating point type signals are loaded, processed and saved in (float32 halves memory and disk usage)',
+              required=False, type=click.Choice(['float32', 'float64']), default='float64', show_default=True)
+@click.option('--force_recompute', '-fr', help='Recompute outputs that are up to date (see the manifest.json of output folders)',
+              required=False, type=bool, default=False, show_default=True, is_flag=True)
+@click.option('--profile', '-pr', help='Profile every command (time, CPU, memory, I/O) and print a summary table at the end of the run',
+              required=False, type=bool, default=False, show_default=True, is_flag=True)
+@click.option('--profile_json', '-pj', help='Save the profile of every command to this JSON file (implies --profile)',
+              required=False, type=str, default=None, show_default=True)
+@click.option('--profile_cprofile', '-pc', help='Save the cProfile statistics of the commands to this .prof file (implies --profile)',
+              required=False, type=str, default=None, show_default=True)
+@click.option('--profile_memory', '-pm', help='Also trace the memory allocated by Python and numpy with tracemalloc, which slows down the commands (implies --profile)',
+              required=False, type=bool, default=False, show_default=True, is_flag=True)
 @click.pass_context
-def cli(ctx, verbose: bool = False, debug: bool = False) -> None:
+def cli(ctx, verbose: bool = False, debug: bool = False, cache_dir: str = None, cache_size: int = 1024,
+        cache_hash_contents: bool = False, no_cache: bool = False, dtype: str = 'float64',
+        force_recompute: bool = False, profile: bool = False, profile_json: str = None,
+        profile_cprofile: str = None, profile_memory: bool = False) -> None:
     """ ElecPhys is a Python package for electrophysiology data analysis. It provides tools for data loading, conversion, preprocessing, and visualization.
 
         Parameters
@@ -26,6 +55,26 @@ def cli(ctx, verbose: bool = False, debug: bool = False) -> None:
             verbose mode. If not specified, the default value is False
         debug: bool
             debug mode. If not specified, the default value is False
+        cache_dir: str
+            folder of the result cache. If not specified, the default value is None (no cache, unless the environment variable ELECPHYS_CACHE_DIR is set)
+        cache_size: int
+            maximum size of the result cache in MB. If not specified, the default value is 1024
+        cache_hash_contents: bool
+            identify input files by the hash of their contents. If not specified, the default value is False
+        no_cache: bool
+            do not use the result cache. If not specified, the default value is False
+        dtype: str
+            floating point type of the signals, 'float32' or 'float64'. If not specified, the default value is 'float64'
+        force_recompute: bool
+            recompute outputs that are up to date. If not specified, the default value is False
+        profile: bool
+            profile every command and print a summary table at the end of the run. If not specified, the default value is False
+        profile_json: str
+            path to a JSON file to save the profile of every command to. If not specified, the default value is None
+        profile_cprofile: str
+            path to a .prof file to save the cProfile statistics of the commands to. If not specified, the default value is None
+        profile_memory: bool
+            trace the memory allocated by the commands with tracemalloc. If not specified, the default value is False
 
         Returns
         ----------
@@ -42,21 +91,115 @@ def cli(ctx, verbose: bool = False, debug: bool = False) -> None:
         print('--- Debug mode is on.\n\n')
         os.environ['ELECPHYS_DEBUG'] = 'True'
 
+    if no_cache:
+        os.environ['ELECPHYS_CACHE_DIR'] = ''
+    elif cache_dir is not None:
+        os.environ['ELECPHYS_CACHE_DIR'] = cache_dir
+    os.environ['ELECPHYS_CACHE_SIZE'] = str(cache_size * 2**20)
+    os.environ['ELECPHYS_CACHE_HASH_CONTENTS'] = str(cache_hash_contents)
+    utils.set_dtype(dtype)
+    os.environ['ELECPHYS_FORCE_RECOMPUTE'] = str(force_recompute)
+    if verbose:
+        ctx.call_on_close(_print_cache_stats)
+    if profile or profile_json is not None or profile_cprofile is not None or profile_memory:
+        os.environ['ELECPHYS_PROFILE'] = 'True'
+    if profile_memory:
+        os.environ['ELECPHYS_PROFILE_MEMORY'] = 'True'
+    if profiling.is_enabled():
+        if profile_cprofile is not None:
+            profiling.enable_cprofile()
+        ctx.call_on_close(lambda: _save_profile(profile_json, profile_cprofile))
+
+
+def _print_cache_stats() -> None:
+    """ Prints the hits and misses of the result cache in this run
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+    """
+    result_cache = cache.get_cache()
+    if result_cache is not None:
+        stats = result_cache.stats()
+        print(f'--- Cache: {stats["hits"]} hits, {stats["misses"]} misses, '
+              f'{stats["entries"]} entries ({stats["size"] / 2**20:.1f} MB)\n\n')
+
+
+def _save_profile(profile_json: str = None, profile_cprofile: str = None) -> None:
+    """ Prints the profiles of the commands of this run, and saves them if requested
+
+        Parameters
+        ----------
+        profile_json: str
+            path to output JSON file. If None, the profiles are not saved
+        profile_cprofile: str
+            path to output .prof file. If None, the cProfile statistics are not saved
+
+        Returns
+        ----------
+    """
+    profiling.print_summary()
+    if profile_json is not None:
+        profiling.save_json(profile_json)
+        print(f'--- Profile saved to {profile_json}')
+    if profile_cprofile is not None:
+        profiling.dump_cprofile(profile_cprofile)
+        print(f'--- cProfile statistics saved to {profile_cprofile}')
+
+
+@cli.command('cache_stats', help='Prints the statistics of the result cache (and clears it if --clear is set)')
+@click.option('--clear', '-c', help='Remove all results from the cache', required=False,
+              type=bool, default=False, show_default=True, is_flag=True)
+@click.pass_context
+@error_handler
+def cache_stats(ctx, clear: bool = False) -> None:
+    """ Prints the statistics of the result cache
+
+        Parameters
+        ----------
+        clear: bool
+            remove all results from the cache. If not specified, the default value is False
+
+        Returns
+        ----------
+    """
+
+    result_cache = cache.get_cache()
+    if result_cache is None:
+        print('--- Cache is disabled.\n\n')
+        return
+    stats = result_cache.stats()
+    print(f'--- Cache folder: {result_cache.cache_dir}')
+    print(f'--- {stats["entries"]} entries, {stats["size"] / 2**20:.1f} MB of {stats["max_size"] / 2**20:.1f} MB')
+    print(f'--- {stats["total_hits"]} hits, {stats["total_misses"]} misses')
+    if clear:
+        result_cache.clear()
+        print('--- Cache cleared.')
+    print('\n')
+
 
 ### Conversion ###
 @cli.command('convert_rhd_to_mat',
-             help='Converts RHD files to mat files using RHD to MAT converter (needs MATLAB installed')
+             help='Converts RHD files to mat files using the native RHD reader (or the RHD to MAT converter written in MATLAB if --use_matlab is set)')
 @click.option('--folder_path', '-f',
               help='Path to folder containing RHD files', required=True, type=str)
 @click.option('--output_mat_file', '-o', help='Path to output mat file',
               required=True, type=str, default='output.mat', show_default=True)
 @click.option('--ds_factor', '-d', help='Downsample factor',
               required=False, type=int, default=1, show_default=True)
+@click.option('--use_matlab', '-um', help='Use the RHD to MAT converter written in MATLAB (needs MATLAB installed)',
+              required=False, type=bool, default=False, show_default=True, is_flag=True)
+@click.option('--chunk_size', '-cs', help='Maximum number of samples per channel decoded and kept in memory at once',
+              required=False, type=int, default=2**17, show_default=True)
+@click.option('--jobs', '-j', help='Number of RHD files decoded in parallel (one file per worker process). If 0, all CPU cores are used',
+              required=False, type=int, default=1, show_default=True)
 @click.pass_context
 @error_handler
-def convert_rhd_to_mat(ctx, folder_path: str,
-                       output_mat_file: str = 'output.mat', ds_factor: int = 1) -> None:
-    """ Converts RHD files to mat files using RHD to MAT converter written in MATLAB
+def convert_rhd_to_mat(ctx, folder_path: str, output_mat_file: str = 'output.mat', ds_factor: int = 1,
+                       use_matlab: bool = False, chunk_size: int = 2**17, jobs: int = 1) -> None:
+    """ Converts RHD files to mat files
 
         Parameters
         ----------
@@ -66,14 +209,76 @@ def convert_rhd_to_mat(ctx, folder_path: str,
             path to output mat file. If the file already exists, it will be overwritten. If not specified, the default value is 'output.mat'
         ds_factor: int
             downsample factor. If not specified, the default value is 1
+        use_matlab: bool
+            use the RHD to MAT converter written in MATLAB. If not specified, the default value is False and the native Python reader is used
+        chunk_size: int
+            maximum number of samples per channel decoded and kept in memory at once. If not specified, the default value is 131072
+        jobs: int
+            number of RHD files decoded in parallel (one file per worker process). If 0, all CPU cores are used. If not specified, the default value is 1
 
         Returns
         ----------
     """
 
-    Warning('** This command requires MATLAB to be installed on your system.\n')
+    if use_matlab:
+        Warning('** This command requires MATLAB to be installed on your system.\n')
     print('--- Converting RHD files to MAT files...')
-    conversion.convert_rhd_to_mat(folder_path, output_mat_file, ds_factor)
+    conversion.convert_rhd_to_mat(folder_path, output_mat_file, ds_factor, use_matlab, chunk_size, jobs)
+    print('--- Conversion complete.\n\n')
+
+
+@cli.command('convert_rhd_to_npz',
+             help='Converts RHD files to NPZ files (one file per amplifier channel)')
+@click.option('--folder_path', '-f',
+              help='Path to folder containing RHD files', required=True, type=str)
+@click.option('--output_npz_folder', '-o', help='Path to output npz folder',
+              required=True, type=str, default='output_npz', show_default=True)
+@click.option('--ds_factor', '-d', help='Downsample factor',
+              required=False, type=int, default=1, show_default=True)
+@click.option('--notch_filter_freq', '-n', help='Notch filter frequency in Hz',
+              required=False, type=int, default=0, show_default=True)
+@click.option('--chunk_size', '-cs', help='Maximum number of samples per channel decoded and kept in memory at once',
+              required=False, type=int, default=2**17, show_default=True)
+@click.option('--jobs', '-j', help='Number of RHD files decoded in parallel (one file per worker process). If 0, all CPU cores are used',
+              required=False, type=int, default=1, show_default=True)
+@click.option('--output_format', '-of', help='Output format: "npz" (one NPZ file per channel) or "npy" (single memory-mappable NPY store)',
+              required=False, type=click.Choice(['npz', 'npy']), default='npz', show_default=True)
+@click.pass_context
+@error_handler
+def convert_rhd_to_npz(ctx, folder_path: str, output_npz_folder: str = 'output_npz', ds_factor: int = 1,
+                       notch_filter_freq: int = 0, chunk_size: int = 2**17, jobs: int = 1, output_format: str = 'npz') -> None:
+    """ Converts RHD files to NPZ files
+
+        Parameters
+        ----------
+        folder_path: str
+            path to folder containing RHD files
+        output_npz_folder: str
+            path to output npz folder. If the folder already exists, it will be overwritten. If not specified, the default value is 'output_npz'
+        ds_factor: int
+            downsample factor. If not specified, the default value is 1
+        notch_filter_freq: int
+            notch filter frequency in Hz. If not specified, the default value is 0. It should be 0 (no filtering), 50 (Hz), or 60 (Hz)
+        chunk_size: int
+            maximum number of samples per channel decoded and kept in memory at once. If not specified, the default value is 131072
+        jobs: int
+            number of RHD files decoded in parallel (one file per worker process). If 0, all CPU cores are used. If not specified, the default value is 1
+        output_format: str
+            output format: 'npz' (one NPZ file per channel) or 'npy' (single memory-mappable NPY store with data.npy and info.json). If not specified, the default value is 'npz'
+
+        Returns
+        ----------
+    """
+
+    print('--- Converting RHD files to NPZ files...')
+    conversion.convert_rhd_to_npz(
+        folder_path,
+        output_npz_folder,
+        ds_factor,
+        notch_filter_freq,
+        chunk_size,
+        jobs,
+        output_format)
     print('--- Conversion complete.\n\n')
 
 
@@ -85,10 +290,12 @@ def convert_rhd_to_mat(ctx, folder_path: str,
               required=True, type=str, default='output_npz', show_default=True)
 @click.option('--notch_filter_freq', '-n', help='Notch filter frequency in Hz',
               required=False, type=int, default=50, show_default=True)
+@click.option('--output_format', '-of', help='Output format: "npz" (one NPZ file per channel) or "npy" (single memory-mappable NPY store)',
+              required=False, type=click.Choice(['npz', 'npy']), default='npz', show_default=True)
 @click.pass_context
 @error_handler
 def convert_mat_to_npz(ctx, mat_file: str, output_npz_folder: str = 'output_npz',
-                       notch_filter_freq: int = 50) -> None:
+                       notch_filter_freq: int = 50, output_format: str = 'npz') -> None:
     """ Converts MAT files to NPZ files
 
         Parameters
@@ -99,6 +306,8 @@ def convert_mat_to_npz(ctx, mat_file: str, output_npz_folder: str = 'output_npz'
             path to output npz folder. If the folder already exists, it will be overwritten. If not specified, the default value is 'output_npz'
         notch_filter_freq: int
             notch filter frequency in Hz. If not specified, the default value is 50. It should be 0 (no filtering), 50 (Hz), or 60 (Hz)
+        output_format: str
+            output format: 'npz' (one NPZ file per channel) or 'npy' (single memory-mappable NPY store with data.npy and info.json). If not specified, the default value is 'npz'
 
         Returns
         ----------
@@ -108,7 +317,35 @@ def convert_mat_to_npz(ctx, mat_file: str, output_npz_folder: str = 'output_npz'
     conversion.convert_mat_to_npz(
         mat_file,
         output_npz_folder,
-        notch_filter_freq)
+        notch_filter_freq,
+        output_format)
+    print('--- Conversion complete.\n\n')
+
+
+@cli.command('convert_npz_to_npy_store',
+             help='Converts a folder of NPZ files (one file per channel) to a single memory-mappable NPY store')
+@click.option('--input_npz_folder', '-i', help='Path to input npz folder',
+              required=True, type=str)
+@click.option('--output_folder', '-o', help='Path to output NPY store folder',
+              required=True, type=str, default='output_npy', show_default=True)
+@click.pass_context
+@error_handler
+def convert_npz_to_npy_store(ctx, input_npz_folder: str, output_folder: str = 'output_npy') -> None:
+    """ Converts a folder of NPZ files to an NPY store
+
+        Parameters
+        ----------
+        input_npz_folder: str
+            path to input npz folder
+        output_folder: str
+            path to output NPY store folder (data.npy and info.json). If the folder already exists, it will be overwritten. If not specified, the default value is 'output_npy'
+
+        Returns
+        ----------
+    """
+
+    print('--- Converting NPZ files to NPY store...')
+    data_io.convert_npz_folder_to_npy_store(input_npz_folder, output_folder)
     print('--- Conversion complete.\n\n')
 ### Conversion ###
 
@@ -119,10 +356,14 @@ def convert_mat_to_npz(ctx, mat_file: str, output_npz_folder: str = 'output_npz'
               help='Path to input npz folder', required=True, type=str)
 @click.option('--output_npz_folder', '-o', help='Path to output npz folder',
               required=True, type=str, default='output_npz_z_normalized', show_default=True)
+@click.option('--jobs', '-j', help='Number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used',
+              required=False, type=int, default=1, show_default=True)
+@click.option('--chunk_size', '-cs', help='Maximum number of samples per channel read and kept in memory at once',
+              required=False, type=int, default=2**17, show_default=True)
 @click.pass_context
 @error_handler
 def zscore_normalize_npz(ctx, input_npz_folder: str,
-                         output_npz_folder: str = 'output_npz_z_normalized') -> None:
+                         output_npz_folder: str = 'output_npz_z_normalized', jobs: int = 1, chunk_size: int = 2**17) -> None:
     """ Z-score normalizes NPZ files
 
         Parameters
@@ -131,13 +372,17 @@ def zscore_normalize_npz(ctx, input_npz_folder: str,
             path to input npz folder
         output_npz_folder: str
             path to output npz folder. If the folder already exists, it will be overwritten. If not specified, the default value is 'output_npz_z_normalized'
+        jobs: int
+            number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used. If not specified, the default value is 1
+        chunk_size: int
+            maximum number of samples per channel read at once. If not specified, the default value is 131072
 
         Returns
         ----------
     """
 
     print('--- Z-score normalizing NPZ files...')
-    preprocessing.zscore_normalize_npz(input_npz_folder, output_npz_folder)
+    preprocessing.zscore_normalize_npz(input_npz_folder, output_npz_folder, jobs, chunk_size)
     print('--- Normalization complete.\n\n')
 
 
@@ -146,10 +391,14 @@ def zscore_normalize_npz(ctx, input_npz_folder: str,
               help='Path to input npz folder', required=True, type=str)
 @click.option('--output_npz_folder', '-o', help='Path to output npz folder',
               required=True, type=str, default='output_npz_normalized', show_default=True)
+@click.option('--jobs', '-j', help='Number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used',
+              required=False, type=int, default=1, show_default=True)
+@click.option('--chunk_size', '-cs', help='Maximum number of samples per channel read and kept in memory at once',
+              required=False, type=int, default=2**17, show_default=True)
 @click.pass_context
 @error_handler
 def normalize_npz(ctx, input_npz_folder: str,
-                  output_npz_folder: str = 'output_npz_normalized') -> None:
+                  output_npz_folder: str = 'output_npz_normalized', jobs: int = 1, chunk_size: int = 2**17) -> None:
     """ Normalizes NPZ files
 
         Parameters
@@ -158,13 +407,17 @@ def normalize_npz(ctx, input_npz_folder: str,
             path to input npz folder
         output_npz_folder: str
             path to output npz folder. If the folder already exists, it will be overwritten. If not specified, the default value is 'output_npz_normalized'
+        jobs: int
+            number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used. If not specified, the default value is 1
+        chunk_size: int
+            maximum number of samples per channel read at once. If not specified, the default value is 131072
 
         Returns
         ----------
     """
 
     print('--- Normalizing NPZ files...')
-    preprocessing.normalize_npz(input_npz_folder, output_npz_folder)
+    preprocessing.normalize_npz(input_npz_folder, output_npz_folder, jobs, chunk_size)
     print('--- Normalization complete.\n\n')
 
 
@@ -188,10 +441,15 @@ def normalize_npz(ctx, input_npz_folder: str,
               type=int,
               default=None,
               show_default=True)
+@click.option('--method', '-me', help='Common reference of the channels: "mean" (average) or "median". Ignored if --rr_channel is given',
+              required=False, type=click.Choice(['mean', 'median']), default='mean', show_default=True)
+@click.option('--chunk_size', '-cs', help='Maximum number of samples per channel re-referenced and kept in memory at once',
+              required=False, type=int, default=2**17, show_default=True)
 @click.pass_context
 @error_handler
 def re_reference_npz(ctx, input_npz_folder: str, output_npz_folder: str = 'output_npz_avg_rereferenced',
-                     ignore_channels: str = None, rr_channel: int = None) -> None:
+                     ignore_channels: str = None, rr_channel: int = None, method: str = 'mean',
+                     chunk_size: int = 2**17) -> None:
     """ Re-references NPZ files and save them as NPZ files
 
         Parameters
@@ -204,6 +462,10 @@ def re_reference_npz(ctx, input_npz_folder: str, output_npz_folder: str = 'outpu
             list of channels to ignore (e.g EMG, EOG, etc.). If None, then no channels will be ignored. Either a list of channel indexes or a string of channel indexes separated by commas
         rr_channel: int
             channel to re-reference signals to. If None, signals will be re-referenced to the average of all channels. If not specified, the default value is None
+        method: str
+            common reference of the channels, 'mean' or 'median'. If not specified, the default value is 'mean'
+        chunk_size: int
+            maximum number of samples per channel re-referenced at once. If not specified, the default value is 131072
 
         Returns
         ----------
@@ -214,12 +476,63 @@ def re_reference_npz(ctx, input_npz_folder: str, output_npz_folder: str = 'outpu
         input_npz_folder,
         output_npz_folder,
         ignore_channels,
-        rr_channel)
+        rr_channel,
+        method,
+        chunk_size)
     print('--- Re-referencing complete.\n\n')
 ### Preprocessing ###
 
 
 ### Fourier Analysis ###
+@cli.command('welch_psd_from_npz',
+             help='Computes power spectral density with Welch\'s method and saves results as NPZ files (can be plotted with plot_dft)')
+@click.option('--input_npz_folder', '-i',
+              help='Path to input npz folder', required=True, type=str)
+@click.option('--output_npz_folder', '-o', help='Path to output npz folder to save PSD results',
+              required=True, type=str, show_default=True, default='output_npz_psd')
+@click.option('--window_size', '-w',
+              help='Window size in seconds', required=True, type=float)
+@click.option('--overlap', '-ov', help='Overlap in seconds',
+              required=True, type=float)
+@click.option('--window_type', '-wt', help='Window type',
+              required=False, type=str, default='hann', show_default=True)
+@click.option('--confidence', '-c', help='Confidence level of the PSD bounds',
+              required=False, type=float, default=0.95, show_default=True)
+@click.option('--jobs', '-j', help='Number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used',
+              required=False, type=int, default=1, show_default=True)
+@click.pass_context
+@error_handler
+def welch_psd(ctx, input_npz_folder: str, window_size: float, overlap: float, window_type: str = 'hann',
+              output_npz_folder: str = 'output_npz_psd', confidence: float = 0.95, jobs: int = 1) -> None:
+    """ Computes power spectral density with Welch's method and saves results as NPZ files
+
+        Parameters
+        ----------
+        input_npz_folder: str
+            path to input npz folder
+        output_npz_folder: str
+            path to output npz folder to save PSD results. If the folder already exists, it will be overwritten. If not specified, the default value is 'output_npz_psd'
+        window_size: float
+            window size in seconds
+        overlap: float
+            overlap in seconds
+        window_type: str
+            window type. If not specified, the default value is 'hann'. It should be a window type supported by scipy.signal.get_window()
+        confidence: float
+            confidence level of the PSD bounds. If not specified, the default value is 0.95
+        jobs: int
+            number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used. If not specified, the default value is 1
+
+        Returns
+        ----------
+    """
+
+    print('--- Computing Welch PSD and saving results as NPZ files...')
+    fourier_analysis.welch_psd_from_npz(
+        input_npz_folder, output_npz_folder, window_size, overlap, window_type, confidence, n_jobs=jobs)
+    print('--- Welch PSD computation complete.\n\n')
+
+
 @cli.command('stft_numeric_output_from_npz',
              help='Computes STFT and saves results as NPZ files')
 @click.option('--input_npz_folder', '-i',
@@ -232,10 +545,12 @@ def re_reference_npz(ctx, input_npz_folder: str, output_npz_folder: str = 'outpu
               required=True, type=float)
 @click.option('--window_type', '-wt', help='Window type',
               required=False, type=str, default='hann', show_default=True)
+@click.option('--jobs', '-j', help='Number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used',
+              required=False, type=int, default=1, show_default=True)
 @click.pass_context
 @error_handler
 def stft_numeric_output(ctx, input_npz_folder: str, window_size: float, overlap: float,
-                        window_type: str = 'hann', output_npz_folder: str = 'output_npz_normalized') -> None:
+                        window_type: str = 'hann', output_npz_folder: str = 'output_npz_normalized', jobs: int = 1) -> None:
     """ Computes STFT and saves results as NPZ files
 
         Parameters
@@ -250,6 +565,8 @@ def stft_numeric_output(ctx, input_npz_folder: str, window_size: float, overlap:
             overlap in seconds
         window_type: str
             window type. If not specified, the default value is 'hann'. It should be a window type supported by scipy.signal.get_window()
+        jobs: int
+            number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used. If not specified, the default value is 1
 
         Returns
         ----------
@@ -257,7 +574,7 @@ def stft_numeric_output(ctx, input_npz_folder: str, window_size: float, overlap:
 
     print('--- Computing STFT and saving results as NPZ files...')
     fourier_analysis.stft_numeric_output_from_npz(
-        input_npz_folder, output_npz_folder, window_size, overlap, window_type)
+        input_npz_folder, output_npz_folder, window_size, overlap, window_type, n_jobs=jobs)
     print('--- STFT computation complete.\n\n')
 
 
@@ -267,10 +584,21 @@ def stft_numeric_output(ctx, input_npz_folder: str, window_size: float, overlap:
               help='Path to input npz folder', required=True, type=str)
 @click.option('--output_npz_folder', '-o', help='Path to output npz folder to save DFT results',
               required=True, type=str, show_default=True, default='output_npz_dft')
+@click.option('--jobs', '-j', help='Number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used',
+              required=False, type=int, default=1, show_default=True)
+@click.option('--one_sided', '-os', help='Save only the non-negative frequencies (the negative ones of a real signal are redundant)',
+              required=False, type=bool, default=False, show_default=True, is_flag=True)
+@click.option('--output_type', '-ot', help='Save the complex DFT, its magnitude or its power',
+              required=False, type=click.Choice(['complex', 'magnitude', 'power']), default='complex', show_default=True)
+@click.option('--f_min', '-fmin', help='Minimum frequency to save in Hz',
+              required=False, type=float, default=None, show_default=True)
+@click.option('--f_max', '-fmax', help='Maximum frequency to save in Hz',
+              required=False, type=float, default=None, show_default=True)
 @click.pass_context
 @error_handler
 def dft_numeric_output(ctx, input_npz_folder: str,
-                       output_npz_folder: str = 'output_npz_dft') -> None:
+                       output_npz_folder: str = 'output_npz_dft', jobs: int = 1, one_sided: bool = False,
+                       output_type: str = 'complex', f_min: float = None, f_max: float = None) -> None:
     """ Computes DFT and saves results as NPZ files
 
         Parameters
@@ -279,6 +607,16 @@ def dft_numeric_output(ctx, input_npz_folder: str,
             path to input npz folder
         output_npz_folder: str
             path to output npz folder to save DFT results. If the folder already exists, it will be overwritten. If not specified, the default value is 'output_npz_dft'
+        jobs: int
+            number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used. If not specified, the default value is 1
+        one_sided: bool
+            whether only the non-negative frequencies are saved. If not specified, the default value is False
+        output_type: str
+            'complex', 'magnitude' or 'power'. If not specified, the default value is 'complex'
+        f_min: float
+            minimum frequency to save in Hz. If not specified, the lowest frequency is used
+        f_max: float
+            maximum frequency to save in Hz. If not specified, the highest frequency is used
 
         Returns
         ----------
@@ -286,7 +624,8 @@ def dft_numeric_output(ctx, input_npz_folder: str,
 
     print('--- Computing DFT and saving results as NPZ files...')
     fourier_analysis.dft_numeric_output_from_npz(
-        input_npz_folder, output_npz_folder)
+        input_npz_folder, output_npz_folder, n_jobs=jobs, one_sided=one_sided, output_type=output_type,
+        f_min=f_min, f_max=f_max)
     print('--- DFT computation complete.\n\n')
 
 
@@ -312,10 +651,12 @@ def dft_numeric_output(ctx, input_npz_folder: str,
               show_default=True)
 @click.option('--filter_order', '-fo', help='Filter order',
               required=True, type=int, default=2, show_default=True)
+@click.option('--jobs', '-j', help='Number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used',
+              required=False, type=int, default=1, show_default=True)
 @click.pass_context
 @error_handler
 def frequncy_domain_filter(ctx, input_npz_folder: str, output_npz_folder: str = 'output_npz_filtered',
-                           filter_type: str = 'LPF', freq_cutoff: str = None, filter_order: int = 2) -> None:
+                           filter_type: str = 'LPF', freq_cutoff: str = None, filter_order: int = 2, jobs: int = 1) -> None:
     """ Filtering in frequency domain using butterworth filter and saves results as NPZ files
 
         Parameters
@@ -330,6 +671,8 @@ def frequncy_domain_filter(ctx, input_npz_folder: str, output_npz_folder: str =
             frequency cutoff in Hz. If filter_type is LPF or HPF, then freq_cutoff is a single value. If filter_type is BPF, then freq_cutoff is a list of two values. If not specified, the default value is None
         filter_order: int
             filter order. If not specified, the default value is 2
+        jobs: int
+            number of channels processed in parallel (one channel per worker process). If 0, all CPU cores are used. If not specified, the default value is 1
 
         Returns
         ----------
@@ -341,7 +684,7 @@ def frequncy_domain_filter(ctx, input_npz_folder: str, output_npz_folder: str =
         'filter_order': filter_order}
     print('--- Filtering in frequency domain using butterworth filter and saving results as NPZ files...')
     fourier_analysis.butterworth_filtering_from_npz(
-        input_npz_folder, output_npz_folder, filter_args)
+        input_npz_folder, output_npz_folder, filter_args, n_jobs=jobs)
     print('--- Filtering complete.\n\n')
 
 
@@ -827,7 +1170,7 @@ def plot_filter_freq_response(ctx, filter_type: str = 'LPF', freq_cutoff: str =
               required=True, type=int, default=None, show_default=True)
 @click.option('--matrix_whitenning',
               '-mw',
-              help='Matrix whitening boolean. If true, the singular values are divided by n_samples',
+              help='Matrix whitening boolean. If true, the components are scaled to unit variance',
               required=False,
               type=bool,
               default=False,
@@ -836,13 +1179,20 @@ def plot_filter_freq_response(ctx, filter_type: str = 'LPF', freq_cutoff: str =
               '-cl',
               help='List of channels to apply PCA, if None then all of the channels will be applied (e.g. --channels_list "[1,2,3]").',
               required=False,
-              type=list,
+              type=str,
               default=None,
               show_default=True)
+@click.option('--solver', '-s', help='PCA solver: "full" (eigendecomposition) or "randomized" (faster for many channels and few components)',
+              required=False, type=click.Choice(['full', 'randomized']), default='full', show_default=True)
+@click.option('--output_format', '-of', help='Output format: "npz" (one NPZ file per component) or "npy" (single memory-mappable NPY store)',
+              required=False, type=click.Choice(['npz', 'npy']), default='npz', show_default=True)
+@click.option('--chunk_size', '-cs', help='Maximum number of samples per channel read and kept in memory at once',
+              required=False, type=int, default=2**15, show_default=True)
 @click.pass_context
 @error_handler
 def pca_from_npz(ctx, input_npz_folder: str, output_npz_folder: str = 'output_npz_pca',
-                 n_components: int = None, matrix_whitenning: bool = False, channels_list: str = None) -> None:
+                 n_components: int = None, matrix_whitenning: bool = False, channels_list: str = None,
+                 solver: str = 'full', output_format: str = 'npz', chunk_size: int = 2**15) -> None:
     """ Computes PCA from NPZ files
 
         Parameters
@@ -854,9 +1204,15 @@ def pca_from_npz(ctx, input_npz_folder: str, output_npz_folder: str = 'output_np
         n_components: int
             number of components to keep after applying the PCA. If not specified, the default value is None
         matrix_whitenning: bool
-            matrix whitening boolean. If true, the singular values are divided by n_samples. If not specified, the default value is False
+            matrix whitening boolean. If true, the components are scaled to unit variance. If not specified, the default value is False
         channels_list: str
             list of channels to apply PCA. either a string of comma-separated channel numbers or a list of integers. If not specified, the default value is None and all of the channels will be applied.
+        solver: str
+            'full' or 'randomized'. If not specified, the default value is 'full'
+        output_format: str
+            'npz' (one NPZ file per component) or 'npy' (single NPY store). If not specified, the default value is 'npz'
+        chunk_size: int
+            maximum number of samples per channel read at once. If not specified, the default value is 32768
 
         Returns
         ----------
@@ -868,7 +1224,10 @@ def pca_from_npz(ctx, input_npz_folder: str, output_npz_folder: str = 'output_np
         output_npz_folder,
         n_components,
         matrix_whitenning,
-        channels_list)
+        channels_list,
+        solver,
+        output_format,
+        chunk_size)
     print('--- PCA computation complete.\n\n')
 ### Dimensionality Reduction ###
 
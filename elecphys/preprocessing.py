@@ -1,18 +1,24 @@
 import os
 import numpy as np
-from scipy import signal
 from tqdm import tqdm
+from functools import lru_cache
 import utils
 import data_io
+import cache
+# only needed by the notch filters
+signal = utils.lazy_import('scipy.signal')
+
+# default number of samples per channel processed at once by the chunked functions
+DEFAULT_CHUNK_SIZE = 2**17
 
 
 def apply_notch(_signal_chan: np.ndarray, _args: dict) -> np.ndarray:
-    """ Applies notch filter to given signal
+    """ Applies notch filter (f0 and its harmonics below 300 Hz) to given signal, with zero phase (forward and backward pass)
 
         Parameters
         ----------
         _signal_chan: np.ndarray
-            signal channel
+            signal channel, or several channels. Shape: (num_samples,) or (num_channels, num_samples)
         _args: dict
             dictionary containing notch filter parameters
 
@@ -21,15 +27,109 @@ def apply_notch(_signal_chan: np.ndarray, _args: dict) -> np.ndarray:
         _signal_chan: np.ndarray
             signal channel with notch filter applied
     """
-    for f0 in np.arange(_args['f0'], 300, _args['f0']):
-        b_notch, a_notch = signal.iirnotch(f0, _args['Q'], _args['fs'])
-        _signal_chan = signal.filtfilt(b_notch, a_notch, _signal_chan)
-    return _signal_chan
+    sos = design_notch_sos(_args['fs'], _args['f0'], _args['Q'])
+    if sos.shape[0] == 0:
+        # no harmonic below 300 Hz and the Nyquist frequency
+        return _signal_chan
+    return signal.sosfiltfilt(sos, _signal_chan, axis=-1)
+
+
+def design_notch_sos(fs: float, f0: float, Q: float) -> np.ndarray:
+    """ Designs a cascade of notch filters at f0 and its harmonics below 300 Hz, as second-order sections
+
+        Parameters
+        ----------
+        fs: float
+            sampling frequency (Hz)
+        f0: float
+            notch filter base frequency (Hz)
+        Q: float
+            quality factor of each notch filter
+
+        Returns
+        ----------
+        sos: np.ndarray
+            second-order sections of the cascaded notch filters. Shape: (num_harmonics, 6), with num_harmonics = 0 if f0 is not below 300 Hz and the Nyquist frequency
+    """
+    # the design is cached, as it is the same for all channels and files
+    return _design_notch_sos(float(fs), float(f0), float(Q)).copy()
+
+
+@lru_cache(maxsize=None)
+def _design_notch_sos(fs: float, f0: float, Q: float) -> np.ndarray:
+    """ Designs the notch filters of design_notch_sos(), cached for each (fs, f0, Q)
+
+        Parameters
+        ----------
+        fs: float
+            sampling frequency (Hz)
+        f0: float
+            notch filter base frequency (Hz)
+        Q: float
+            quality factor of each notch filter
+
+        Returns
+        ----------
+        sos: np.ndarray
+            second-order sections of the cascaded notch filters. Shape: (num_harmonics, 6)
+    """
+    sos = []
+    for f_harmonic in np.arange(f0, 300, f0):
+        if f_harmonic >= fs / 2:
+            break
+        b_notch, a_notch = signal.iirnotch(f_harmonic, Q, fs)
+        sos.append(signal.tf2sos(b_notch, a_notch))
+    if len(sos) == 0:
+        return np.empty((0, 6))
+    return np.concatenate(sos, axis=0)
+
+
+class StreamingNotchFilter:
+    """ Causal notch filter (f0 and its harmonics below 300 Hz) that can be applied chunk by chunk, carrying the filter state over between chunks
+
+        Parameters
+        ----------
+        fs: float
+            sampling frequency (Hz)
+        f0: float
+            notch filter base frequency (Hz)
+        Q: float
+            quality factor of each notch filter
+
+        Returns
+        ----------
+    """
+
+    def __init__(self, fs: float, f0: float, Q: float = 60):
+        self.sos = design_notch_sos(fs, f0, Q)
+        self.zi = None
+
+    def filter(self, chunk: np.ndarray) -> np.ndarray:
+        """ Filters the next chunk of the signal
+
+        Parameters
+            ----------
+            chunk: np.ndarray
+                next chunk of the signal. Shape: (num_channels, num_samples)
+
+        Returns
+            ----------
+            chunk_filtered: np.ndarray
+                filtered chunk. Shape: (num_channels, num_samples)
+        """
+        if chunk.shape[-1] == 0 or self.sos.shape[0] == 0:
+            return chunk
+        if self.zi is None:
+            # start from the steady state of the first sample to avoid a step transient
+            zi = signal.sosfilt_zi(self.sos)
+            self.zi = zi[:, np.newaxis, :] * chunk[np.newaxis, :, 0, np.newaxis]
+        chunk_filtered, self.zi = signal.sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return chunk_filtered
 
 
 def zscore_normalize_npz(input_npz_folder: str,
-                         output_npz_folder: str) -> None:
-    """ Z-score normalizes NPZ files
+                         output_npz_folder: str, n_jobs: int = 1, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """ Z-score normalizes NPZ files. Each channel is read twice chunk by chunk (once for its mean and standard deviation, once to normalize it), so memory usage does not grow with the recording length
 
         Parameters
         ----------
@@ -37,30 +137,17 @@ def zscore_normalize_npz(input_npz_folder: str,
             path to input npz folder
         output_npz_folder: str
             path to output npz folder
+        n_jobs: int
+            number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
+        chunk_size: int
+            maximum number of samples read at once
 
         Returns
         ----------
     """
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
-
     print(
         f'Z-score normalizing NPZ files in {input_npz_folder} and saving to {output_npz_folder}...')
-    for npz_file in tqdm(os.listdir(input_npz_folder)):
-        if npz_file.endswith('.npz'):
-            npz_file_path = os.path.join(input_npz_folder, npz_file)
-            npz_file_contents = np.load(npz_file_path)
-            data = npz_file_contents['data']
-            fs = npz_file_contents['fs']
-            data_zscore = zscore_normalize(data)
-            np.savez(
-                os.path.join(
-                    output_npz_folder,
-                    npz_file),
-                data=data_zscore,
-                fs=fs)
+    _normalize_npz_folder(input_npz_folder, output_npz_folder, 'zscore_normalize', n_jobs, chunk_size)
 
 
 def zscore_normalize(data: np.ndarray) -> np.ndarray:
@@ -80,8 +167,9 @@ def zscore_normalize(data: np.ndarray) -> np.ndarray:
     return data_zscore
 
 
-def normalize_npz(input_npz_folder: str, output_npz_folder: str) -> None:
-    """ Normalizes NPZ files
+def normalize_npz(input_npz_folder: str, output_npz_folder: str, n_jobs: int = 1,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """ Normalizes NPZ files. Each channel is read twice chunk by chunk (once for its maximum absolute value, once to normalize it), so memory usage does not grow with the recording length
 
         Parameters
         ----------
@@ -89,30 +177,17 @@ def normalize_npz(input_npz_folder: str, output_npz_folder: str) -> None:
             path to input npz folder
         output_npz_folder: str
             path to output npz folder
+        n_jobs: int
+            number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
+        chunk_size: int
+            maximum number of samples read at once
 
         Returns
         ----------
     """
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
-
     print(
         f'Normalizing NPZ files in {input_npz_folder} and saving to {output_npz_folder}...')
-    for npz_file in tqdm(os.listdir(input_npz_folder)):
-        if npz_file.endswith('.npz'):
-            npz_file_path = os.path.join(input_npz_folder, npz_file)
-            npz_file_contents = np.load(npz_file_path)
-            data = npz_file_contents['data']
-            fs = npz_file_contents['fs']
-            data_normalized = normalize(data)
-            np.savez(
-                os.path.join(
-                    output_npz_folder,
-                    npz_file),
-                data=data_normalized,
-                fs=fs)
+    _normalize_npz_folder(input_npz_folder, output_npz_folder, 'normalize', n_jobs, chunk_size)
 
 
 def normalize(data: np.ndarray) -> np.ndarray:
@@ -132,9 +207,119 @@ def normalize(data: np.ndarray) -> np.ndarray:
     return data_normalized
 
 
+class RunningStatistics:
+    """ Mean, standard deviation and maximum absolute value of a signal, updated chunk by chunk in a single pass. The mean and variance are accumulated with Welford's algorithm, merging whole chunks at once (Chan et al.), which is as accurate as np.mean() and np.std() on the whole signal
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+    """
+
+    def __init__(self):
+        self.num_samples = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max_abs = 0.0
+
+    def update(self, chunk: np.ndarray) -> None:
+        """ Adds a chunk of samples to the statistics
+
+        Parameters
+            ----------
+            chunk: np.ndarray
+                chunk of samples
+
+        Returns
+            ----------
+        """
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.size == 0:
+            return
+        chunk_mean = np.mean(chunk)
+        chunk_m2 = np.sum(np.square(chunk - chunk_mean))
+        num_samples = self.num_samples + chunk.size
+        delta = chunk_mean - self.mean
+        self.mean += delta * chunk.size / num_samples
+        self.m2 += chunk_m2 + delta ** 2 * self.num_samples * chunk.size / num_samples
+        self.num_samples = num_samples
+        self.max_abs = max(self.max_abs, float(np.max(np.abs(chunk))))
+
+    @property
+    def std(self) -> float:
+        """ Standard deviation (same as np.std(), with ddof=0) """
+        return float(np.sqrt(self.m2 / self.num_samples))
+
+
+def _normalize_npz_folder(input_npz_folder: str, output_npz_folder: str, method: str, n_jobs: int,
+                          chunk_size: int) -> None:
+    """ Normalizes all channels of a folder in parallel, skipping the channels whose output is up to date. Used by zscore_normalize_npz() and normalize_npz()
+
+        Parameters
+        ----------
+        input_npz_folder: str
+            path to input npz folder
+        output_npz_folder: str
+            path to output npz folder
+        method: str
+            'zscore_normalize' (see zscore_normalize()) or 'normalize' (see normalize())
+        n_jobs: int
+            number of channels processed in parallel (one channel per worker process). If None, 0 or negative, all CPU cores are used
+        chunk_size: int
+            maximum number of samples read at once
+
+        Returns
+        ----------
+    """
+    data_io.make_output_folder(output_npz_folder)
+
+    args_list = [(input_npz_folder, npz_file, output_npz_folder, method, chunk_size)
+                 for npz_file in data_io.list_channel_files(input_npz_folder)]
+    if data_io.is_memory_folder(input_npz_folder) or data_io.is_memory_folder(output_npz_folder):
+        # in-memory folders are not shared with worker processes and cannot be cached or fingerprinted
+        utils.run_jobs(_normalize_npz_file, args_list, 1)
+        return
+    cache.run_jobs(_normalize_npz_file, args_list, n_jobs, method,
+                   [cache.channel_input_files(input_npz_folder, args[1]) for args in args_list],
+                   [[args[1]] for args in args_list],
+                   [os.path.join(output_npz_folder, args[1]) for args in args_list])
+
+
+def _normalize_npz_file(args: tuple) -> None:
+    """ Normalizes one channel and saves it with the same file name. Worker of _normalize_npz_folder()
+
+        Parameters
+        ----------
+        args: tuple
+            (input_npz_folder, npz_file, output_npz_folder, method, chunk_size)
+
+        Returns
+        ----------
+    """
+    input_npz_folder, npz_file, output_npz_folder, method, chunk_size = args
+    # only chunk_size samples are read from disk at once
+    data, fs = data_io.open_channel(input_npz_folder, npz_file)
+    statistics = RunningStatistics()
+    for start_sample in range(0, len(data), chunk_size):
+        statistics.update(data[start_sample:start_sample + chunk_size])
+    if method == 'zscore_normalize':
+        offset, scale = statistics.mean, statistics.std
+    else:
+        offset, scale = 0.0, statistics.max_abs
+    if data_io.is_memory_folder(output_npz_folder):
+        data_io.save_channel(output_npz_folder, npz_file, (data - offset) / scale, fs)
+        return
+    with data_io.NpzStreamWriter(output_npz_folder, 1, len(data), fs, utils.get_dtype(), [npz_file]) as writer:
+        for start_sample in range(0, len(data), chunk_size):
+            chunk = np.asarray(data[start_sample:start_sample + chunk_size], dtype=np.float64)
+            writer.write(((chunk - offset) / scale)[np.newaxis, :])
+
+
 def re_reference_npz(input_npz_folder: str, output_npz_folder: str, ignore_channels: [
-                     list, str] = None, rr_channel: int = None) -> None:
-    """ re-references NPZ files
+                     list, str] = None, rr_channel: int = None, method: str = 'mean',
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """ re-references NPZ files. The channels are read, re-referenced and written chunk by chunk (all channels at once), so memory usage does not grow with the recording length
 
         Parameters
         ----------
@@ -145,26 +330,79 @@ def re_reference_npz(input_npz_folder: str, output_npz_folder: str, ignore_chann
         ignore_channels: list, str
             list of channels to be ignored. Either a list of channel indexes or a string of channel indexes separated by commas. If None, no channels will be ignored
         rr_channel: int
-            channel to be used as reference. If None, average re-referencing will be used
+            channel to be used as reference. If None, the common average (or median) of the channels is used
+        method: str
+            'mean' (default) for common average re-referencing or 'median' for common median re-referencing. Ignored if rr_channel is given
+        chunk_size: int
+            maximum number of samples per channel re-referenced at once
 
         Returns
         ----------
     """
-    if not os.path.exists(output_npz_folder):
-        os.makedirs(output_npz_folder)
-    else:
-        Warning(f'{output_npz_folder} already exists. Files will be overwritten.')
+    check_re_reference_method(method)
+    data_io.make_output_folder(output_npz_folder)
+
+    # every output depends on all channels
+    manifest = cache.get_manifest(output_npz_folder, input_npz_folder)
+    if manifest is not None:
+        provenance = manifest.provenance(
+            're_reference', cache.folder_input_files(input_npz_folder), [ignore_channels, rr_channel, method])
+        if manifest.is_folder_up_to_date(provenance):
+            print(f'Re-referenced NPZ files in {output_npz_folder} are up to date.')
+            return
 
     print(
-        f'Average re-referencing NPZ files in {input_npz_folder} and saving to {output_npz_folder}...')
-    data_all, fs, _ = data_io.load_all_npz_files(input_npz_folder)
-    data_all_rereferenced = re_reference(data_all, ignore_channels, rr_channel)
-    data_io.write_separate_npz_files(
-        data_all_rereferenced, fs, output_npz_folder)
+        f'Re-referencing NPZ files in {input_npz_folder} and saving to {output_npz_folder}...')
+    num_channels, num_samples, fs = data_io.get_npz_folder_info(input_npz_folder)
+    chunks = iter_re_referenced_chunks(input_npz_folder, ignore_channels, rr_channel, method, chunk_size)
+    if data_io.is_memory_folder(output_npz_folder):
+        # the output is kept in memory anyway
+        data_all_rereferenced = np.empty((num_channels, num_samples), dtype=utils.get_dtype())
+        start_sample = 0
+        for chunk in chunks:
+            data_all_rereferenced[:, start_sample:start_sample + chunk.shape[1]] = chunk
+            start_sample += chunk.shape[1]
+        data_io.write_separate_npz_files(data_all_rereferenced, fs, output_npz_folder)
+        return
+    with data_io.NpzStreamWriter(output_npz_folder, num_channels, num_samples, fs, utils.get_dtype()) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    if manifest is not None:
+        manifest.record([os.path.join(output_npz_folder, f'Ch{ch_indx+1}.npz')
+                         for ch_indx in range(num_channels)], provenance)
+
+
+def iter_re_referenced_chunks(input_npz_folder: str, ignore_channels: [list, str] = None, rr_channel: int = None,
+                              method: str = 'mean', chunk_size: int = DEFAULT_CHUNK_SIZE) -> np.ndarray:
+    """ Reads and re-references the channels of a folder chunk by chunk (see re_reference())
+
+        Parameters
+        ----------
+        input_npz_folder: str
+            path to input npz folder or NPY store folder
+        ignore_channels: list, str
+            list of channels to be ignored. Either a list of channel indexes or a string of channel indexes separated by commas. If None, no channels will be ignored
+        rr_channel: int
+            channel to be used as reference. If None, the common average (or median) of the channels is used
+        method: str
+            'mean' (default) or 'median'. Ignored if rr_channel is given
+        chunk_size: int
+            maximum number of samples per channel in a chunk
+
+        Returns
+        ----------
+        generator of chunks: np.ndarray
+            re-referenced chunks, in the floating point type of utils.get_dtype(). Shape: (num_channels, num_chunk_samples)
+    """
+    _, num_samples, _ = data_io.get_npz_folder_info(input_npz_folder)
+    for chunk in tqdm(data_io.iter_channel_chunks(input_npz_folder, chunk_size),
+                      total=-(-num_samples // chunk_size)):
+        _subtract_reference(chunk, ignore_channels, rr_channel, method)
+        yield chunk
 
 
 def re_reference(data: np.ndarray, ignore_channels: [
-                 list, str] = None, rr_channel: int = None) -> np.ndarray:
+                 list, str] = None, rr_channel: int = None, method: str = 'mean') -> np.ndarray:
     """ Average re-references data
 
         Parameters
@@ -175,12 +413,23 @@ def re_reference(data: np.ndarray, ignore_channels: [
             list of channels to be ignored. Either a list of channel indexes or a string of channel indexes separated by commas. If None, no channels will be ignored
         rr_channel: int
             channel to be used as reference. If None, average re-referencing will be used
+        method: str
+            'mean' (default) for common average re-referencing or 'median' for common median re-referencing. Ignored if rr_channel is given
 
         Returns
         ----------
         data_rereferenced: numpy.ndarray
             re-referenced data. Shape: (n_channels, n_samples)
     """
+    check_re_reference_method(method)
+    data_rereferenced = data.copy()
+    _subtract_reference(data_rereferenced, ignore_channels, rr_channel, method)
+    return data_rereferenced
+
+
+def _subtract_reference(data: np.ndarray, ignore_channels: [list, str] = None, rr_channel: int = None,
+                        method: str = 'mean') -> None:
+    """ Re-references data in place (see re_reference()). The reference is subtracted by broadcasting, without repeating it for every channel """
     ignore_channels = utils.convert_string_to_list(ignore_channels)
     if ignore_channels is not None:
         ignore_channels = [i - 1 for i in ignore_channels]
@@ -189,14 +438,32 @@ def re_reference(data: np.ndarray, ignore_channels: [
                 data.shape[0]) if i not in ignore_channels]
     else:
         channels_list = [i for i in range(data.shape[0])]
-    rr_channel = rr_channel - 1 if rr_channel is not None else None
-    data_rereferenced = data.copy()
+    if len(channels_list) == data.shape[0]:
+        selected_data = data
+    else:
+        selected_data = data[channels_list, :]
     if rr_channel is not None:
-        reference = data[rr_channel, :].reshape(1, -1)
-        data_rereferenced[channels_list, :] = data[channels_list,
-                                                   :] - np.repeat(reference, len(channels_list), axis=0)
+        # copied, since the reference channel is re-referenced too
+        reference = data[rr_channel - 1, :].copy()
+    elif method == 'median':
+        reference = np.median(selected_data, axis=0)
     else:
-        reference = np.mean(data[channels_list, :], axis=0).reshape(1, -1)
-        data_rereferenced[channels_list, :] = data[channels_list,
-                                                   :] - np.repeat(reference, len(channels_list), axis=0)
-    return data_rereferenced
+        reference = np.mean(selected_data, axis=0)
+    selected_data -= reference
+    if selected_data is not data:
+        data[channels_list, :] = selected_data
+
+
+def check_re_reference_method(method: str) -> None:
+    """ Checks the re-referencing method
+
+        Parameters
+        ----------
+        method: str
+            'mean' or 'median'
+
+        Returns
+        ----------
+    """
+    if method not in ['mean', 'median']:
+        raise ValueError('Re-referencing method must be either "mean" or "median"')
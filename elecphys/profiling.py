@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import utils
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# profiles of the commands run in this process, in order ('records'), I/O counters of the command being profiled
+# ('io_state', None if no command is profiled) and cProfile profiler enabled while commands are profiled ('cprofile',
+# see enable_cprofile()), shared by the elecphys.profiling and profiling module objects
+_state = utils.shared_state('profiling', '_state', {'records': [], 'io_state': None, 'cprofile': None})
+
+
+def is_enabled() -> bool:
+    """ Checks whether the commands of the command line interface are profiled (global option --profile, or environment variable ELECPHYS_PROFILE=True)
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        enabled: bool
+            whether profiling is enabled
+    """
+    return os.environ.get('ELECPHYS_PROFILE') == 'True'
+
+
+def is_memory_traced() -> bool:
+    """ Checks whether the memory allocations of profiled commands are traced with tracemalloc (global option --profile_memory, or environment variable ELECPHYS_PROFILE_MEMORY=True). Tracing slows down commands that allocate many small Python objects, so it is off by default
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        traced: bool
+            whether memory allocations are traced
+    """
+    return os.environ.get('ELECPHYS_PROFILE_MEMORY') == 'True'
+
+
+@contextmanager
+def profile_command(name: str, trace_memory: bool = None):
+    """ Profiles the code run in the with block: wall time, CPU time (including the one of finished worker processes), peak resident set size, peak memory allocated by Python and numpy if trace_memory is True, bytes and samples read and written through data_io, and the time spent reading and writing files. The I/O of the worker processes of utils.parallel_imap() is counted too, and their I/O times are added up, so the I/O time can be larger than the wall time with several workers. The profile is added to get_records()
+
+        Parameters
+        ----------
+        name: str
+            name of the profiled command or stage
+        trace_memory: bool
+            whether memory allocations are traced with tracemalloc, which slows down the profiled code. If None, is_memory_traced() is used
+
+        Returns
+        ----------
+    """
+    if trace_memory is None:
+        trace_memory = is_memory_traced()
+    io_state = _new_io_state()
+    outer_io_state, _state['io_state'] = _state['io_state'], io_state
+    was_tracing = tracemalloc.is_tracing()
+    if trace_memory and not was_tracing:
+        tracemalloc.start()
+    elif trace_memory and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    start_times = os.times()
+    start_time = time.perf_counter()
+    if _state['cprofile'] is not None:
+        _state['cprofile'].enable()
+    try:
+        yield
+    finally:
+        if _state['cprofile'] is not None:
+            _state['cprofile'].disable()
+        wall_time = time.perf_counter() - start_time
+        end_times = os.times()
+        peak_traced_memory = tracemalloc.get_traced_memory()[1] / 2**20 if trace_memory else None
+        if trace_memory and not was_tracing:
+            tracemalloc.stop()
+        _state['io_state'] = outer_io_state
+        # user and system time of this process and of its finished children
+        cpu_time = sum(end_times[:4]) - sum(start_times[:4])
+        _state['records'].append({'command': name,
+                         'wall_time_s': wall_time,
+                         'cpu_time_s': cpu_time,
+                         'io_time_s': io_state['time'],
+                         'compute_time_s': max(wall_time - io_state['time'], 0.0),
+                         'peak_traced_memory_mb': peak_traced_memory,
+                         'peak_rss_mb': peak_rss_mb(),
+                         'bytes_read': io_state['bytes_read'],
+                         'bytes_written': io_state['bytes_written'],
+                         'samples_read': io_state['samples_read'],
+                         'samples_per_s': io_state['samples_read'] / wall_time if wall_time > 0 else 0.0})
+
+
+@contextmanager
+def io_time():
+    """ Counts the time spent in the with block as I/O time of the profiled command. Nested blocks are only counted once. Does nothing if no command is profiled
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+    """
+    io_state = _state['io_state']
+    if io_state is None:
+        yield
+        return
+    io_state['depth'] += 1
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        io_state['depth'] -= 1
+        if io_state['depth'] == 0:
+            io_state['time'] += time.perf_counter() - start_time
+
+
+def is_counting() -> bool:
+    """ Checks whether a command is being profiled in this process, so that the I/O of its worker processes has to be counted too (see call_counted())
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        counting: bool
+            whether a command is being profiled
+    """
+    return _state['io_state'] is not None
+
+
+def call_counted(func_args: tuple) -> tuple:
+    """ Calls a function in a worker process and counts its I/O, so that it can be added to the profiled command of the parent process with add_io_counts(). Used by utils.parallel_imap()
+
+        Parameters
+        ----------
+        func_args: tuple
+            (func, args), where func is a module-level (picklable) function taking one argument
+
+        Returns
+        ----------
+        result: any
+            func(args)
+        io_counts: dict
+            time spent reading and writing files, samples and bytes read and bytes written by func(args)
+    """
+    func, args = func_args
+    outer_io_state, _state['io_state'] = _state['io_state'], _new_io_state()
+    try:
+        result = func(args)
+        return result, {key: _state['io_state'][key] for key in ['time', 'samples_read', 'bytes_read', 'bytes_written']}
+    finally:
+        _state['io_state'] = outer_io_state
+
+
+def add_io_counts(io_counts: dict) -> None:
+    """ Adds the I/O counted in a worker process (see call_counted()) to the profiled command
+
+        Parameters
+        ----------
+        io_counts: dict
+            counts returned by call_counted()
+
+        Returns
+        ----------
+    """
+    if _state['io_state'] is not None:
+        for key, value in io_counts.items():
+            _state['io_state'][key] += value
+
+
+def _new_io_state() -> dict:
+    """ Creates the I/O counters of a profiled command """
+    return {'depth': 0, 'time': 0.0, 'samples_read': 0, 'bytes_read': 0, 'bytes_written': 0}
+
+
+def count_read(data: np.ndarray) -> None:
+    """ Counts the samples and bytes of a signal read from a file or an in-memory folder. Reads nested in another counted read (e.g. the channels read by load_all_npz_files()) are not counted again
+
+        Parameters
+        ----------
+        data: np.ndarray
+            signal that was read
+
+        Returns
+        ----------
+    """
+    if _state['io_state'] is not None and _state['io_state']['depth'] <= 1:
+        _state['io_state']['samples_read'] += data.size
+        _state['io_state']['bytes_read'] += data.nbytes
+
+
+def count_written(*arrays) -> None:
+    """ Counts the bytes of arrays written to a file
+
+        Parameters
+        ----------
+        *arrays: np.ndarray
+            arrays that were written (other values are ignored)
+
+        Returns
+        ----------
+    """
+    if _state['io_state'] is not None and _state['io_state']['depth'] <= 1:
+        _state['io_state']['bytes_written'] += sum(array.nbytes for array in arrays if isinstance(array, np.ndarray))
+
+
+def peak_rss_mb() -> float:
+    """ Gets the peak resident set size of this process since it started, or of its largest finished worker process if it is larger, or None if it is not available (Windows)
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        peak_rss: float
+            peak resident set size (MB)
+    """
+    if resource is None:
+        return None
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, kilobytes on Linux
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+def enable_cprofile() -> None:
+    """ Runs cProfile while commands are profiled, so that their function-level statistics can be saved with dump_cprofile()
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+    """
+    if _state['cprofile'] is None:
+        _state['cprofile'] = cProfile.Profile()
+
+
+def dump_cprofile(output_file: str) -> None:
+    """ Saves the cProfile statistics of the profiled commands (see enable_cprofile()), to be read with pstats or snakeviz
+
+        Parameters
+        ----------
+        output_file: str
+            path to output .prof file
+
+        Returns
+        ----------
+    """
+    if _state['cprofile'] is None:
+        raise ValueError('cProfile is not enabled. Call enable_cprofile() before profiling commands')
+    _state['cprofile'].dump_stats(output_file)
+
+
+def get_records() -> list:
+    """ Gets the profiles of the commands run in this process (see profile_command())
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        records: list
+            one dict per command, in the order the commands ran
+    """
+    return list(_state['records'])
+
+
+def clear_records() -> None:
+    """ Removes the profiles of the commands run so far
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+    """
+    _state['records'].clear()
+
+
+def save_json(output_file: str) -> None:
+    """ Saves the profiles of the commands run in this process to a JSON file
+
+        Parameters
+        ----------
+        output_file: str
+            path to output JSON file
+
+        Returns
+        ----------
+    """
+    with open(output_file, 'w') as fp:
+        json.dump({'commands': _state['records']}, fp, indent=4)
+
+
+def print_summary() -> None:
+    """ Prints a table of the profiles of the commands run in this process, with their total if there are several
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+    """
+    rows = [_summary_row(record['command'], record) for record in _state['records']]
+    if len(_state['records']) > 1:
+        total = {key: sum(record[key] for record in _state['records']) for key in
+                 ['wall_time_s', 'cpu_time_s', 'io_time_s', 'compute_time_s', 'bytes_read', 'bytes_written',
+                  'samples_read']}
+        traced_memory = [record['peak_traced_memory_mb'] for record in _state['records']
+                         if record['peak_traced_memory_mb'] is not None]
+        total['peak_traced_memory_mb'] = max(traced_memory) if len(traced_memory) > 0 else None
+        total['peak_rss_mb'] = _state['records'][-1]['peak_rss_mb']
+        total['samples_per_s'] = total['samples_read'] / total['wall_time_s'] if total['wall_time_s'] > 0 else 0.0
+        rows.append(_summary_row('total', total))
+    header = ['command', 'wall (s)', 'CPU (s)', 'I/O (s)', 'compute (s)', 'peak mem (MB)', 'peak RSS (MB)',
+              'read (MB)', 'written (MB)', 'samples/s']
+    widths = [max(len(row[column]) for row in [header] + rows) for column in range(len(header))]
+    print('--- Profile:')
+    for row in [header] + rows:
+        print('  '.join([row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]))
+    print('\n')
+
+
+def _summary_row(name: str, record: dict) -> list:
+    """ Formats the cells of a row of print_summary() """
+    return [name,
+            f'{record["wall_time_s"]:.3f}',
+            f'{record["cpu_time_s"]:.3f}',
+            f'{record["io_time_s"]:.3f}',
+            f'{record["compute_time_s"]:.3f}',
+            '-' if record['peak_traced_memory_mb'] is None else f'{record["peak_traced_memory_mb"]:.1f}',
+            '-' if record['peak_rss_mb'] is None else f'{record["peak_rss_mb"]:.1f}',
+            f'{record["bytes_read"] / 2**20:.1f}',
+            f'{record["bytes_written"] / 2**20:.1f}',
+            f'{record["samples_per_s"]:.3g}']
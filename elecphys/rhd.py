@@ -0,0 +1,394 @@
+import os
+import struct
+import numpy as np
+
+
+RHD_MAGIC_NUMBER = 0xc6912702
+AMPLIFIER_SCALE = 0.195  # microvolts per bit
+AMPLIFIER_OFFSET = 32768
+
+
+def _read(fid, fmt: str):
+    """ Reads one little-endian value from a binary file
+
+        Parameters
+        ----------
+        fid: file object
+            binary file opened for reading
+        fmt: str
+            struct format character of the value (e.g. 'h', 'I', 'f')
+
+        Returns
+        ----------
+        value: int, float
+            value read from the file
+    """
+    size = struct.calcsize('<' + fmt)
+    return struct.unpack('<' + fmt, fid.read(size))[0]
+
+
+def read_qstring(fid) -> str:
+    """ Reads a Qt style QString from a binary file
+
+        Parameters
+        ----------
+        fid: file object
+            binary file opened for reading
+
+        Returns
+        ----------
+        string: str
+            decoded string. Empty if the QString is null
+    """
+    length = _read(fid, 'I')
+    if length == 0xffffffff:
+        return ''
+    return fid.read(length).decode('utf-16-le')
+
+
+def read_rhd_header(fid) -> dict:
+    """ Reads the header of an Intan Technologies RHD2000 data file
+
+        Parameters
+        ----------
+        fid: file object
+            RHD file opened in binary mode, positioned at the beginning of the file
+
+        Returns
+        ----------
+        header: dict
+            dictionary containing the header information. The file object is left positioned at the first data block, which is stored in header['header_size']
+    """
+    magic_number = _read(fid, 'I')
+    if magic_number != RHD_MAGIC_NUMBER:
+        raise ValueError('Unrecognized file type. File is not an RHD2000 data file.')
+
+    header = {}
+    header['version'] = (_read(fid, 'h'), _read(fid, 'h'))
+    main_version, secondary_version = header['version']
+    header['num_samples_per_data_block'] = 60 if main_version == 1 else 128
+
+    header['sample_rate'] = _read(fid, 'f')
+    header['dsp_enabled'] = _read(fid, 'h')
+    header['actual_dsp_cutoff_frequency'] = _read(fid, 'f')
+    header['actual_lower_bandwidth'] = _read(fid, 'f')
+    header['actual_upper_bandwidth'] = _read(fid, 'f')
+    header['desired_dsp_cutoff_frequency'] = _read(fid, 'f')
+    header['desired_lower_bandwidth'] = _read(fid, 'f')
+    header['desired_upper_bandwidth'] = _read(fid, 'f')
+    notch_filter_mode = _read(fid, 'h')
+    header['notch_filter_frequency'] = {1: 50, 2: 60}.get(notch_filter_mode, 0)
+    header['desired_impedance_test_frequency'] = _read(fid, 'f')
+    header['actual_impedance_test_frequency'] = _read(fid, 'f')
+    header['notes'] = [read_qstring(fid) for _ in range(3)]
+
+    header['num_temp_sensor_channels'] = 0
+    if (main_version == 1 and secondary_version >= 1) or main_version > 1:
+        header['num_temp_sensor_channels'] = _read(fid, 'h')
+    header['board_mode'] = 0
+    if (main_version == 1 and secondary_version >= 3) or main_version > 1:
+        header['board_mode'] = _read(fid, 'h')
+    header['reference_channel'] = ''
+    if main_version > 1:
+        header['reference_channel'] = read_qstring(fid)
+
+    channel_types = ['amplifier_channels', 'aux_input_channels', 'supply_voltage_channels',
+                     'board_adc_channels', 'board_dig_in_channels', 'board_dig_out_channels']
+    for channel_type in channel_types:
+        header[channel_type] = []
+
+    number_of_signal_groups = _read(fid, 'h')
+    for signal_group in range(1, number_of_signal_groups + 1):
+        signal_group_name = read_qstring(fid)
+        signal_group_prefix = read_qstring(fid)
+        signal_group_enabled = _read(fid, 'h')
+        signal_group_num_channels = _read(fid, 'h')
+        _read(fid, 'h')  # number of amplifier channels in the group
+        if signal_group_num_channels <= 0 or signal_group_enabled <= 0:
+            continue
+        for _ in range(signal_group_num_channels):
+            channel = {'port_name': signal_group_name,
+                       'port_prefix': signal_group_prefix,
+                       'port_number': signal_group}
+            channel['native_channel_name'] = read_qstring(fid)
+            channel['custom_channel_name'] = read_qstring(fid)
+            channel['native_order'] = _read(fid, 'h')
+            channel['custom_order'] = _read(fid, 'h')
+            signal_type = _read(fid, 'h')
+            channel_enabled = _read(fid, 'h')
+            channel['chip_channel'] = _read(fid, 'h')
+            channel['board_stream'] = _read(fid, 'h')
+            # spike trigger settings: voltage_trigger_mode, voltage_threshold, digital_trigger_channel, digital_edge_polarity
+            fid.read(4 * 2)
+            channel['electrode_impedance_magnitude'] = _read(fid, 'f')
+            channel['electrode_impedance_phase'] = _read(fid, 'f')
+            if channel_enabled:
+                if signal_type not in range(len(channel_types)):
+                    raise ValueError(f'Unknown channel type: {signal_type}')
+                header[channel_types[signal_type]].append(channel)
+
+    header['header_size'] = fid.tell()
+    return header
+
+
+def rhd_block_dtype(header: dict) -> np.dtype:
+    """ Builds the structured dtype of one RHD data block
+
+        Parameters
+        ----------
+        header: dict
+            RHD header as returned by read_rhd_header()
+
+        Returns
+        ----------
+        block_dtype: np.dtype
+            structured dtype describing the byte layout of a single data block
+    """
+    main_version, secondary_version = header['version']
+    n = header['num_samples_per_data_block']
+    if (main_version == 1 and secondary_version >= 2) or main_version > 1:
+        timestamp_type = '<i4'
+    else:
+        timestamp_type = '<u4'
+    fields = [('timestamps', timestamp_type, (n,))]
+    if len(header['amplifier_channels']) > 0:
+        fields.append(('amplifier', '<u2', (len(header['amplifier_channels']), n)))
+    if len(header['aux_input_channels']) > 0:
+        fields.append(('aux_input', '<u2', (len(header['aux_input_channels']), n // 4)))
+    if len(header['supply_voltage_channels']) > 0:
+        fields.append(('supply_voltage', '<u2', (len(header['supply_voltage_channels']),)))
+    if header['num_temp_sensor_channels'] > 0:
+        fields.append(('temp_sensor', '<i2', (header['num_temp_sensor_channels'],)))
+    if len(header['board_adc_channels']) > 0:
+        fields.append(('board_adc', '<u2', (len(header['board_adc_channels']), n)))
+    if len(header['board_dig_in_channels']) > 0:
+        fields.append(('board_dig_in', '<u2', (n,)))
+    if len(header['board_dig_out_channels']) > 0:
+        fields.append(('board_dig_out', '<u2', (n,)))
+    return np.dtype(fields)
+
+
+def open_rhd_file(rhd_file: str) -> [dict, np.memmap]:
+    """ Opens an RHD file and memory-maps its data blocks
+
+        Parameters
+        ----------
+        rhd_file: str
+            path to RHD file
+
+        Returns
+        ----------
+        header: dict
+            RHD header as returned by read_rhd_header(), with the extra keys 'num_data_blocks', 'first_timestamp' and 'last_timestamp' (None if the file has no data)
+        blocks: np.memmap
+            read-only structured array of data blocks. Shape: (num_data_blocks,)
+    """
+    with open(rhd_file, 'rb') as fid:
+        header = read_rhd_header(fid)
+    block_dtype = rhd_block_dtype(header)
+    bytes_remaining = os.path.getsize(rhd_file) - header['header_size']
+    header['num_data_blocks'] = bytes_remaining // block_dtype.itemsize
+    header['first_timestamp'] = None
+    header['last_timestamp'] = None
+    if header['num_data_blocks'] == 0:
+        return header, np.zeros((0,), dtype=block_dtype)
+    blocks = np.memmap(rhd_file, dtype=block_dtype, mode='r',
+                       offset=header['header_size'], shape=(header['num_data_blocks'],))
+    header['first_timestamp'] = int(blocks[0]['timestamps'][0])
+    header['last_timestamp'] = int(blocks[-1]['timestamps'][-1])
+    return header, blocks
+
+
+def amplifier_data_from_blocks(blocks: np.ndarray) -> np.ndarray:
+    """ Converts raw amplifier samples of RHD data blocks to microvolts
+
+        Parameters
+        ----------
+        blocks: np.ndarray
+            structured array of data blocks, as returned by open_rhd_file()
+
+        Returns
+        ----------
+        amplifier_data: np.ndarray
+            amplifier data in microvolts. Shape: (num_amplifier_channels, num_blocks * num_samples_per_data_block)
+    """
+    raw = blocks['amplifier']
+    raw = raw.transpose(1, 0, 2).reshape(raw.shape[1], -1)
+    return AMPLIFIER_SCALE * (raw.astype(np.float64) - AMPLIFIER_OFFSET)
+
+
+def timestamps_from_blocks(blocks: np.ndarray) -> np.ndarray:
+    """ Extracts amplifier timestamps (in samples) from RHD data blocks
+
+        Parameters
+        ----------
+        blocks: np.ndarray
+            structured array of data blocks, as returned by open_rhd_file()
+
+        Returns
+        ----------
+        timestamps: np.ndarray
+            amplifier timestamps in samples. Shape: (num_blocks * num_samples_per_data_block,)
+    """
+    return blocks['timestamps'].reshape(-1).astype(np.int64)
+
+
+def load_rhd_file(rhd_file: str) -> [np.ndarray, np.ndarray, dict]:
+    """ Loads amplifier data and timestamps from an RHD file
+
+        Parameters
+        ----------
+        rhd_file: str
+            path to RHD file
+
+        Returns
+        ----------
+        amplifier_data: np.ndarray
+            amplifier data in microvolts. Shape: (num_amplifier_channels, num_samples)
+        timestamps: np.ndarray
+            amplifier timestamps in samples. Shape: (num_samples,)
+        header: dict
+            RHD header as returned by open_rhd_file()
+    """
+    header, blocks = open_rhd_file(rhd_file)
+    if 'amplifier' not in blocks.dtype.names:
+        raise ValueError(f'{rhd_file} does not contain any amplifier channels')
+    amplifier_data = amplifier_data_from_blocks(blocks)
+    timestamps = timestamps_from_blocks(blocks)
+    del blocks
+    return amplifier_data, timestamps, header
+
+
+def list_rhd_files(folder_path: str) -> list:
+    """ Lists RHD files in a folder, in the same order as MATLAB's dir()
+
+        Parameters
+        ----------
+        folder_path: str
+            path to folder containing RHD files
+
+        Returns
+        ----------
+        rhd_files: list
+            sorted list of paths to RHD files
+    """
+    file_names = sorted(file_name for file_name in os.listdir(folder_path)
+                        if file_name.lower().endswith('.rhd'))
+    if len(file_names) == 0:
+        raise FileNotFoundError(f'No RHD files found in {folder_path}')
+    return [os.path.join(folder_path, file_name) for file_name in file_names]
+
+
+def iter_rhd_chunks(rhd_file: str, chunk_size: int) -> [np.ndarray, np.ndarray]:
+    """ Iterates over the amplifier data of an RHD file in chunks of data blocks
+
+        Parameters
+        ----------
+        rhd_file: str
+            path to RHD file
+        chunk_size: int
+            maximum number of samples per channel in each chunk. It is rounded down to a whole number of data blocks (at least one block)
+
+        Returns
+        ----------
+        generator of (amplifier_data, timestamps):
+            amplifier_data: np.ndarray
+                amplifier data of the chunk in microvolts. Shape: (num_amplifier_channels, num_chunk_samples)
+            timestamps: np.ndarray
+                amplifier timestamps of the chunk in samples. Shape: (num_chunk_samples,)
+    """
+    header, blocks = open_rhd_file(rhd_file)
+    if 'amplifier' not in blocks.dtype.names:
+        raise ValueError(f'{rhd_file} does not contain any amplifier channels')
+    chunk_blocks = max(1, int(chunk_size) // header['num_samples_per_data_block'])
+    for block_start in range(0, header['num_data_blocks'], chunk_blocks):
+        chunk = blocks[block_start:block_start + chunk_blocks]
+        yield amplifier_data_from_blocks(chunk), timestamps_from_blocks(chunk)
+
+
+def read_rhd_folder_info(folder_path: str) -> [list, list]:
+    """ Reads the headers of all RHD files in a folder without reading their data, and sorts the files by their first amplifier timestamp
+
+        Parameters
+        ----------
+        folder_path: str
+            path to folder containing RHD files
+
+        Returns
+        ----------
+        rhd_files: list
+            list of paths to RHD files, in timestamp order (files with equal timestamps keep their name order)
+        headers: list
+            list of RHD headers (as returned by open_rhd_file()) in the same order as rhd_files
+    """
+    rhd_files = list_rhd_files(folder_path)
+    headers = []
+    for rhd_file in rhd_files:
+        header, blocks = open_rhd_file(rhd_file)
+        del blocks
+        headers.append(header)
+    sample_rates = set(header['sample_rate'] for header in headers)
+    num_channels = set(len(header['amplifier_channels']) for header in headers)
+    if len(sample_rates) > 1 or len(num_channels) > 1:
+        raise ValueError(f'All RHD files in {folder_path} must have the same sampling rate and number of amplifier channels')
+    # files without data have no timestamp and keep their place at the end
+    order = sorted(range(len(rhd_files)), key=lambda i: (headers[i]['first_timestamp'] is None,
+                                                         headers[i]['first_timestamp'] or 0, i))
+    rhd_files = [rhd_files[i] for i in order]
+    headers = [headers[i] for i in order]
+    return rhd_files, headers
+
+
+def check_timestamps_continuity(rhd_files: list, headers: list) -> [int, int]:
+    """ Checks that consecutive RHD files continue each other's amplifier timestamps and prints a warning for every gap or overlap between files
+
+        Parameters
+        ----------
+        rhd_files: list
+            list of paths to RHD files, in the order they will be concatenated
+        headers: list
+            list of RHD headers (as returned by open_rhd_file()) in the same order as rhd_files
+
+        Returns
+        ----------
+        num_gaps: int
+            number of file boundaries where samples are missing
+        num_overlaps: int
+            number of file boundaries where timestamps are repeated
+    """
+    num_gaps = 0
+    num_overlaps = 0
+    for file_indx in range(1, len(headers)):
+        previous_timestamp = headers[file_indx - 1]['last_timestamp']
+        next_timestamp = headers[file_indx]['first_timestamp']
+        if previous_timestamp is None or next_timestamp is None:
+            continue
+        step = next_timestamp - previous_timestamp
+        if step > 1:
+            num_gaps += 1
+            print(f'Warning: {step - 1} missing samples between {os.path.basename(rhd_files[file_indx - 1])} and {os.path.basename(rhd_files[file_indx])}. Time scale will not be uniform!')
+        elif step < 1:
+            num_overlaps += 1
+            print(f'Warning: {1 - step} overlapping samples between {os.path.basename(rhd_files[file_indx - 1])} and {os.path.basename(rhd_files[file_indx])}.')
+    return num_gaps, num_overlaps
+
+
+def count_timestamp_gaps(timestamps: np.ndarray, previous_timestamp: int = None) -> int:
+    """ Counts the gaps in a sequence of amplifier timestamps, i.e. consecutive timestamps that do not increase by exactly one sample
+
+        Parameters
+        ----------
+        timestamps: np.ndarray
+            amplifier timestamps in samples
+        previous_timestamp: int
+            timestamp preceding the first element of timestamps (e.g. the last timestamp of the previous chunk). If None, it is not taken into account
+
+        Returns
+        ----------
+        num_gaps: int
+            number of gaps
+    """
+    num_gaps = int(np.count_nonzero(np.diff(timestamps) != 1))
+    if previous_timestamp is not None and len(timestamps) > 0 and timestamps[0] - previous_timestamp != 1:
+        num_gaps += 1
+    return num_gaps
@@ -1,5 +1,11 @@
+import os
 import re
+import sys
+import importlib.util
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from tqdm import tqdm
 
 
 def get_matlab_engine():
@@ -23,6 +29,55 @@ def get_matlab_engine():
     return matlab.engine.start_matlab()
 
 
+def lazy_import(module_name: str):
+    """Imports a module lazily: it is only loaded the first time one of its attributes is used, so that importing a module does not pay for the libraries (e.g. matplotlib or scipy) that only some of its functions need
+
+        Parameters
+        ----------
+        module_name: str
+            name of the module, e.g. 'scipy.signal'
+
+        Returns
+        ----------
+        module: module
+            module, loaded on first attribute access (or already loaded if it was imported before)
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.find_spec(module_name)
+    if spec is None:
+        raise ImportError(f'No module named {module_name}')
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def shared_state(module_name: str, name: str, default):
+    """Gets the module-level state of an elecphys module, shared by its two module objects: the modules of the package import each other as top-level modules (e.g. data_io), so importing elecphys.data_io loads a second data_io module object, whose state would otherwise be separate
+
+        Parameters
+        ----------
+        module_name: str
+            name of the module without the package, e.g. 'data_io'
+        name: str
+            name of the module-level variable holding the state
+        default: any
+            initial state, used if no module object of module_name defines name yet. It has to be mutable (e.g. a dict), as reassigning the variable would only change one module object
+
+        Returns
+        ----------
+        state: any
+            state of the module object that was loaded first, or default
+    """
+    for loaded_name in [module_name, f'elecphys.{module_name}']:
+        module = sys.modules.get(loaded_name)
+        if module is not None and hasattr(module, name):
+            return getattr(module, name)
+    return default
+
+
 def sort_file_names(file_names: list) -> list:
     """Sorts file names in ascending order
 
@@ -144,3 +199,125 @@ def check_freq_bands(freq_bands: list, fs: int) -> list:
                 f'Invalid frequency band: {freq_band}. Both elements should be smaller than half of sampling frequency (fs={fs}Hz).')
 
     return freq_bands
+
+
+def get_n_jobs(n_jobs: int = 1) -> int:
+    """ Resolves the number of parallel jobs
+
+        Parameters
+        ----------
+        n_jobs: int
+            number of parallel jobs. If None, 0 or negative, all CPU cores are used
+
+        Returns
+        ----------
+        n_jobs: int
+            number of parallel jobs (at least 1)
+    """
+    if n_jobs is None or n_jobs <= 0:
+        return os.cpu_count() or 1
+    return int(n_jobs)
+
+
+def get_dtype() -> np.dtype:
+    """ Gets the floating point type signals are loaded, processed and saved in, set with set_dtype() (or the --dtype option of the command line interface). Stored in the environment variable ELECPHYS_DTYPE, so that worker processes use it too
+
+        Parameters
+        ----------
+
+        Returns
+        ----------
+        dtype: numpy.dtype
+            numpy.float32 or numpy.float64 (default)
+    """
+    return np.dtype(os.environ.get('ELECPHYS_DTYPE', 'float64'))
+
+
+def set_dtype(dtype) -> None:
+    """ Sets the floating point type signals are loaded, processed and saved in. float32 halves the memory and disk footprint and speeds up filtering and Fourier transforms, with a relative error around 1e-6
+
+        Parameters
+        ----------
+        dtype: str or numpy.dtype
+            'float32' or 'float64'
+
+        Returns
+        ----------
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError('dtype must be float32 or float64')
+    os.environ['ELECPHYS_DTYPE'] = dtype.name
+
+
+def parallel_imap(func, args_list: list, n_jobs: int = 1):
+    """ Applies a function to every element of a list in a process pool and yields the results in the order of the list
+
+        Parameters
+        ----------
+        func: function
+            module-level (picklable) function taking one argument
+        args_list: list
+            list (or iterable, which is then consumed lazily) of arguments to be passed to func
+        n_jobs: int
+            number of worker processes. If 1, func is called in the current process. If None, 0 or negative, all CPU cores are used
+
+        Returns
+        ----------
+        generator of results:
+            func(args) for every args in args_list, in order. At most 2 * n_jobs results are computed ahead of the consumer
+    """
+    n_jobs = get_n_jobs(n_jobs)
+    if hasattr(args_list, '__len__'):
+        n_jobs = min(n_jobs, max(len(args_list), 1))
+    if n_jobs == 1:
+        for args in args_list:
+            yield func(args)
+        return
+
+    # the I/O of the workers is counted in the profile of the command (see profiling.profile_command()). profiling
+    # imports utils, hence the import here
+    import profiling
+    counting = profiling.is_counting()
+
+    def submit(args):
+        if counting:
+            return executor.submit(profiling.call_counted, (func, args))
+        return executor.submit(func, args)
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = deque()
+        args_iterator = iter(args_list)
+        for args in args_iterator:
+            pending.append(submit(args))
+            if len(pending) >= 2 * n_jobs:
+                break
+        while pending:
+            result = pending.popleft().result()
+            if counting:
+                result, io_counts = result
+                profiling.add_io_counts(io_counts)
+            for args in args_iterator:
+                pending.append(submit(args))
+                break
+            yield result
+
+
+def run_jobs(func, args_list: list, n_jobs: int = 1) -> list:
+    """ Runs a function on every element of a list in a process pool (see parallel_imap()), with a progress bar
+
+        Parameters
+        ----------
+        func: function
+            module-level (picklable) function taking one argument
+        args_list: list
+            list of arguments to be passed to func, one per job
+        n_jobs: int
+            number of worker processes. If 1, the jobs run in the current process. If None, 0 or negative, all CPU cores are used
+
+        Returns
+        ----------
+        results: list
+            func(args) for every args in args_list, in order
+    """
+    return list(tqdm(parallel_imap(func, args_list, n_jobs), total=len(args_list)))
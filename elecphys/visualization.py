@@ -242,9 +242,7 @@ def plot_signals_from_npz(
         ----------
     """
 
-    npz_files = os.listdir(npz_folder_path)
-    # remove non-NPZ files
-    npz_files = utils.sort_file_names(npz_files)
+    npz_files = data_io.list_channel_files(npz_folder_path)
     channels_list = utils.convert_string_to_list(channels_list)
     if channels_list is None:
         channels_list = tuple(range(1, len(npz_files) + 1))
@@ -267,8 +265,14 @@ def plot_signals_from_npz(
     else:
         ax = fig.subplots(len(channels_list), 1, sharex=True)
 
-    data_all, fs, channels_map = data_io.load_all_npz_files(npz_folder_path, channels_list=channels_list)
-    t = np.arange(0, data_all.shape[1] / fs, 1 / fs)
+    # only the samples in [t_min, t_max] are read
+    _, num_samples, fs = data_io.get_npz_folder_info(npz_folder_path)
+    start_sample, stop_sample = data_io.time_to_sample_range(fs, num_samples, t_min, t_max)
+    if stop_sample == start_sample:
+        raise ValueError(f'Invalid time interval: [{t_min}, {t_max}]. No samples in this interval.')
+    data_all, fs, channels_map = data_io.load_all_npz_files(
+        npz_folder_path, channels_list=channels_list, start_sample=start_sample, stop_sample=stop_sample)
+    t = (start_sample + np.arange(data_all.shape[1])) / fs
     if t_min is None:
         t_min = np.min(t)
     if t_max is None:
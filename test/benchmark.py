@@ -0,0 +1,318 @@
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import matplotlib
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+matplotlib.use('Agg')
+import numpy as np
+import elecphys.conversion as conversion
+import elecphys.preprocessing as preprocessing
+import elecphys.fourier_analysis as fourier_analysis
+import elecphys.visualization as visualization
+import elecphys.data_io as data_io
+import elecphys.cfc as cfc
+import elecphys.cache as cache
+
+# synthetic recordings: number of channels, sampling frequency (Hz) and duration (s)
+PRESETS = {'quick': {'num_channels': 32, 'fs': 20000, 'duration': 10},
+           'minutes': {'num_channels': 64, 'fs': 30000, 'duration': 300},
+           'high_density': {'num_channels': 256, 'fs': 30000, 'duration': 120},
+           'hour': {'num_channels': 32, 'fs': 20000, 'duration': 3600}}
+HISTORY_FILE = os.path.join(os.path.dirname(__file__), 'benchmark_history.jsonl')
+# minimum number of timed runs of the startup benchmarks, whose times of a few hundred milliseconds vary more between runs
+STARTUP_REPEAT = 10
+FREQ_BANDS = [[1, 4], [4, 8], [8, 12], [30, 80]]
+FREQS_PHASE = np.arange(4, 13, 2)
+FREQS_AMP = np.arange(30, 121, 10)
+
+
+def write_synthetic_mat(mat_file, num_channels, fs, duration, seed=0, chunk_duration=10):
+    """ Writes a synthetic recording chunk by chunk: a common theta rhythm whose phase modulates the amplitude of gamma oscillations, 50 Hz line noise, channel offsets and white noise """
+    rng = np.random.default_rng(seed)
+    num_samples = int(fs * duration)
+    offsets = rng.normal(0, 100, size=(num_channels, 1))
+    gains = rng.uniform(0.5, 1.5, size=(num_channels, 1))
+    with data_io.MatStreamWriter(mat_file, num_channels, num_samples, fs) as writer:
+        for start_sample in range(0, num_samples, int(fs * chunk_duration)):
+            t = np.arange(start_sample, min(start_sample + int(fs * chunk_duration), num_samples)) / fs
+            theta = np.sin(2 * np.pi * 8 * t)
+            gamma = (1 + theta) * np.sin(2 * np.pi * 60 * t)
+            chunk = gains * (20 * theta + 5 * gamma) + 10 * np.sin(2 * np.pi * 50 * t) + offsets
+            writer.write(chunk + rng.normal(0, 5, size=chunk.shape))
+
+
+def setup_convert_mat_to_npz(recording):
+    return lambda: conversion.convert_mat_to_npz(recording['mat_file'], recording['npz_folder'], 50)
+
+
+def setup_load_all_npz_files(recording):
+    return lambda: data_io.load_all_npz_files(recording['npz_folder'])
+
+
+def setup_re_reference(recording):
+    data, _, _ = data_io.load_all_npz_files(recording['npz_folder'], t_max=recording['window'])
+    return lambda: preprocessing.re_reference(data)
+
+
+def setup_stft_from_array(recording):
+    data, fs, _ = data_io.load_all_npz_files(recording['npz_folder'], channels_list=[1])
+    return lambda: fourier_analysis.stft_from_array(data[0], fs, 1, 0.5)
+
+
+def setup_freq_bands_power_over_time(recording):
+    return lambda: fourier_analysis.freq_bands_power_over_time(
+        recording['npz_folder'], FREQ_BANDS, output_plot_file=os.path.join(recording['folder'], 'power.png'),
+        plot_type='avg')
+
+
+def setup_calc_tf_mvl(recording):
+    data, fs, _ = data_io.load_all_npz_files(recording['npz_folder'], channels_list=[1], t_max=recording['window'])
+    return lambda: cfc.calc_tf_mvl(data[0], fs, FREQS_PHASE, FREQS_AMP)
+
+
+def setup_cfc_mi(recording):
+    data, fs, _ = data_io.load_all_npz_files(recording['npz_folder'], channels_list=[1], t_max=recording['window'])
+    return lambda: cfc.cfc_mi(data[0], FREQS_PHASE, FREQS_AMP, fs)
+
+
+def setup_plot_signal(recording):
+    return lambda: visualization.plot_signals_from_npz(
+        recording['npz_folder'], os.path.join(recording['folder'], 'signal.png'), 0, recording['window'],
+        '[1,2,3,4,5,6,7,8]')
+
+
+def setup_plot_stft(recording):
+    data, fs, _ = data_io.load_all_npz_files(recording['npz_folder'], channels_list=[1], t_max=recording['window'])
+    f, t, Zxx = fourier_analysis.stft_from_array(data[0], fs, 1, 0.5)
+    Zxx = 10 * np.log10(np.abs(Zxx) + np.finfo(np.float64).tiny)
+    return lambda: visualization.plot_stft_from_array(
+        Zxx, t, f, 0, 200, 0, recording['window'], np.min(Zxx), np.max(Zxx), os.path.join(recording['folder'], 'stft.png'))
+
+
+def setup_plot_dft(recording):
+    dft_folder = os.path.join(recording['folder'], 'npz_dft')
+    fourier_analysis.dft_numeric_output_from_npz(recording['npz_folder'], dft_folder)
+    return lambda: visualization.plot_dft_from_npz(
+        dft_folder, os.path.join(recording['folder'], 'dft.png'), 0, 200, 'average_of_channels')
+
+
+def setup_plot_mvl(recording):
+    data, fs, _ = data_io.load_all_npz_files(recording['npz_folder'], channels_list=[1], t_max=recording['window'])
+    MI_mat = cfc.calc_tf_mvl(data[0], fs, FREQS_PHASE, FREQS_AMP)
+    return lambda: visualization.plot_mvl_form_array(
+        MI_mat, FREQS_PHASE, FREQS_AMP, figure_save_path=os.path.join(recording['folder'], 'mvl.png'))
+
+
+def setup_cli_help(recording):
+    command = [sys.executable, '-m', 'elecphys.main', '--help']
+    repository_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    return lambda: subprocess.run(command, cwd=repository_folder, capture_output=True, check=True)
+
+
+# startup time of the command line interface, which does not need a recording
+STARTUP_BENCHMARKS = {'cli_help': setup_cli_help}
+# run in this order: convert_mat_to_npz writes the NPZ files the other benchmarks read
+BENCHMARKS = {'convert_mat_to_npz': setup_convert_mat_to_npz,
+              'load_all_npz_files': setup_load_all_npz_files,
+              're_reference': setup_re_reference,
+              'stft_from_array': setup_stft_from_array,
+              'freq_bands_power_over_time': setup_freq_bands_power_over_time,
+              'calc_tf_mvl': setup_calc_tf_mvl,
+              'cfc_mi': setup_cfc_mi,
+              'plot_signal': setup_plot_signal,
+              'plot_stft': setup_plot_stft,
+              'plot_dft': setup_plot_dft,
+              'plot_mvl': setup_plot_mvl}
+
+
+def measure(func, repeat, subprocess_memory=False):
+    """ Times func (best and median of repeat runs) and measures its peak memory (Python and numpy allocations, traced in a separate run so that tracing does not slow the timed runs). If subprocess_memory is True, func runs a subprocess, whose allocations are not traced: its peak resident set size is measured instead """
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    if subprocess_memory:
+        return {'time_s': min(times), 'time_median_s': statistics.median(times),
+                'peak_memory_mb': children_peak_rss_mb()}
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'time_s': min(times), 'time_median_s': statistics.median(times), 'peak_memory_mb': peak_memory / 2**20}
+
+
+def children_peak_rss_mb():
+    """ Gets the peak resident set size of the largest finished subprocess, or None if it is not available (Windows). The startup benchmarks run before any other subprocess, so it is the one of their subprocesses """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+def run_benchmarks(parameters, names, repeat, folder):
+    recording = {'folder': folder,
+                 'mat_file': os.path.join(folder, 'synthetic.mat'),
+                 'npz_folder': os.path.join(folder, 'npz'),
+                 'window': min(parameters['window'], parameters['duration'])}
+    results = {}
+    for name, setup in STARTUP_BENCHMARKS.items():
+        if name in names:
+            print(f'--- Benchmarking {name}...')
+            results[name] = measure(setup(recording), max(repeat, STARTUP_REPEAT), subprocess_memory=True)
+            print(f'{name}: {results[name]["time_s"]:.3f} s')
+    if not any(name in BENCHMARKS for name in names):
+        return results
+    print(f'--- Writing a synthetic recording of {parameters["num_channels"]} channels, {parameters["fs"]} Hz, '
+          f'{parameters["duration"]} s...')
+    write_synthetic_mat(recording['mat_file'], parameters['num_channels'], parameters['fs'], parameters['duration'])
+    for name, setup in BENCHMARKS.items():
+        # the NPZ files are needed by all the other benchmarks
+        if name not in names and name != 'convert_mat_to_npz':
+            continue
+        func = setup(recording)
+        if name not in names:
+            func()
+            continue
+        print(f'--- Benchmarking {name}...')
+        results[name] = measure(func, repeat)
+        print(f'{name}: {results[name]["time_s"]:.3f} s, {results[name]["peak_memory_mb"]:.1f} MB')
+    return results
+
+
+def machine_info():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def find_baseline(history, record, baseline_commit=None):
+    """ Finds the latest record of the same parameters on the same machine (and of the given commit, if any) """
+    for old_record in reversed(history):
+        if old_record['parameters'] != record['parameters'] or old_record['machine'] != record['machine']:
+            continue
+        if baseline_commit is not None and not (old_record['commit'] or '').startswith(baseline_commit):
+            continue
+        return old_record
+    return None
+
+
+def compare(record, baseline, time_tolerance, memory_tolerance):
+    """ Prints the change of every benchmark from the baseline and returns the names of the regressed ones. The allowed slowdown of a benchmark is time_tolerance plus its noise, the largest relative difference between the median and the best time of the two runs, so that benchmarks whose times vary between runs of the same code are not reported as regressions """
+    regressions = []
+    print(f'--- Comparison with {baseline["commit"]} ({baseline["timestamp"]}):')
+    for name, result in record['results'].items():
+        if name not in baseline['results']:
+            continue
+        old_result = baseline['results'][name]
+        time_ratio = result['time_s'] / max(old_result['time_s'], 1e-9)
+        noise = max(run['time_median_s'] / max(run['time_s'], 1e-9) - 1 for run in [result, old_result])
+        regressed = time_ratio > 1 + time_tolerance + noise
+        if result['peak_memory_mb'] is not None and old_result['peak_memory_mb'] is not None:
+            memory_ratio = result['peak_memory_mb'] / max(old_result['peak_memory_mb'], 1e-9)
+            regressed = regressed or memory_ratio > 1 + memory_tolerance
+            memory_change = f'x{memory_ratio:.2f}'
+        else:
+            memory_change = 'unknown'
+        print(f'{name}: time x{time_ratio:.2f} (allowed x{1 + time_tolerance + noise:.2f}), peak memory {memory_change}'
+              f'{"  REGRESSION" if regressed else ""}')
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the hot paths of elecphys on a synthetic recording and appends the results to a history file')
+    parser.add_argument('--preset', '-p', choices=PRESETS.keys(), default='quick', help='size of the synthetic recording')
+    parser.add_argument('--num_channels', '-n', type=int, help='number of channels (overrides the preset)')
+    parser.add_argument('--fs', type=int, help='sampling frequency in Hz (overrides the preset)')
+    parser.add_argument('--duration', '-d', type=float, help='duration in seconds (overrides the preset)')
+    parser.add_argument('--window', '-w', type=float, default=2,
+                        help='duration in seconds of the segment used by re_reference, calc_tf_mvl, cfc_mi '
+                        'and the plots of a segment')
+    parser.add_argument('--dtype', '-dt', choices=['float32', 'float64'], default='float64')
+    parser.add_argument('--benchmarks', '-b', nargs='+', choices=list(STARTUP_BENCHMARKS) + list(BENCHMARKS),
+                        default=list(STARTUP_BENCHMARKS) + list(BENCHMARKS))
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='number of timed runs of every benchmark')
+    parser.add_argument('--history', default=HISTORY_FILE, help='JSON Lines file the results are appended to')
+    parser.add_argument('--no_save', action='store_true', help='do not append the results to the history')
+    parser.add_argument('--compare', '-c', action='store_true',
+                        help='compare with the latest results of the same parameters on this machine, '
+                        'and exit with status 1 on regressions')
+    parser.add_argument('--baseline', help='commit (or commit prefix) to compare with instead of the latest results')
+    parser.add_argument('--time_tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown, in addition to the noise of the timed runs')
+    parser.add_argument('--memory_tolerance', type=float, default=0.1, help='allowed relative increase of peak memory')
+    args = parser.parse_args(argv)
+
+    parameters = dict(PRESETS[args.preset])
+    for key in ['num_channels', 'fs', 'duration']:
+        if getattr(args, key) is not None:
+            parameters[key] = getattr(args, key)
+    parameters.update({'window': args.window, 'dtype': args.dtype})
+
+    # results must be computed, not read from the result cache or skipped as up to date
+    os.environ.pop('ELECPHYS_CACHE_DIR', None)
+    os.environ['ELECPHYS_FORCE_RECOMPUTE'] = 'True'
+    os.environ['ELECPHYS_DTYPE'] = args.dtype
+    folder = tempfile.mkdtemp(prefix='elecphys_benchmark_')
+    try:
+        results = run_benchmarks(parameters, args.benchmarks, args.repeat, folder)
+    finally:
+        shutil.rmtree(folder)
+
+    record = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(),
+              'version': cache.package_version(), 'machine': machine_info(), 'parameters': parameters,
+              'results': results}
+    history = load_history(args.history)
+    regressions = []
+    if args.compare:
+        baseline = find_baseline(history, record, args.baseline)
+        if baseline is None:
+            print('--- No results of the same parameters on this machine to compare with.')
+        else:
+            regressions = compare(record, baseline, args.time_tolerance, args.memory_tolerance)
+    if not args.no_save:
+        with open(args.history, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+    if regressions:
+        print(f'--- Regressions: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,13 +3,56 @@ import os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
+import json
 import shutil
+import struct
+import subprocess
 import unittest
+import numpy as np
+from scipy import signal
+import mat73
 import elecphys.conversion as conversion
 import elecphys.preprocessing as preprocessing
 import elecphys.fourier_analysis as fourier_analysis
 import elecphys.visualization as visualization
 import elecphys.data_io as data_io
+import elecphys.cfc as cfc
+import elecphys.dimensionality_reduction as dimensionality_reduction
+import elecphys.profiling as profiling
+
+
+def write_qstring(fid, string):
+    encoded = string.encode('utf-16-le')
+    fid.write(struct.pack('<I', len(encoded)))
+    fid.write(encoded)
+
+
+def write_synthetic_rhd(rhd_file, num_channels=4, num_blocks=20, first_timestamp=0, sample_rate=20000, seed=0):
+    """ Writes a synthetic RHD2000 (v3.0) file with amplifier channels only and returns the raw amplifier samples """
+    num_samples_per_data_block = 128
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(0, 2**16, size=(num_channels, num_blocks * num_samples_per_data_block), dtype=np.uint16)
+    timestamps = np.arange(first_timestamp, first_timestamp + raw.shape[1], dtype=np.int32)
+    with open(rhd_file, 'wb') as fid:
+        fid.write(struct.pack('<Ihh', 0xc6912702, 3, 0))
+        fid.write(struct.pack('<fhffffffhff', sample_rate, 0, 1, 0.1, 7500, 1, 0.1, 7500, 0, 1000, 1000))
+        for note in ['', '', '']:
+            write_qstring(fid, note)
+        fid.write(struct.pack('<hh', 0, 0))
+        write_qstring(fid, 'hardware')
+        fid.write(struct.pack('<h', 1))
+        write_qstring(fid, 'Port A')
+        write_qstring(fid, 'A')
+        fid.write(struct.pack('<hhh', 1, num_channels, num_channels))
+        for ch_num in range(num_channels):
+            write_qstring(fid, f'A-{ch_num:03d}')
+            write_qstring(fid, f'A-{ch_num:03d}')
+            fid.write(struct.pack('<hhhhhhhhhhff', ch_num, ch_num, 0, 1, ch_num, 0, 0, 0, 0, 0, 0, 0))
+        for block in range(num_blocks):
+            block_slice = slice(block * num_samples_per_data_block, (block + 1) * num_samples_per_data_block)
+            fid.write(timestamps[block_slice].tobytes())
+            fid.write(raw[:, block_slice].tobytes())
+    return raw, timestamps
 
 class TestCases_0_autopep8(unittest.TestCase):
     def test_1_autopep8(self):
@@ -25,12 +68,74 @@ class TestCases_0_conversion(unittest.TestCase):
         folder_path = os.path.join(os.path.dirname(__file__), 'data', 'rhd')
         output_mat_file = os.path.join(
             os.path.dirname(__file__), 'data', 'mat', 'sample.mat')
+        output_mat_file_native = os.path.join(
+            os.path.dirname(__file__), 'data', 'mat', 'sample_native.mat')
         for ds_factor in [1, 20]:
-            if os.path.exists(output_mat_file):
-                os.remove(output_mat_file)
+            for mat_file in [output_mat_file, output_mat_file_native]:
+                if os.path.exists(mat_file):
+                    os.remove(mat_file)
             conversion.convert_rhd_to_mat(
-                folder_path, output_mat_file, ds_factor)
+                folder_path, output_mat_file, ds_factor, use_matlab=True)
             self.assertTrue(os.path.exists(output_mat_file))
+            # the native decoder gives the same file as convertRHD2Mat.m
+            conversion.convert_rhd_to_mat(folder_path, output_mat_file_native, ds_factor)
+            mat_file_contents = mat73.loadmat(output_mat_file)
+            mat_file_contents_native = mat73.loadmat(output_mat_file_native)
+            self.assertTrue(np.array_equal(mat_file_contents['data'], mat_file_contents_native['data']))
+            self.assertEqual(mat_file_contents['fs'], mat_file_contents_native['fs'])
+        os.remove(output_mat_file_native)
+
+        os.remove(output_mat_file)
+        command_prompt = f'python3 -m elecphys.main convert_rhd_to_mat --folder_path {folder_path} --output_mat_file {output_mat_file} --ds_factor {ds_factor}'
+        for _ in range(2):
+            os.system(command_prompt)
+        self.assertTrue(os.path.exists(output_mat_file))
+
+    def test_1_rhd_to_mat_native(self):
+        folder_path = os.path.join(os.path.dirname(__file__), 'data', 'rhd_synthetic')
+        output_mat_file = os.path.join(os.path.dirname(__file__), 'data', 'mat_synthetic', 'synthetic.mat')
+        if os.path.exists(folder_path):
+            shutil.rmtree(folder_path)
+        os.makedirs(folder_path)
+        raw_all = []
+        for file_num in range(3):
+            raw, _ = write_synthetic_rhd(os.path.join(folder_path, f'recording_{file_num}.rhd'),
+                                         first_timestamp=file_num * 20 * 128, seed=file_num)
+            raw_all.append(raw)
+        for ds_factor in [1, 20]:
+            if os.path.exists(output_mat_file):
+                os.remove(output_mat_file)
+            conversion.convert_rhd_to_mat(folder_path, output_mat_file, ds_factor)
+            mat_file_contents = mat73.loadmat(output_mat_file)
+            expected = np.concatenate([0.195 * (raw[:, ::ds_factor].astype(float) - 32768) for raw in raw_all], axis=1)
+            self.assertTrue(np.array_equal(mat_file_contents['data'], expected))
+            self.assertEqual(mat_file_contents['fs'], 20000 / ds_factor)
+            # files decoded in parallel are streamed in order
+            os.remove(output_mat_file)
+            conversion.convert_rhd_to_mat(folder_path, output_mat_file, ds_factor, chunk_size=1000, n_jobs=2)
+            self.assertTrue(np.array_equal(mat73.loadmat(output_mat_file)['data'], expected))
+            # the MAT file has its manifest next to it
+            self.assertTrue(os.path.exists(f'{output_mat_file}.manifest.json'))
+
+        output_npz_folder = os.path.join(os.path.dirname(__file__), 'data', 'npz_synthetic')
+        for chunk_size in [128, 1000, 2**17]:
+            if os.path.exists(output_npz_folder):
+                shutil.rmtree(output_npz_folder)
+            conversion.convert_rhd_to_npz(folder_path, output_npz_folder, 8, 50, chunk_size=chunk_size)
+            self.assertEqual(len(data_io.list_channel_files(output_npz_folder)), 4)
+            data, fs = data_io.load_npz(os.path.join(output_npz_folder, 'Ch2.npz'))
+            if chunk_size == 128:
+                data_reference = data
+            self.assertTrue(np.allclose(data, data_reference))
+
+        shutil.rmtree(output_npz_folder)
+        conversion.convert_rhd_to_npz(folder_path, output_npz_folder, 8, 50, chunk_size=1000, n_jobs=2)
+        data, fs = data_io.load_npz(os.path.join(output_npz_folder, 'Ch2.npz'))
+        self.assertTrue(np.allclose(data, data_reference))
+        self.assertEqual(len(data_io.list_channel_files(output_npz_folder)), 4)
+        # the temporary files of the workers are removed
+        self.assertFalse(any(os.path.isdir(os.path.join(output_npz_folder, file_name))
+                             for file_name in os.listdir(output_npz_folder)))
 
         os.remove(output_mat_file)
         command_prompt = f'python3 -m elecphys.main convert_rhd_to_mat --folder_path {folder_path} --output_mat_file {output_mat_file} --ds_factor {ds_factor}'
@@ -59,12 +164,83 @@ class TestCases_0_conversion(unittest.TestCase):
             os.system(command_prompt)
         self.assertTrue(os.path.exists(output_npz_folder))
 
+    def test_3_npy_store(self):
+        mat_file = os.path.join(
+            os.path.dirname(__file__),
+            'data',
+            'mat',
+            'sample.mat')
+        npz_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        npy_store_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npy')
+        if os.path.exists(npy_store_folder):
+            shutil.rmtree(npy_store_folder)
+        conversion.convert_mat_to_npz(
+            mat_file, npy_store_folder, 60, output_format='npy')
+        self.assertTrue(data_io.is_npy_store(npy_store_folder))
+        data_npz, fs_npz, channels_map_npz = data_io.load_all_npz_files(npz_folder)
+        data_npy, fs_npy, channels_map_npy = data_io.load_all_npz_files(npy_store_folder)
+        self.assertIsInstance(data_npy, np.memmap)
+        self.assertTrue(np.array_equal(data_npz, data_npy))
+        self.assertEqual(fs_npz, fs_npy)
+        self.assertEqual(channels_map_npz, channels_map_npy)
+        data_npz, _, channels_map_npz = data_io.load_all_npz_files(npz_folder, ignore_channels=[1, 3])
+        data_npy, _, channels_map_npy = data_io.load_all_npz_files(npy_store_folder, ignore_channels=[1, 3])
+        self.assertTrue(np.array_equal(data_npz, data_npy))
+        self.assertEqual(channels_map_npz, channels_map_npy)
+
+        self.assertEqual(data_io.list_channel_files(npz_folder), data_io.list_channel_files(npy_store_folder))
+        data, fs = data_io.load_channel(npy_store_folder, 'Ch2.npz')
+        self.assertTrue(np.array_equal(data, data_io.load_npz(os.path.join(npz_folder, 'Ch2.npz'))[0]))
+
+        shutil.rmtree(npy_store_folder)
+        command_prompt = f'python3 -m elecphys.main convert_npz_to_npy_store --input_npz_folder {npz_folder} --output_folder {npy_store_folder}'
+        os.system(command_prompt)
+        data_npy, _, _ = data_io.load_all_npz_files(npy_store_folder)
+        self.assertTrue(np.array_equal(data_io.load_all_npz_files(npz_folder)[0], data_npy))
+
+    def test_4_time_window_reads(self):
+        npz_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        npy_store_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npy')
+        data, fs = data_io.open_npz_data(os.path.join(npz_folder, 'Ch3.npz'))
+        self.assertIsInstance(data, np.memmap)
+        self.assertTrue(np.array_equal(data, data_io.load_npz(os.path.join(npz_folder, 'Ch3.npz'))[0]))
+        data_all, fs, _ = data_io.load_all_npz_files(npz_folder, ignore_channels=[2])
+        num_channels, num_samples, fs_info = data_io.get_npz_folder_info(npz_folder)
+        self.assertEqual(num_samples, data_all.shape[1])
+        self.assertEqual(fs, fs_info)
+        for t_min, t_max in [(None, None), (1, 2.5), (0.0005, None), (None, 3)]:
+            start_sample, stop_sample = data_io.time_to_sample_range(fs, num_samples, t_min, t_max)
+            for folder in [npz_folder, npy_store_folder]:
+                data_window, _, _ = data_io.load_all_npz_files(folder, ignore_channels=[2], t_min=t_min, t_max=t_max)
+                self.assertTrue(np.array_equal(data_window, data_all[:, start_sample:stop_sample]))
+                data_window, _, _ = data_io.load_all_npz_files(
+                    folder, ignore_channels=[2], start_sample=start_sample, stop_sample=stop_sample)
+                self.assertTrue(np.array_equal(data_window, data_all[:, start_sample:stop_sample]))
+        with self.assertRaises(ValueError):
+            data_io.load_all_npz_files(npz_folder, start_sample=10, stop_sample=num_samples + 1)
+
+        for t_min, t_max in [(0, num_samples / fs), (1.2, 4.7), (num_samples / fs - 2, num_samples / fs)]:
+            f, t, Zxx = fourier_analysis.stft_from_array(data_all[0], fs, 0.5, 0.2)
+            t_window, start_sample, stop_sample = fourier_analysis.stft_window_sample_range(
+                num_samples, fs, 0.5, 0.2, t_min, t_max)
+            data_window = np.pad(data_all[0, max(start_sample, 0):min(stop_sample, num_samples)],
+                                 (max(-start_sample, 0), max(stop_sample - num_samples, 0)))
+            _, _, Zxx_window = fourier_analysis.stft_from_array(data_window, fs, 0.5, 0.2, boundary=None, padded=False)
+            t0 = np.where(t >= t_min)[0][0]
+            t1 = np.where(t <= t_max)[0][-1]
+            self.assertTrue(np.array_equal(t_window, t[t0:t1 + 1]))
+            self.assertTrue(np.allclose(Zxx_window, Zxx[:, t0:t1 + 1]))
+
 
 class TestCases_1_preprocessing(unittest.TestCase):
     def test_apply_notch(self):
         npz_files_folder = os.path.join(
             os.path.dirname(__file__), 'data', 'npz')
-        npz_files = os.listdir(npz_files_folder)
+        npz_files = data_io.list_channel_files(npz_files_folder)
         npz_file = npz_files[0]
         _signal_chan, fs = data_io.load_npz(
             os.path.join(npz_files_folder, npz_file))
@@ -72,6 +248,28 @@ class TestCases_1_preprocessing(unittest.TestCase):
             _signal_chan, {'Q': 60, 'fs': fs, 'f0': 50})
         self.assertTrue(output.shape == _signal_chan.shape)
 
+        data_all, fs, _ = data_io.load_all_npz_files(npz_files_folder, channels_list=[1, 2, 3])
+        output = preprocessing.apply_notch(
+            data_all, {'Q': 60, 'fs': fs, 'f0': 50})
+        self.assertTrue(output.shape == data_all.shape)
+        for ch_indx in range(data_all.shape[0]):
+            self.assertTrue(np.allclose(output[ch_indx], preprocessing.apply_notch(
+                data_all[ch_indx], {'Q': 60, 'fs': fs, 'f0': 50})))
+
+        t = np.arange(20 * 1000) / 1000
+        sine_50 = np.sin(2 * np.pi * 50 * t)
+        output = preprocessing.apply_notch(
+            np.vstack((sine_50, sine_50 + np.sin(2 * np.pi * 10 * t))), {'Q': 60, 'fs': 1000, 'f0': 50})
+        self.assertLess(np.max(np.abs(output[0, 5000:-5000])), 1e-3)
+        self.assertTrue(np.allclose(output[1, 5000:-5000], np.sin(2 * np.pi * 10 * t[5000:-5000]), atol=1e-2))
+
+        # no harmonic below 300 Hz: the signal is not filtered
+        output = preprocessing.apply_notch(sine_50, {'Q': 30, 'fs': 1000, 'f0': 400})
+        self.assertTrue(np.array_equal(output, sine_50))
+        notch_filter = preprocessing.StreamingNotchFilter(1000, 400, 30)
+        chunk = sine_50[np.newaxis, :1000]
+        self.assertTrue(np.array_equal(notch_filter.filter(chunk), chunk))
+
     def test_zscore_normalize_npz(self):
         npz_files_folder = os.path.join(
             os.path.dirname(__file__), 'data', 'npz')
@@ -81,6 +279,12 @@ class TestCases_1_preprocessing(unittest.TestCase):
             shutil.rmtree(output_npz_folder)
         preprocessing.zscore_normalize_npz(npz_files_folder, output_npz_folder)
         self.assertTrue(os.path.exists(output_npz_folder))
+        data, _ = data_io.load_npz(os.path.join(npz_files_folder, 'Ch3.npz'))
+        # chunked and parallel normalization gives the same result as normalizing the whole channel
+        shutil.rmtree(output_npz_folder)
+        preprocessing.zscore_normalize_npz(npz_files_folder, output_npz_folder, n_jobs=2, chunk_size=1000)
+        data_normalized, _ = data_io.load_npz(os.path.join(output_npz_folder, 'Ch3.npz'))
+        np.testing.assert_allclose(data_normalized, preprocessing.zscore_normalize(data), rtol=1e-10, atol=1e-12)
 
         shutil.rmtree(output_npz_folder)
         command_prompt = f'python3 -m elecphys.main zscore_normalize_npz --input_npz_folder {npz_files_folder} --output_npz_folder {output_npz_folder}'
@@ -97,6 +301,12 @@ class TestCases_1_preprocessing(unittest.TestCase):
             shutil.rmtree(output_npz_folder)
         preprocessing.normalize_npz(npz_files_folder, output_npz_folder)
         self.assertTrue(os.path.exists(output_npz_folder))
+        data, _ = data_io.load_npz(os.path.join(npz_files_folder, 'Ch3.npz'))
+        # chunked and parallel normalization gives the same result as normalizing the whole channel
+        shutil.rmtree(output_npz_folder)
+        preprocessing.normalize_npz(npz_files_folder, output_npz_folder, n_jobs=2, chunk_size=1000)
+        data_normalized, _ = data_io.load_npz(os.path.join(output_npz_folder, 'Ch3.npz'))
+        np.testing.assert_allclose(data_normalized, preprocessing.normalize(data), rtol=1e-10, atol=1e-12)
 
         shutil.rmtree(output_npz_folder)
         command_prompt = f'python3 -m elecphys.main normalize_npz --input_npz_folder {npz_files_folder} --output_npz_folder {output_npz_folder}'
@@ -128,6 +338,74 @@ class TestCases_1_preprocessing(unittest.TestCase):
             os.system(command_prompt)
         self.assertTrue(os.path.exists(output_npz_folder))
 
+        # chunked re-referencing gives the same result as re-referencing the whole recording
+        data_all, _, _ = data_io.load_all_npz_files(npz_files_folder)
+        for method in ['mean', 'median']:
+            for ignore_channels, rr_channel in [(None, None), ("[1,4,6]", None), ([2], 3)]:
+                shutil.rmtree(output_npz_folder)
+                preprocessing.re_reference_npz(npz_files_folder, output_npz_folder, ignore_channels, rr_channel,
+                                               method, chunk_size=1000)
+                data_rereferenced, _, _ = data_io.load_all_npz_files(output_npz_folder)
+                np.testing.assert_allclose(
+                    data_rereferenced, preprocessing.re_reference(data_all, ignore_channels, rr_channel, method))
+        data_rereferenced = preprocessing.re_reference(data_all, "[1,4,6]", method='median')
+        np.testing.assert_array_equal(data_rereferenced[[0, 3, 5]], data_all[[0, 3, 5]])
+        channels = [ch_indx for ch_indx in range(data_all.shape[0]) if ch_indx not in [0, 3, 5]]
+        np.testing.assert_allclose(data_rereferenced[channels],
+                                   data_all[channels] - np.median(data_all[channels], axis=0))
+        with self.assertRaises(ValueError):
+            preprocessing.re_reference(data_all, method='mode')
+        shutil.rmtree(output_npz_folder)
+
+
+    def test_running_statistics(self):
+        data = np.random.default_rng(0).normal(3, 2, 10**5)
+        statistics = preprocessing.RunningStatistics()
+        for start_sample in range(0, len(data), 999):
+            statistics.update(data[start_sample:start_sample + 999])
+        self.assertEqual(statistics.num_samples, len(data))
+        self.assertAlmostEqual(statistics.mean, np.mean(data), places=12)
+        self.assertAlmostEqual(statistics.std, np.std(data), places=12)
+        self.assertEqual(statistics.max_abs, np.max(np.abs(data)))
+
+    def test_pca_from_npz(self):
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        output_npz_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_pca')
+        if os.path.exists(output_npz_folder):
+            shutil.rmtree(output_npz_folder)
+        command_prompt = f'python3 -m elecphys.main pca_from_npz --input_npz_folder {npz_files_folder} --output_npz_folder {output_npz_folder} --n_components 3 --channels_list "[1,2,3,4,5,6]"'
+        os.system(command_prompt)
+        self.assertEqual(data_io.list_channel_files(output_npz_folder), ['PC1.npz', 'PC2.npz', 'PC3.npz'])
+
+        # streaming PCA gives the same components as PCA of the whole recording
+        data_all, _, _ = data_io.load_all_npz_files(npz_files_folder)
+        eigenvalues, eigenvectors = np.linalg.eigh(np.cov(data_all))
+        eigenvalues, eigenvectors = eigenvalues[::-1][:4], eigenvectors[:, ::-1][:, :4]
+        for solver in ['full', 'randomized']:
+            shutil.rmtree(output_npz_folder)
+            dimensionality_reduction.pca_from_npz(npz_files_folder, output_npz_folder, 4, False, None, solver,
+                                                  chunk_size=1000, seed=0)
+            with open(os.path.join(output_npz_folder, dimensionality_reduction.PCA_MODEL_FILE)) as fp:
+                pca_model = json.load(fp)
+            components = np.array(pca_model['components'])
+            np.testing.assert_allclose(pca_model['explained_variance'], eigenvalues, rtol=1e-6)
+            np.testing.assert_allclose(np.abs(components @ eigenvectors), np.eye(4), atol=1e-4)
+            data_pca, _, _ = data_io.load_all_npz_files(output_npz_folder)
+            np.testing.assert_allclose(data_pca, components @ (data_all - np.mean(data_all, axis=1, keepdims=True)),
+                                       atol=1e-8 * np.max(np.abs(data_pca)))
+
+        shutil.rmtree(output_npz_folder)
+        dimensionality_reduction.pca_from_npz(npz_files_folder, output_npz_folder, 2, True, "[2,3,5,8]",
+                                              output_format='npy', chunk_size=1000)
+        self.assertTrue(data_io.is_npy_store(output_npz_folder))
+        data_pca, _, _ = data_io.load_all_npz_files(output_npz_folder)
+        self.assertEqual(data_pca.shape, (2, data_all.shape[1]))
+        np.testing.assert_allclose(np.var(data_pca, axis=1, ddof=1), 1)
+        with self.assertRaises(ValueError):
+            dimensionality_reduction.pca_from_npz(npz_files_folder, output_npz_folder, 5, False, "[1,2,3]")
+
 
 class TestCases_2_fourier_analysis(unittest.TestCase):
     def test_stft_numeric_output_from_npz(self):
@@ -161,12 +439,161 @@ class TestCases_2_fourier_analysis(unittest.TestCase):
             npz_files_folder, output_npz_folder)
         self.assertTrue(os.path.exists(output_npz_folder))
 
+        output_npz_folder_parallel = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_dft_parallel')
+        if os.path.exists(output_npz_folder_parallel):
+            shutil.rmtree(output_npz_folder_parallel)
+        fourier_analysis.dft_numeric_output_from_npz(
+            npz_files_folder, output_npz_folder_parallel, n_jobs=2)
+        self.assertEqual(sorted(os.listdir(output_npz_folder)), sorted(os.listdir(output_npz_folder_parallel)))
+        for npz_file in data_io.list_channel_files(output_npz_folder):
+            _, Zxx = data_io.load_npz_dft(os.path.join(output_npz_folder, npz_file))
+            _, Zxx_parallel = data_io.load_npz_dft(os.path.join(output_npz_folder_parallel, npz_file))
+            self.assertTrue(np.array_equal(Zxx, Zxx_parallel))
+        shutil.rmtree(output_npz_folder_parallel)
+
+        data, fs = data_io.load_npz(os.path.join(npz_files_folder, 'Ch1.npz'))
+        f, Zxx = data_io.load_npz_dft(os.path.join(output_npz_folder, 'DFT_Ch1.npz'))
+        self.assertEqual(len(Zxx), len(data))
+        np.testing.assert_allclose(f, np.arange(len(data)) * (fs / len(data)))
+        np.testing.assert_allclose(Zxx, np.fft.fft(data))
+        fourier_analysis.dft_numeric_output_from_npz(
+            npz_files_folder, output_npz_folder_parallel, one_sided=True)
+        f_one_sided, Zxx_one_sided = data_io.load_npz_dft(os.path.join(output_npz_folder_parallel, 'DFT_Ch1.npz'))
+        np.testing.assert_allclose(f_one_sided, f[:len(data) // 2 + 1])
+        np.testing.assert_allclose(Zxx_one_sided, Zxx[:len(data) // 2 + 1])
+        shutil.rmtree(output_npz_folder_parallel)
+        fourier_analysis.utils.set_dtype('float32')
+        try:
+            fourier_analysis.dft_numeric_output_from_npz(
+                npz_files_folder, output_npz_folder_parallel, output_type='power', f_min=44, f_max=80)
+        finally:
+            fourier_analysis.utils.set_dtype('float64')
+        f_power, power = data_io.load_npz_dft(os.path.join(output_npz_folder_parallel, 'DFT_Ch1.npz'))
+        self.assertEqual(power.dtype, np.float32)
+        rows = (f >= 44) & (f <= 80)
+        np.testing.assert_array_equal(f_power, f[rows])
+        np.testing.assert_allclose(power, np.abs(Zxx[rows])**2, rtol=1e-3)
+        shutil.rmtree(output_npz_folder_parallel)
+
         shutil.rmtree(output_npz_folder)
         command_prompt = f'python3 -m elecphys.main dft_numeric_output_from_npz --input_npz_folder "{npz_files_folder}" --output_npz_folder {output_npz_folder}'
         for _ in range(2):
             os.system(command_prompt)
         self.assertTrue(os.path.exists(output_npz_folder))
 
+    def test_in_memory_chain(self):
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        output_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_chain')
+        if os.path.exists(output_folder):
+            shutil.rmtree(output_folder)
+        filter_args = {'filter_type': 'BPF', 'freq_cutoff': '[1,100]', 'filter_order': 4}
+        # same chain on disk and in memory
+        for folder, stft_folder in [(output_folder, 'stft_disk'), ('mem://chain', 'stft_memory')]:
+            preprocessing.re_reference_npz(npz_files_folder, os.path.join(folder, 'reref'))
+            fourier_analysis.butterworth_filtering_from_npz(
+                os.path.join(folder, 'reref'), os.path.join(folder, 'filtered'), dict(filter_args), n_jobs=2)
+            fourier_analysis.stft_numeric_output_from_npz(
+                os.path.join(folder, 'filtered'), os.path.join(output_folder, stft_folder), 1, 0.5)
+        self.assertFalse(os.path.exists('mem:'))
+        # the folders written by the modules of the package are read with elecphys.data_io
+        self.assertEqual(data_io.list_channel_files('mem://chain/filtered'),
+                         data_io.list_channel_files(os.path.join(output_folder, 'filtered')))
+        data, fs = data_io.load_channel('mem://chain/filtered', 'Filtered_Ch2.npz')
+        data_disk, fs_disk = data_io.load_npz(os.path.join(output_folder, 'filtered', 'Filtered_Ch2.npz'))
+        np.testing.assert_array_equal(data, data_disk)
+        self.assertEqual(fs, fs_disk)
+        data_all, _, _ = data_io.load_all_npz_files('mem://chain/reref', channels_list=[2, 3], t_min=1, t_max=2)
+        data_all_disk, _, _ = data_io.load_all_npz_files(
+            os.path.join(output_folder, 'reref'), channels_list=[2, 3], t_min=1, t_max=2)
+        np.testing.assert_array_equal(data_all, data_all_disk)
+        for npz_file in data_io.list_channel_files(os.path.join(output_folder, 'stft_disk')):
+            _, _, Zxx = data_io.load_npz_stft(os.path.join(output_folder, 'stft_disk', npz_file))
+            _, _, Zxx_memory = data_io.load_npz_stft(os.path.join(output_folder, 'stft_memory', npz_file))
+            np.testing.assert_array_equal(Zxx, Zxx_memory)
+        with self.assertRaises(ValueError):
+            fourier_analysis.stft_numeric_output_from_npz('mem://chain/filtered', 'mem://chain/stft', 1, 0.5)
+        with self.assertRaises(ValueError):
+            data_io.list_channel_files('mem://missing')
+        for folder in ['reref', 'filtered']:
+            data_io.release_memory_folder(f'mem://chain/{folder}')
+
+        mat_file = os.path.join(os.path.dirname(__file__), 'data', 'mat', 'sample.mat')
+        shutil.rmtree(output_folder)
+        command_prompt = f'python3 -m elecphys.main convert_mat_to_npz --mat_file {mat_file} --output_npz_folder mem://raw --notch_filter_freq 50 re_reference_npz --input_npz_folder mem://raw --output_npz_folder mem://reref stft_numeric_output_from_npz --input_npz_folder mem://reref --output_npz_folder {output_folder} --window_size 1 --overlap 0.5'
+        os.system(command_prompt)
+        self.assertEqual(len(data_io.list_channel_files(output_folder)), len(data_io.list_channel_files(npz_files_folder)))
+        shutil.rmtree(output_folder)
+
+    def test_float32_mode(self):
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        output_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_float32')
+        if os.path.exists(output_folder):
+            shutil.rmtree(output_folder)
+        filter_args = {'filter_type': 'BPF', 'freq_cutoff': '[1,100]', 'filter_order': 4}
+        results = {}
+        try:
+            for dtype in ['float64', 'float32']:
+                fourier_analysis.utils.set_dtype(dtype)
+                folder = f'mem://{dtype}'
+                preprocessing.re_reference_npz(npz_files_folder, f'{folder}/reref')
+                fourier_analysis.butterworth_filtering_from_npz(
+                    f'{folder}/reref', f'{folder}/filtered', dict(filter_args))
+                fourier_analysis.stft_numeric_output_from_npz(
+                    f'{folder}/filtered', os.path.join(output_folder, dtype), 1, 0.5)
+                data, _ = data_io.load_channel(f'{folder}/filtered', 'Filtered_Ch2.npz')
+                _, _, Zxx = data_io.load_npz_stft(os.path.join(output_folder, dtype, 'STFT_Filtered_Ch2.npz'))
+                data_all, _, _ = data_io.load_all_npz_files(npz_files_folder, channels_list=[1, 2])
+                results[dtype] = (data, Zxx, data_all)
+                for folder_name in ['reref', 'filtered']:
+                    data_io.release_memory_folder(f'{folder}/{folder_name}')
+        finally:
+            fourier_analysis.utils.set_dtype('float64')
+        for result, result_float32 in zip(results['float64'], results['float32']):
+            self.assertEqual(result_float32.real.dtype, np.float32)
+            np.testing.assert_allclose(result_float32, result, rtol=0, atol=1e-5 * np.max(np.abs(result)))
+        with self.assertRaises(ValueError):
+            fourier_analysis.utils.set_dtype('int16')
+        shutil.rmtree(output_folder)
+
+    def test_welch_psd_from_npz(self):
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        output_npz_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_psd')
+        if os.path.exists(output_npz_folder):
+            shutil.rmtree(output_npz_folder)
+        fourier_analysis.welch_psd_from_npz(npz_files_folder, output_npz_folder, 1, 0.5, n_jobs=2)
+        self.assertEqual(len(data_io.list_channel_files(output_npz_folder)), len(data_io.list_channel_files(npz_files_folder)))
+        data, fs = data_io.load_npz(os.path.join(npz_files_folder, 'Ch1.npz'))
+        f, psd = data_io.load_npz_dft(os.path.join(output_npz_folder, 'PSD_Ch1.npz'))
+        f_welch, psd_welch = signal.welch(data, fs, nperseg=int(fs), noverlap=int(fs / 2))
+        np.testing.assert_allclose(f, f_welch)
+        np.testing.assert_allclose(psd, psd_welch, rtol=1e-10)
+        with np.load(os.path.join(output_npz_folder, 'PSD_Ch1.npz')) as psd_npz:
+            self.assertTrue(np.all(psd_npz['Zxx_low'] < psd) and np.all(psd_npz['Zxx_high'] > psd))
+        fourier_analysis._MAX_BLOCK_ELEMENTS, max_block_elements = 10 * int(fs), fourier_analysis._MAX_BLOCK_ELEMENTS
+        try:
+            _, psd_blocks, _, _ = fourier_analysis.welch_psd_from_array(data, fs, 1, 0.5)
+        finally:
+            fourier_analysis._MAX_BLOCK_ELEMENTS = max_block_elements
+        np.testing.assert_allclose(psd_blocks, psd_welch, rtol=1e-10)
+
+        output_plot_file = os.path.join(os.path.dirname(__file__), 'data', 'plots', 'psd_plot.png')
+        if os.path.exists(output_plot_file):
+            os.remove(output_plot_file)
+        visualization.plot_dft_from_npz(output_npz_folder, output_plot_file, 1, 150, 'average_of_channels')
+        self.assertTrue(os.path.exists(output_plot_file))
+
+        shutil.rmtree(output_npz_folder)
+        command_prompt = f'python3 -m elecphys.main welch_psd_from_npz --input_npz_folder "{npz_files_folder}" --output_npz_folder {output_npz_folder} --window_size 1 --overlap 0.5'
+        os.system(command_prompt)
+        self.assertTrue(os.path.exists(os.path.join(output_npz_folder, 'PSD_Ch1.npz')))
+
     def test_frequency_filtering(self):
         filter_order = 2
         for filter_args in [{'filter_type': 'LPF', 'freq_cutoff': 100}, {
@@ -180,8 +607,10 @@ class TestCases_2_fourier_analysis(unittest.TestCase):
                 shutil.rmtree(output_npz_folder)
 
             fourier_analysis.butterworth_filtering_from_npz(
-                npz_files_folder, output_npz_folder, filter_args)
+                npz_files_folder, output_npz_folder, filter_args, n_jobs=2)
             self.assertTrue(os.path.exists(output_npz_folder))
+            with open(os.path.join(output_npz_folder, 'filter_freq_response.json'), 'r') as fp:
+                self.assertEqual(json.load(fp)['freq_cutoff'], filter_args['freq_cutoff'])
 
             shutil.rmtree(output_npz_folder)
             command_prompt = f'python3 -m elecphys.main frequncy_domain_filter --input_npz_folder "{npz_files_folder}" --output_npz_folder {output_npz_folder} --filter_type {filter_args["filter_type"]} --filter_order {filter_args["filter_order"]} --freq_cutoff "{filter_args["freq_cutoff"]}"'
@@ -213,6 +642,134 @@ class TestCases_2_fourier_analysis(unittest.TestCase):
         for _ in range(2):
             os.system(command_prompt)
 
+    def test_freq_bands_power_from_array(self):
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        data_all, fs, _ = data_io.load_all_npz_files(npz_files_folder, channels_list=[1, 2, 3], t_max=30)
+        freq_bands = [[0, 4], [44, 80], [10, 20]]
+        for window_type in ['hann', 'kaiser 5']:
+            power_bands = fourier_analysis.freq_bands_power_from_array(data_all, fs, 1, 0.5, freq_bands, window_type)
+            for ch_indx in range(data_all.shape[0]):
+                f, _, Zxx = fourier_analysis.stft_from_array(
+                    data_all[ch_indx], fs, 1, 0.5, window_type, boundary=None, padded=False)
+                self.assertEqual(power_bands.shape[2], Zxx.shape[1])
+                for band_indx, freq_band in enumerate(freq_bands):
+                    rows = (f >= freq_band[0]) & (f <= freq_band[1])
+                    np.testing.assert_allclose(power_bands[band_indx, ch_indx],
+                                               np.sum(np.abs(Zxx[rows])**2, axis=0), rtol=1e-10)
+        # a band narrower than the frequency resolution (0.5 Hz) has no power
+        with self.assertRaisesRegex(ValueError, r'\[10\.1, 10\.2\]'):
+            fourier_analysis.freq_bands_power_from_array(data_all, fs, 1, 0.5, [[0, 4], [10.1, 10.2]])
+
+    def test_rid_rihaczek4(self):
+        rng = np.random.default_rng(0)
+        for tbins, fbins in [(64, 64), (65, 64), (64, 100), (64, 128)]:
+            x = rng.standard_normal(tbins)
+            half = int(tbins / 2)
+            d = np.linspace(-1, 1, tbins)
+            ambf = np.zeros((tbins, tbins))
+            for i in range(tbins):
+                for j in range(tbins):
+                    n = (j + half) % tbins
+                    ambf[i, j] = x[n] * x[(n + i + half) % tbins] * np.exp(-1e4 * (d[i] * d[j])**4)
+            nfft = tbins if tbins - 1 == fbins else fbins
+            expected = np.fft.fft(ambf[np.arange(nfft) % tbins, :], axis=0)
+            if tbins - 1 != fbins:
+                expected[:, -1] = 0
+            tfd = cfc.rid_rihaczek4(x, fbins)
+            self.assertEqual(tfd.shape, expected.shape)
+            self.assertTrue(np.allclose(tfd, expected))
+            self.assertTrue(np.allclose(cfc.rid_rihaczek4(x, fbins, freq_rows=[1, 5, 9]), expected[[1, 5, 9], :]))
+
+        x = rng.standard_normal(300)
+        tfd = cfc.rid_rihaczek4(x, 100)
+        self.assertEqual(tfd.shape, (100, 300))
+        self.assertTrue(np.allclose(cfc.rid_rihaczek4(x, 100, freq_rows=[3, 40]), tfd[[3, 40], :]))
+
+    def test_calc_tf_mvl(self):
+        t = np.arange(1000) / 1000
+        x = np.random.default_rng(1).standard_normal(1000) + (1 + np.sin(2 * np.pi * 6 * t)) * np.sin(2 * np.pi * 40 * t)
+        freqs_phase = [2, 4, 6, 8]
+        freqs_amp = [30, 40, 50]
+        MI_mat = cfc.calc_tf_mvl(x, 1000, freqs_phase, freqs_amp)
+        self.assertEqual(MI_mat.shape, (len(freqs_phase), len(freqs_amp)))
+        for phase_counter, freq_phase in enumerate(freqs_phase):
+            for amp_counter, freq_amp in enumerate(freqs_amp):
+                mvl = cfc.band_tfMVL(x, [freq_amp - 1, freq_amp + 1], [freq_phase - 1, freq_phase + 1], 1000)
+                self.assertAlmostEqual(MI_mat[phase_counter, amp_counter], mvl)
+
+    def test_cfc_mi(self):
+        t = np.arange(10000) / 1000
+        x = np.random.default_rng(1).standard_normal(len(t)) + (1 + np.sin(2 * np.pi * 6 * t)) * np.sin(2 * np.pi * 40 * t)
+        freqs_phase = [4, 6, 8]
+        freqs_amp = [30, 40]
+        nbins = 20
+        MI_mat = cfc.cfc_mi(x, freqs_phase, freqs_amp, 1000, nbins)
+        self.assertEqual(MI_mat.shape, (len(freqs_phase), len(freqs_amp)))
+        bins = np.linspace(0, 360, nbins)
+        for phase_counter, freq_phase in enumerate(freqs_phase):
+            for amp_counter, freq_amp in enumerate(freqs_amp):
+                inst_phase = cfc.extract_inst_phase(cfc.butterworth_filter(x, freq_phase, 1000)[0])
+                inst_amp = cfc.extract_inst_amp(cfc.butterworth_filter(x, freq_amp, 1000)[0])
+                means_amps_in_bin = np.array([np.mean(inst_amp[(inst_phase >= bins[i]) & (inst_phase < bins[i + 1])])
+                                              for i in range(nbins - 1)])
+                means_amps_in_bin = means_amps_in_bin / np.sum(means_amps_in_bin)
+                MI = np.sum(means_amps_in_bin * np.log(means_amps_in_bin * (nbins - 1))) / nbins
+                self.assertAlmostEqual(MI_mat[phase_counter, amp_counter], MI)
+        self.assertEqual(np.argmax(MI_mat[:, 1]), 1)
+
+    def test_cfc_surrogates(self):
+        rng = np.random.default_rng(3)
+        t = np.arange(20000) / 1000
+        # the 40 Hz amplitude follows either the 6 Hz rhythm of the signal or an independent one
+        slow = signal.sosfiltfilt(signal.butter(2, [5, 7], 'bandpass', fs=1000, output='sos'),
+                                  rng.standard_normal((2, len(t))))
+        slow = slow / np.std(slow, axis=1, keepdims=True)
+        noise = slow[0] + 0.5 * rng.standard_normal(len(t))
+        freqs_phase = [2, 6]
+        freqs_amp = [40, 80]
+        for modulation, significant in [(0, True), (1, False)]:
+            x = noise + (1 + 0.5 * slow[modulation]) * np.sin(2 * np.pi * 40 * t)
+            MI_mat, z_mat, p_mat = cfc.surrogate_comodulogram(
+                x, 1000, freqs_phase, freqs_amp, 'mi', 50, seed=0)
+            np.testing.assert_allclose(MI_mat, cfc.cfc_mi(x, freqs_phase, freqs_amp, 1000))
+            self.assertEqual(p_mat.shape, (len(freqs_phase), len(freqs_amp)))
+            self.assertEqual(p_mat[1, 0] == 1 / 51, significant)
+            self.assertEqual(z_mat[1, 0] > 5, significant)
+        MI_mat, z_mat_block, p_mat_block = cfc.surrogate_comodulogram(
+            x, 1000, freqs_phase, freqs_amp, 'mi', 25, 'block_swap', seed=1)
+        _, z_mat_parallel, p_mat_parallel = cfc.surrogate_comodulogram(
+            x, 1000, freqs_phase, freqs_amp, 'mi', 25, 'block_swap', seed=1, n_jobs=2)
+        np.testing.assert_array_equal(z_mat_block, z_mat_parallel)
+        np.testing.assert_array_equal(p_mat_block, p_mat_parallel)
+        Phase, Amp = cfc.tf_phase_amp(x[:1001], 1000, freqs_phase, freqs_amp)
+        indexes = cfc.surrogate_indexes(Amp.shape[-1], 3, 'circular_shift', np.random.default_rng(0), 100)
+        self.assertTrue(np.all(np.sort(indexes, axis=1) == np.arange(Amp.shape[-1])))
+        surrogates_MI_mat = cfc._surrogates_batch(
+            (Phase, Amp, 'tf_mvl', 20, 'circular_shift', 100, 10, 3, 0))
+        for i in range(3):
+            np.testing.assert_allclose(surrogates_MI_mat[i], cfc.mvl_from_phase_amp(Phase, Amp[..., indexes[i]]))
+
+    def test_cfc_sliding(self):
+        t = np.arange(40000) / 1000
+        x = np.random.default_rng(2).standard_normal(len(t)) + \
+            (1 + (t >= 20) * np.sin(2 * np.pi * 6 * t)) * np.sin(2 * np.pi * 40 * t)
+        freqs_phase = [4, 6]
+        freqs_amp = [30, 40]
+        MI_mat, t_windows = fourier_analysis.calc_cfc_sliding_from_array(
+            x, 1000, freqs_amp, freqs_phase, 4, 2, method='mi')
+        self.assertEqual(MI_mat.shape, (19, len(freqs_phase), len(freqs_amp)))
+        np.testing.assert_allclose(t_windows, np.arange(2, 39, 2))
+        self.assertGreater(np.min(MI_mat[t_windows > 22, 1, 1]), 10 * np.max(MI_mat[t_windows < 18, 1, 1]))
+        MI_mat_parallel, _ = fourier_analysis.calc_cfc_sliding_from_array(
+            x, 1000, freqs_amp, freqs_phase, 4, 2, method='mi', n_jobs=2)
+        np.testing.assert_array_equal(MI_mat, MI_mat_parallel)
+        MI_mat, t_windows = fourier_analysis.calc_cfc_sliding_from_array(
+            x, 1000, freqs_amp, freqs_phase, 1, 1, time_interval=[10, 13])
+        self.assertEqual(MI_mat.shape, (3, len(freqs_phase), len(freqs_amp)))
+        np.testing.assert_allclose(t_windows, [10.5, 11.5, 12.5])
+        np.testing.assert_allclose(MI_mat[1], cfc.calc_tf_mvl(x[11000:12000], 1000, freqs_phase, freqs_amp))
+
     def test_cfc_from_npz(self):
         return
         npz_files_folder = os.path.join(
@@ -232,7 +789,7 @@ class TestCases_3_visualization(unittest.TestCase):
     def test_plot_stft(self):
         npz_files_folder = os.path.join(
             os.path.dirname(__file__), 'data', 'npz_stft')
-        npz_files = os.listdir(npz_files_folder)
+        npz_files = data_io.list_channel_files(npz_files_folder)
         npz_file = npz_files[0]
         output_plot_file = os.path.join(os.path.dirname(
             __file__), 'data', 'plots', 'stft_plot.png')
@@ -428,6 +985,208 @@ class TestCases_4_utils(unittest.TestCase):
     def test_get_matlab_engine(self):
         pass
 
+    def test_result_cache(self):
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        output_npz_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_dft_cached')
+        cache_dir = os.path.join(
+            os.path.dirname(__file__), 'data', 'cache')
+        for folder in [output_npz_folder, cache_dir]:
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+        os.environ['ELECPHYS_CACHE_DIR'] = cache_dir
+        try:
+            fourier_analysis.dft_numeric_output_from_npz(npz_files_folder, output_npz_folder)
+            result_cache = fourier_analysis.cache.get_cache()
+            num_channels = len(data_io.list_channel_files(npz_files_folder))
+            self.assertEqual((result_cache.hits, result_cache.misses), (0, num_channels))
+            _, Zxx = data_io.load_npz_dft(os.path.join(output_npz_folder, 'DFT_Ch1.npz'))
+            shutil.rmtree(output_npz_folder)
+            fourier_analysis.dft_numeric_output_from_npz(npz_files_folder, output_npz_folder)
+            self.assertEqual((result_cache.hits, result_cache.misses), (num_channels, num_channels))
+            _, Zxx_cached = data_io.load_npz_dft(os.path.join(output_npz_folder, 'DFT_Ch1.npz'))
+            np.testing.assert_array_equal(Zxx, Zxx_cached)
+            # other parameters are other results
+            fourier_analysis.dft_numeric_output_from_npz(npz_files_folder, output_npz_folder, f_max=100)
+            self.assertEqual(result_cache.misses, 2 * num_channels)
+            stats = result_cache.stats()
+            self.assertEqual(stats['entries'], 2 * num_channels)
+            self.assertEqual((stats['total_hits'], stats['total_misses']), (num_channels, 2 * num_channels))
+            # results of another version of the package are other results
+            input_files = [os.path.join(npz_files_folder, 'Ch1.npz')]
+            key = result_cache.key('dft', input_files, [])
+            package_version = fourier_analysis.cache.package_version
+            fourier_analysis.cache.package_version = lambda: 'other'
+            try:
+                self.assertNotEqual(result_cache.key('dft', input_files, []), key)
+            finally:
+                fourier_analysis.cache.package_version = package_version
+            # and so are the results of modified sources of the package
+            source_hash = fourier_analysis.cache.source_hash
+            fourier_analysis.cache.source_hash = lambda: 'other'
+            try:
+                self.assertNotEqual(result_cache.key('dft', input_files, []), key)
+            finally:
+                fourier_analysis.cache.source_hash = source_hash
+
+            # the least recently used results are removed first
+            os.environ['ELECPHYS_CACHE_SIZE'] = str(stats['size'] // 2)
+            result_cache = fourier_analysis.cache.get_cache()
+            result_cache.evict()
+            self.assertLessEqual(result_cache.stats()['size'], stats['size'] // 2)
+            shutil.rmtree(output_npz_folder)
+            fourier_analysis.dft_numeric_output_from_npz(npz_files_folder, output_npz_folder, f_max=100)
+            self.assertEqual((result_cache.hits, result_cache.misses), (num_channels, 0))
+            result_cache.clear()
+            self.assertEqual(result_cache.stats()['entries'], 0)
+        finally:
+            del os.environ['ELECPHYS_CACHE_DIR']
+            os.environ.pop('ELECPHYS_CACHE_SIZE', None)
+        shutil.rmtree(output_npz_folder)
+        shutil.rmtree(cache_dir)
+
+    def test_manifest(self):
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        input_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_manifest_input')
+        reref_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_manifest_reref')
+        stft_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_manifest_stft')
+        for folder in [input_folder, reref_folder, stft_folder]:
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+        shutil.copytree(npz_files_folder, input_folder)
+
+        def output_mtimes(folder):
+            return {file_name: os.stat(os.path.join(folder, file_name)).st_mtime_ns
+                    for file_name in os.listdir(folder) if file_name.endswith('.npz')}
+
+        def run_pipeline():
+            preprocessing.re_reference_npz(input_folder, reref_folder)
+            fourier_analysis.stft_numeric_output_from_npz(input_folder, stft_folder, 1, 0.5)
+
+        run_pipeline()
+        # the manifest is not listed as a channel file
+        self.assertEqual(len(data_io.list_channel_files(stft_folder)), len(data_io.list_channel_files(input_folder)))
+        with open(os.path.join(stft_folder, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        provenance = manifest['analyses'][manifest['outputs']['STFT_Ch1.npz']['analysis']]
+        self.assertEqual(provenance['name'], 'STFT')
+        self.assertEqual(provenance['params'], ['Ch1.npz', 1, 0.5, 'hann'])
+        self.assertEqual(provenance['source'], fourier_analysis.cache.source_hash())
+        self.assertIn('version', provenance)
+        # the provenance of outputs calculated from all channels is stored once
+        with open(os.path.join(reref_folder, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        self.assertEqual(len(manifest['analyses']), 1)
+        self.assertEqual(len(manifest['outputs']), len(data_io.list_channel_files(input_folder)))
+        reref_mtimes, stft_mtimes = output_mtimes(reref_folder), output_mtimes(stft_folder)
+        # nothing changed: all outputs are up to date
+        run_pipeline()
+        self.assertEqual(output_mtimes(reref_folder), reref_mtimes)
+        self.assertEqual(output_mtimes(stft_folder), stft_mtimes)
+        # one channel changed: only its STFT is regenerated, and all re-referenced channels
+        data, fs = data_io.load_npz(os.path.join(input_folder, 'Ch2.npz'))
+        np.savez(os.path.join(input_folder, 'Ch2.npz'), data=2 * data, fs=fs)
+        run_pipeline()
+        new_stft_mtimes = output_mtimes(stft_folder)
+        self.assertEqual([file_name for file_name in stft_mtimes if new_stft_mtimes[file_name] != stft_mtimes[file_name]],
+                         ['STFT_Ch2.npz'])
+        new_reref_mtimes = output_mtimes(reref_folder)
+        self.assertTrue(all(new_reref_mtimes[file_name] != reref_mtimes[file_name] for file_name in reref_mtimes))
+        # a modified or removed output is stale, and so are outputs of other parameters
+        os.remove(os.path.join(stft_folder, 'STFT_Ch3.npz'))
+        run_pipeline()
+        self.assertTrue(os.path.exists(os.path.join(stft_folder, 'STFT_Ch3.npz')))
+        stft_mtimes = output_mtimes(stft_folder)
+        fourier_analysis.stft_numeric_output_from_npz(input_folder, stft_folder, 1, 0.25)
+        new_stft_mtimes = output_mtimes(stft_folder)
+        self.assertTrue(all(new_stft_mtimes[file_name] != stft_mtimes[file_name] for file_name in stft_mtimes))
+        os.environ['ELECPHYS_FORCE_RECOMPUTE'] = 'True'
+        try:
+            preprocessing.re_reference_npz(input_folder, reref_folder)
+        finally:
+            del os.environ['ELECPHYS_FORCE_RECOMPUTE']
+        self.assertTrue(all(output_mtimes(reref_folder)[file_name] != new_reref_mtimes[file_name]
+                            for file_name in new_reref_mtimes))
+        for folder in [input_folder, reref_folder, stft_folder]:
+            shutil.rmtree(folder)
+
+    def test_profiling(self):
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        output_npz_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_profiled')
+        profile_json = os.path.join(
+            os.path.dirname(__file__), 'data', 'profile.json')
+        profile_cprofile = os.path.join(
+            os.path.dirname(__file__), 'data', 'profile.prof')
+        if os.path.exists(output_npz_folder):
+            shutil.rmtree(output_npz_folder)
+        profiling.clear_records()
+        with profiling.profile_command('re_reference_npz', trace_memory=True):
+            preprocessing.re_reference_npz(npz_files_folder, output_npz_folder, chunk_size=1000)
+        record = profiling.get_records()[0]
+        data_all, _, _ = data_io.load_all_npz_files(npz_files_folder)
+        self.assertEqual(record['command'], 're_reference_npz')
+        self.assertEqual(record['samples_read'], data_all.size)
+        self.assertEqual((record['bytes_read'], record['bytes_written']), (data_all.nbytes, data_all.nbytes))
+        self.assertTrue(0 < record['io_time_s'] <= record['wall_time_s'])
+        self.assertAlmostEqual(record['io_time_s'] + record['compute_time_s'], record['wall_time_s'])
+        self.assertGreater(record['peak_traced_memory_mb'], 0)
+        # the I/O of worker processes is counted too
+        for n_jobs in [1, 2]:
+            with profiling.profile_command(f'stft_{n_jobs}'):
+                fourier_analysis.stft_numeric_output_from_npz(
+                    output_npz_folder, f'{output_npz_folder}_stft_{n_jobs}', 1, 0.5, n_jobs=n_jobs)
+        record, record_parallel = profiling.get_records()[1:]
+        # memory is only traced on request
+        self.assertIsNone(record['peak_traced_memory_mb'])
+        self.assertGreater(record['peak_rss_mb'], 0)
+        self.assertEqual(record_parallel['samples_read'], data_all.size)
+        self.assertEqual((record_parallel['bytes_read'], record_parallel['bytes_written']),
+                         (record['bytes_read'], record['bytes_written']))
+        self.assertGreater(record_parallel['io_time_s'], 0)
+        for n_jobs in [1, 2]:
+            shutil.rmtree(f'{output_npz_folder}_stft_{n_jobs}')
+
+        shutil.rmtree(output_npz_folder)
+        command_prompt = f'python3 -m elecphys.main --profile_json {profile_json} --profile_cprofile {profile_cprofile} re_reference_npz --input_npz_folder {npz_files_folder} --output_npz_folder {output_npz_folder} dft_numeric_output_from_npz --input_npz_folder {output_npz_folder} --output_npz_folder {output_npz_folder}_dft'
+        os.system(command_prompt)
+        with open(profile_json) as fp:
+            records = json.load(fp)['commands']
+        self.assertEqual([record['command'] for record in records], ['re_reference_npz', 'dft_numeric_output'])
+        self.assertEqual(records[1]['samples_read'], data_all.size)
+        self.assertTrue(os.path.exists(profile_cprofile))
+        for folder in [output_npz_folder, f'{output_npz_folder}_dft']:
+            shutil.rmtree(folder)
+        for file_path in [profile_json, profile_cprofile]:
+            os.remove(file_path)
+
+    def test_cli_startup_imports(self):
+        def imported_modules(*args):
+            # modules imported by the command line interface, from the output of python -X importtime
+            output = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'elecphys.main', *args],
+                                    cwd=os.path.join(os.path.dirname(__file__), '..'), capture_output=True, text=True)
+            self.assertEqual(output.returncode, 0, output.stderr)
+            return {line.split('|')[-1].strip() for line in output.stderr.splitlines() if line.startswith('import time:')}
+
+        heavy_modules = ['matplotlib', 'scipy', 'h5py', 'mat73']
+        modules = imported_modules('--help')
+        self.assertEqual([module for module in heavy_modules if module in modules], [])
+        npz_files_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz')
+        output_npz_folder = os.path.join(
+            os.path.dirname(__file__), 'data', 'npz_normalized_startup')
+        modules = imported_modules('normalize_npz', '-i', npz_files_folder, '-o', output_npz_folder)
+        self.assertEqual([module for module in ['matplotlib', 'scipy.signal', 'h5py', 'mat73'] if module in modules], [])
+        self.assertEqual(len(data_io.list_channel_files(output_npz_folder)),
+                         len(data_io.list_channel_files(npz_files_folder)))
+        shutil.rmtree(output_npz_folder)
+
 
 if __name__ == '__main__':
     os.system('pip3 uninstall elecphys -y')